@@ -0,0 +1,58 @@
+import time
+import argparse
+import numpy as np
+
+from hepaccelerate.utils import JaggedStruct, choose_backend
+
+#random events with a few jets and many GenPart-like objects
+def make_events(nev, nmin1, nmax1, nmin2, nmax2, etamax, NUMPY_LIB, seed=0):
+    rng = np.random.RandomState(seed)
+    objs = []
+    for nmin, nmax in [(nmin1, nmax1), (nmin2, nmax2)]:
+        counts = rng.randint(nmin, nmax + 1, size=nev)
+        offsets = np.zeros(nev + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        n = offsets[-1]
+        attrs = {
+            "eta": rng.uniform(-etamax, etamax, size=n).astype(np.float32),
+            "phi": rng.uniform(-np.pi, np.pi, size=n).astype(np.float32),
+        }
+        objs += [JaggedStruct(NUMPY_LIB.array(offsets), {k: NUMPY_LIB.array(v) for k, v in attrs.items()}, NUMPY_LIB)]
+    return objs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the grid deltaR matching with the brute-force nearest match')
+    parser.add_argument('--use-cuda', action='store_true', help='Use the CUDA backend')
+    parser.add_argument('--events', action='store', help='Number of events', type=int, default=20000)
+    parser.add_argument('--objects', nargs=2, action='store', help='Minimum and maximum number of objects of the second collection per event', type=int, default=[100, 400])
+    parser.add_argument('--jets', nargs=2, action='store', help='Minimum and maximum number of objects of the first collection per event', type=int, default=[0, 11])
+    parser.add_argument('--etamax', action='store', help='The objects are uniform in |eta| < etamax', type=float, default=6.0)
+    parser.add_argument('--drcut', nargs='+', action='store', help='deltaR cuts to benchmark', type=float, default=[0.4, 0.05, 0.01, 0.005])
+    parser.add_argument('--repeat', action='store', help='Number of timed runs, the best one is reported', type=int, default=3)
+    args = parser.parse_args()
+
+    NUMPY_LIB, ha = choose_backend(args.use_cuda)
+    objs1, objs2 = make_events(args.events, args.jets[0], args.jets[1], args.objects[0], args.objects[1], args.etamax, NUMPY_LIB)
+    mask1 = NUMPY_LIB.ones(len(objs1.eta), dtype=NUMPY_LIB.bool_)
+    mask2 = NUMPY_LIB.ones(len(objs2.eta), dtype=NUMPY_LIB.bool_)
+    print("{0} events, {1} x {2} objects".format(args.events, len(objs1.eta), len(objs2.eta)))
+
+    for drcut in args.drcut:
+        times = {}
+        for name in ["grid", "brute force"]:
+            best = np.inf
+            #the first run compiles the kernels
+            for i in range(args.repeat + 1):
+                t0 = time.time()
+                if name == "grid":
+                    match_idx, match_dr = ha.match_deltar_grid(objs1, mask1, objs2, mask2, drcut)
+                else:
+                    _, match = ha.mask_deltar_several(objs1, mask1, [(objs2, mask2, drcut)], return_match=True)
+                t1 = time.time()
+                if i > 0:
+                    best = min(best, t1 - t0)
+            times[name] = best
+        #the brute force returns the nearest object also beyond drcut
+        expected = NUMPY_LIB.where(match["dr"] < drcut, match["index"], -1)
+        assert(np.all(NUMPY_LIB.asnumpy(match_idx) == NUMPY_LIB.asnumpy(expected)))
+        print("drcut {0}: grid {1:.2f} s, brute force {2:.2f} s".format(drcut, times["grid"], times["brute force"]))
@@ -0,0 +1,23 @@
+import os, argparse
+
+from hepaccelerate.utils import load_results, json_to_hbin
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Convert the output files of run_analysis.py between the JSON and the binary (.hbin) format')
+  parser.add_argument('filenames', nargs='+', help='JSON files to convert to .hbin, or .hbin files to convert to JSON')
+  parser.add_argument('--outdir', action='store', help='directory of the converted files, by default next to the inputs', type=str, default=None)
+  parser.add_argument('--remove', action='store_true', help='remove the input files after the conversion')
+  args = parser.parse_args()
+
+  for fn in args.filenames:
+    base, ext = os.path.splitext(fn)
+    if not args.outdir is None:
+      base = os.path.join(args.outdir, os.path.basename(base))
+    if ext == '.hbin':
+      outfn = base + '.json'
+      load_results(fn).save_json(outfn)
+    else:
+      outfn = json_to_hbin(fn, base + '.hbin')
+    print(f'{fn} -> {outfn}')
+    if args.remove:
+      os.remove(fn)
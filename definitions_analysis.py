@@ -588,6 +588,7 @@ histogram_settings = {
   'deltaRhadWHiggs'   : (0,5,31),
   'deltaRHiggsLepton' : (0,5,31),
   'PV_npvsGood'       : (0,101,102),
+  'DNN_pred'          : (0,1,21),
   'weights'           : (-2,2,401),
 #    "nleps" : (0,10,11),
 #    "btags" : (0,8,9),
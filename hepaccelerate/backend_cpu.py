@@ -3,50 +3,151 @@ import numba
 import numpy as np
 import math
 
-@numba.jit(fastmath=True)
+@numba.njit
 def searchsorted_devfunc(arr, val):
-    ret = -1
-
-    #overflow
-    if val > arr[-1]:
-        return len(arr)
-
+    """Bin of val in the edges arr, -1 for underflow (or nan) and len(arr) for overflow"""
     #underflow bin will not be filled
-    if val < arr[0]:
+    if not (val >= arr[0]):
         return -1
 
-    for i in range(len(arr)):
-        #if val <= arr[i]:
-        if val < arr[i+1]:
-            ret = i
-            break
-    return ret
-
-@numba.jit(fastmath=True)
-def searchsorted_devfunc2D(arr_x, arr_y, val_x, val_y):
-    ret = -1
-    for i in range(len(arr_x)):
-        for j in range(len(arr_y)):
-            #if val <= arr[i]:
-            if val_x < arr_x[i+1] and val_y <arr_y[i+1]:
-                ret_i = i
-                ret_j = j
-                break
-    return ret_i, ret_j
-
-#need atomics to add to bin contents
-@numba.jit
-def fill_histogram(data, weights, bins, out_w, out_w2):
+    #overflow, the last edge belongs to the last bin
+    if val > arr[-1]:
+        return len(arr)
+    if val == arr[-1]:
+        return len(arr) - 2
+
+    #binary search for the last edge <= val
+    lo = 0
+    hi = len(arr) - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if arr[mid] <= val:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+@numba.njit
+def histogram_bin_devfunc(bins, val, uniform):
+    """
+    Bin of val to fill in a histogram: under- and overflow go to the first and last bin, nan goes to the first bin
+    together with the underflow. With uniform binning the bin is computed directly, otherwise by binary search.
+    """
+    nbins = len(bins) - 1
+    if np.isnan(val) or val < bins[0]:
+        return 0
+    if val >= bins[nbins]:
+        return nbins - 1
+    if not uniform:
+        return searchsorted_devfunc(bins, val)
+    ibin = int((val - bins[0]) / (bins[nbins] - bins[0]) * nbins)
+    #correct for the rounding close to the edges
+    if ibin >= nbins:
+        ibin = nbins - 1
+    if val < bins[ibin]:
+        ibin -= 1
+    elif val >= bins[ibin + 1]:
+        ibin += 1
+    return ibin
+
+@numba.njit
+def fill_histogram(data, weights, bins, uniform, out_w, out_w2):
     for i in range(len(data)):
-        bin_idx = searchsorted_devfunc(bins, data[i])
-        if bin_idx >= len(out_w):
-          bin_idx = len(out_w)-1
-        elif bin_idx == -1:
-          bin_idx = 0
-        if bin_idx >=0 and bin_idx < len(out_w):
+        bin_idx = histogram_bin_devfunc(bins, data[i], uniform)
+        if bin_idx >= 0:
             out_w[bin_idx] += weights[i]
             out_w2[bin_idx] += weights[i]**2
 
+#every thread fills a private copy of the histogram for a contiguous range of the data, the copies are summed at the end
+@numba.njit(parallel=True)
+def fill_histogram_parallel(data, weights, bins, uniform, nchunks, out_w, out_w2):
+    nbins = out_w.shape[0]
+    chunk_w = np.zeros((nchunks, nbins), dtype=out_w.dtype)
+    chunk_w2 = np.zeros((nchunks, nbins), dtype=out_w2.dtype)
+    chunksize = (len(data) + nchunks - 1) // nchunks
+    for ichunk in numba.prange(nchunks):
+        for i in range(ichunk*chunksize, min((ichunk + 1)*chunksize, len(data))):
+            bin_idx = histogram_bin_devfunc(bins, data[i], uniform)
+            if bin_idx >= 0:
+                chunk_w[ichunk, bin_idx] += weights[i]
+                chunk_w2[ichunk, bin_idx] += weights[i]**2
+    for ibin in numba.prange(nbins):
+        for ichunk in range(nchunks):
+            out_w[ibin] += chunk_w[ichunk, ibin]
+            out_w2[ibin] += chunk_w2[ichunk, ibin]
+
+#fill the histograms of several variables for several masks and weights for the events [start, end), data, masks and weights
+#are tuples of per-event arrays, such that no copy of them is needed. The edges of all the variables are concatenated in bins,
+#those of variable ivar are bins[edge_offsets[ivar]:edge_offsets[ivar+1]] and its histograms start at bin_offsets[ivar] in out_w.
+#The masks passed by an event are looked up once, the events passing none of them are skipped.
+@numba.njit
+def fill_histograms_several(data, masks, weights, bins, edge_offsets, bin_offsets, uniform, start, end, out_w, out_w2):
+    passed = np.zeros(len(masks), dtype=np.int64)
+    for i in range(start, end):
+        npassed = 0
+        for imask in range(len(masks)):
+            if masks[imask][i]:
+                passed[npassed] = imask
+                npassed += 1
+        if npassed == 0:
+            continue
+        for ivar in range(len(data)):
+            bin_idx = histogram_bin_devfunc(bins[edge_offsets[ivar]:edge_offsets[ivar+1]], data[ivar][i], uniform[ivar])
+            if bin_idx < 0:
+                continue
+            bin_idx += bin_offsets[ivar]
+            for k in range(npassed):
+                imask = passed[k]
+                for iw in range(len(weights)):
+                    out_w[imask, iw, bin_idx] += weights[iw][i]
+                    out_w2[imask, iw, bin_idx] += weights[iw][i]**2
+
+#every thread fills private copies of the histograms for a contiguous range of the events, the copies are summed at the end
+@numba.njit(parallel=True)
+def fill_histograms_several_parallel(data, masks, weights, bins, edge_offsets, bin_offsets, uniform, nchunks, out_w, out_w2):
+    nev = len(masks[0])
+    chunk_w = np.zeros((nchunks, ) + out_w.shape, dtype=out_w.dtype)
+    chunk_w2 = np.zeros((nchunks, ) + out_w2.shape, dtype=out_w2.dtype)
+    chunksize = (nev + nchunks - 1) // nchunks
+    for ichunk in numba.prange(nchunks):
+        fill_histograms_several(data, masks, weights, bins, edge_offsets, bin_offsets, uniform,
+            ichunk*chunksize, min((ichunk + 1)*chunksize, nev), chunk_w[ichunk], chunk_w2[ichunk])
+    flat_w = out_w.reshape(-1)
+    flat_w2 = out_w2.reshape(-1)
+    chunk_w = chunk_w.reshape((nchunks, -1))
+    chunk_w2 = chunk_w2.reshape((nchunks, -1))
+    for ibin in numba.prange(flat_w.shape[0]):
+        for ichunk in range(nchunks):
+            flat_w[ibin] += chunk_w[ichunk, ibin]
+            flat_w2[ibin] += chunk_w2[ichunk, ibin]
+
+#N-dimensional histogram, data has shape (ndim, nevents) and the edges of axis idim are bins[edge_offsets[idim]:edge_offsets[idim+1]].
+#The bins are filled in the flattened histogram with the given strides, every chunk of the data has a private copy.
+@numba.njit(parallel=True)
+def fill_histogram_nd(data, weights, bins, edge_offsets, uniform, strides, nchunks, out_w, out_w2):
+    nbins = out_w.shape[0]
+    ndim = data.shape[0]
+    nev = data.shape[1]
+    chunk_w = np.zeros((nchunks, nbins), dtype=out_w.dtype)
+    chunk_w2 = np.zeros((nchunks, nbins), dtype=out_w2.dtype)
+    chunksize = (nev + nchunks - 1) // nchunks
+    for ichunk in numba.prange(nchunks):
+        for i in range(ichunk*chunksize, min((ichunk + 1)*chunksize, nev)):
+            bin_idx = 0
+            for idim in range(ndim):
+                ibin = histogram_bin_devfunc(bins[edge_offsets[idim]:edge_offsets[idim+1]], data[idim, i], uniform[idim])
+                if ibin < 0:
+                    bin_idx = -1
+                    break
+                bin_idx += ibin*strides[idim]
+            if bin_idx >= 0:
+                chunk_w[ichunk, bin_idx] += weights[i]
+                chunk_w2[ichunk, bin_idx] += weights[i]**2
+    for ibin in numba.prange(nbins):
+        for ichunk in range(nchunks):
+            out_w[ibin] += chunk_w[ichunk, ibin]
+            out_w2[ibin] += chunk_w2[ichunk, ibin]
+
 @numba.njit(parallel=True)
 def select_opposite_sign_muons_kernel(muon_charges_content, muon_charges_offsets, content_mask_in, content_mask_out):
     
@@ -89,6 +190,13 @@ def sum_in_offsets_kernel(content, offsets, mask_rows, mask_content, out):
             if mask_content[ielem]:
                 out[iev] += content[ielem]
 
+#index of the event of every object
+@numba.njit(parallel=True)
+def get_parents_kernel(offsets, out):
+    for iev in numba.prange(offsets.shape[0]-1):
+        for ielem in range(offsets[iev], offsets[iev + 1]):
+            out[ielem] = iev
+
 @numba.njit(parallel=True)
 def multiply_in_offsets_kernel(content, offsets, mask_rows, mask_content, out):
 
@@ -144,62 +252,96 @@ def min_in_offsets_kernel(content, offsets, mask_rows, mask_content, out):
                     first = False
         out[iev] = accum
 
+#codes of the DNN input features computed on the fly from pt, eta, phi and mass,
+#the codes from DNN_NUM_KINEMATIC_FEATURES on refer to the rows of an array of extra columns
+DNN_KINEMATIC_FEATURES = {"pt": 0, "eta": 1, "phi": 2, "mass": 3, "px": 4, "py": 5, "pz": 6, "en": 7}
+DNN_NUM_KINEMATIC_FEATURES = len(DNN_KINEMATIC_FEATURES)
+
+@numba.njit
+def dnn_feature_devfunc(code, pt, eta, phi, mass, extras, ielem):
+    if code == 0:
+        return pt
+    elif code == 1:
+        return eta
+    elif code == 2:
+        return phi
+    elif code == 3:
+        return mass
+    elif code == 4:
+        return pt * np.cos(phi)
+    elif code == 5:
+        return pt * np.sin(phi)
+    elif code == 6:
+        return pt * np.sinh(eta)
+    elif code == 7:
+        return np.sqrt(mass**2 + (1+np.sinh(eta)**2)*pt**2)
+    return extras[code - DNN_NUM_KINEMATIC_FEATURES, ielem]
+
+#features of the first nobj masked objects of every event, out has shape (nev, nobj, nfeats)
 @numba.njit(parallel=True)
-def dnn_jets_kernel(content, offsets, feats_indx, nobj, mask_rows, mask_content, out):
+def dnn_objects_kernel(pt, eta, phi, mass, extras, offsets, codes, mask_rows, mask_content, out):
+    nobj = out.shape[1]
     for iev in numba.prange(offsets.shape[0]-1):
         if not mask_rows[iev]:
             continue
         start = offsets[iev]
         end = offsets[iev + 1]
 
-        for idx in range(nobj):
-            index_to_get = 0
-            for ielem in range(start, end):
-                if mask_content[ielem]:
-                    if index_to_get == idx:
-                        out[iev][idx][feats_indx] = content[ielem]
-                        break
-                    else:
-                        index_to_get += 1
+        iobj = 0
+        for ielem in range(start, end):
+            if iobj >= nobj:
+                break
+            if not mask_content[ielem]:
+                continue
+            for ifeat in range(codes.shape[0]):
+                out[iev, iobj, ifeat] = dnn_feature_devfunc(codes[ifeat], pt[ielem], eta[ielem], phi[ielem], mass[ielem], extras, ielem)
+            iobj += 1
 
+#features of the leading lepton, the first masked muon or electron with the higher pt, out has shape (nev, 1, nfeats)
 @numba.njit(parallel=True)
-def dnn_met_kernel(content, feats_indx, mask_rows, out):
-    for iev in numba.prange(content.shape[0]-1):
+def dnn_leps_kernel(mu_pt, mu_eta, mu_phi, mu_mass, mu_offsets, mu_mask_content,
+        el_pt, el_eta, el_phi, el_mass, el_offsets, el_mask_content, codes, mask_rows, out):
+    empty = np.zeros((0, 0), dtype=np.float32)
+    for iev in numba.prange(mu_offsets.shape[0]-1):
         if not mask_rows[iev]:
             continue
-
-        out[iev][feats_indx] = content[iev]
-
-
+        imu = -1
+        for ielem in range(mu_offsets[iev], mu_offsets[iev + 1]):
+            if mu_mask_content[ielem]:
+                imu = ielem
+                break
+        iel = -1
+        for ielem in range(el_offsets[iev], el_offsets[iev + 1]):
+            if el_mask_content[ielem]:
+                iel = ielem
+                break
+        if imu >= 0 and (iel < 0 or mu_pt[imu] > el_pt[iel]):
+            for ifeat in range(codes.shape[0]):
+                out[iev, 0, ifeat] = dnn_feature_devfunc(codes[ifeat], mu_pt[imu], mu_eta[imu], mu_phi[imu], mu_mass[imu], empty, imu)
+        elif iel >= 0:
+            for ifeat in range(codes.shape[0]):
+                out[iev, 0, ifeat] = dnn_feature_devfunc(codes[ifeat], el_pt[iel], el_eta[iel], el_phi[iel], el_mass[iel], empty, iel)
+
+#event-level features, with eta and mass set to 0, out has shape (nev, nfeats)
 @numba.njit(parallel=True)
-def dnn_leps_kernel(content, feats_indx, mask_rows, out):
-    for iev in numba.prange(content.shape[0]-1):
+def dnn_met_kernel(pt, phi, extras, codes, mask_rows, out):
+    for iev in numba.prange(pt.shape[0]):
         if not mask_rows[iev]:
             continue
+        for ifeat in range(codes.shape[0]):
+            out[iev, ifeat] = dnn_feature_devfunc(codes[ifeat], pt[iev], 0.0, phi[iev], 0.0, extras, iev)
 
-        out[iev][0][feats_indx] = content[iev]
-
-
-@numba.njit(parallel=True)
-def calc_px_kernel(content_pt, content_phi, out):
-    for iobj in numba.prange(content_pt.shape[0]-1):
-        out[iobj] = content_pt[iobj] * np.cos(content_phi[iobj])
-
-@numba.njit(parallel=True)
-def calc_py_kernel(content_pt, content_phi, out):
-    for iobj in numba.prange(content_pt.shape[0]-1):
-        out[iobj] = content_pt[iobj] * np.sin(content_phi[iobj])
-
+#px, py, pz and energy of every object, computed in double precision
 @numba.njit(parallel=True)
-def calc_pz_kernel(content_pt, content_eta, out):
-    for iobj in numba.prange(content_pt.shape[0]-1):
-        out[iobj] = content_pt[iobj] * np.sinh(content_eta[iobj])
+def calc_cartesian_kernel(content_pt, content_eta, content_phi, content_mass, out_px, out_py, out_pz, out_en):
+    for iobj in numba.prange(content_pt.shape[0]):
+        pt = np.float64(content_pt[iobj])
+        sinh_eta = np.sinh(np.float64(content_eta[iobj]))
+        out_px[iobj] = pt * np.cos(np.float64(content_phi[iobj]))
+        out_py[iobj] = pt * np.sin(np.float64(content_phi[iobj]))
+        out_pz[iobj] = pt * sinh_eta
+        out_en[iobj] = np.sqrt(np.float64(content_mass[iobj])**2 + (1+sinh_eta**2)*pt**2)
 
-@numba.njit(parallel=True)
-def calc_en_kernel(content_pt, content_eta, content_mass, out):
-    for iobj in numba.prange(content_pt.shape[0]-1):
-        out[iobj] = np.sqrt(content_mass[iobj]**2 + (1+np.sinh(content_eta[iobj])**2)*content_pt[iobj]**2)
-    
 @numba.njit(parallel=True)
 def get_in_offsets_kernel(content, offsets, indices, mask_rows, mask_content, out):
     for iev in numba.prange(offsets.shape[0]-1):
@@ -217,32 +359,73 @@ def get_in_offsets_kernel(content, offsets, indices, mask_rows, mask_content, ou
                 else:
                     index_to_get += 1
 
-'''
-Function to get the index of the index_to_get-th highest element of content. Combined with the get_in_offsets function it allows e.g. to access the jet with the 1st or 2nd highest btag score
-'''
+#content index of the element number indices[r, iev] among the masked elements of every event, stored in out[r, iev]
 @numba.njit(parallel=True)
-def index_in_offsets_kernel(content, offsets, index_to_get, mask_rows, mask_content, out):
+def resolve_in_offsets_kernel(offsets, indices, mask_rows, mask_content, out):
     for iev in numba.prange(offsets.shape[0]-1):
         if not mask_rows[iev]:
             continue
-            
         start = offsets[iev]
         end = offsets[iev + 1]
-        if end==start:
-          continue
-        event_content = content[start:end]
-
-        ind = 0
-        _index_to_get = index_to_get
-#        while _index_to_get < len(event_content):
-        for i in numba.prange(end-start):
-          ind = np.argsort(event_content)[-_index_to_get]
-          if mask_content[start + ind]:
-            out[iev] = ind
-            break
-          else:
-            _index_to_get += 1
-        
+
+        index_to_get = 0
+        for ielem in range(start, end):
+            if mask_content[ielem]:
+                for r in range(indices.shape[0]):
+                    if index_to_get == indices[r, iev]:
+                        out[r, iev] = ielem
+                index_to_get += 1
+
+@numba.njit(parallel=True)
+def get_at_indices_kernel(content, indices, mask_rows, out):
+    for iev in numba.prange(indices.shape[0]):
+        if not mask_rows[iev]:
+            continue
+        if indices[iev] >= 0:
+            out[iev] = content[indices[iev]]
+
+@numba.njit
+def rank_in_event_devfunc(content, mask_content, start, end, i, descending):
+    """Rank of the element i among the masked elements [start, end) of its event, ties are ranked in storage order"""
+    c = content[i]
+    rank = 0
+    for j in range(start, end):
+        if j == i or not mask_content[j]:
+            continue
+        if descending:
+            better = content[j] > c
+        else:
+            better = content[j] < c
+        if better or (content[j] == c and j < i):
+            rank += 1
+    return rank
+
+@numba.njit(parallel=True)
+def rank_in_offsets_kernel(content, offsets, mask_rows, mask_content, descending, out):
+    for iev in numba.prange(offsets.shape[0]-1):
+        if not mask_rows[iev]:
+            continue
+        start = offsets[iev]
+        end = offsets[iev + 1]
+        for i in range(start, end):
+            if mask_content[i]:
+                out[i] = rank_in_event_devfunc(content, mask_content, start, end, i, descending)
+
+#the content index of the element of rank r is stored in out[iev, r] for r < k
+@numba.njit(parallel=True)
+def topk_in_offsets_kernel(content, offsets, mask_rows, mask_content, descending, out):
+    k = out.shape[1]
+    for iev in numba.prange(offsets.shape[0]-1):
+        if not mask_rows[iev]:
+            continue
+        start = offsets[iev]
+        end = offsets[iev + 1]
+        for i in range(start, end):
+            if mask_content[i]:
+                rank = rank_in_event_devfunc(content, mask_content, start, end, i, descending)
+                if rank < k:
+                    out[iev, rank] = i
+
 @numba.njit(parallel=True)
 def min_in_offsets_kernel(content, offsets, mask_rows, mask_content, out):
     for iev in numba.prange(offsets.shape[0]-1):
@@ -275,6 +458,11 @@ def sum_in_offsets(struct, content, mask_rows, mask_content, dtype=None):
     sum_in_offsets_kernel(content, struct.offsets, mask_rows, mask_content, sum_offsets)
     return sum_offsets
 
+def get_parents(offsets, num_objects):
+    out = np.zeros(num_objects, dtype=np.int64)
+    get_parents_kernel(offsets, out)
+    return out
+
 def multiply_in_offsets(struct, content, mask_rows, mask_content, dtype=None):
     if not dtype:
         dtype = content.dtype
@@ -298,89 +486,111 @@ def select_muons_opposite_sign(muons, in_mask):
     return out_mask
 
 def get_in_offsets(content, offsets, indices, mask_rows, mask_content):
+    """
+    Element number indices[iev] among the masked elements of every event.
+    With mask_content=None, indices are content indices (e.g. from nth_in_offsets or topk_in_offsets), -1 if there is none.
+    """
     #out = np.zeros(len(offsets) - 1, dtype=content.dtype)
     out = -999.*np.ones(len(offsets) - 1, dtype=content.dtype) #to avoid histos being filled with 0 for non-existing objects, i.e. in events with no fat jets
-    get_in_offsets_kernel(content, offsets, indices, mask_rows, mask_content, out)
+    if mask_content is None:
+        get_at_indices_kernel(content, indices, mask_rows, out)
+    else:
+        get_in_offsets_kernel(content, offsets, indices, mask_rows, mask_content, out)
     return out
 
-def index_in_offsets(content, offsets, index_to_get, mask_rows, mask_content):
-    out = np.zeros(len(offsets) - 1, dtype=offsets.dtype)
-    index_in_offsets_kernel(content, offsets, index_to_get, mask_rows, mask_content, out)
-    return out
+def resolve_in_offsets(offsets, indices, mask_rows, mask_content):
+    """
+    Content index of the element number indices[iev] among the masked elements of every event, -1 if there is none.
+    indices can also be an array of (nindices, nev), e.g. to resolve the leading and sub-leading objects in one pass.
+    """
+    indices = np.asarray(indices)
+    out = -np.ones((1, ) + indices.shape if indices.ndim == 1 else indices.shape, dtype=np.int64)
+    resolve_in_offsets_kernel(offsets, indices.reshape(out.shape), mask_rows, mask_content, out)
+    return out.reshape(indices.shape)
+
+def get_at_indices(columns, inds):
+    """Gather the elements at the content indices inds (-1 gives -999) from every column of the dict columns"""
+    valid = inds >= 0
+    ret = {}
+    for name, content in columns.items():
+        out = -999.*np.ones(inds.shape, dtype=content.dtype)
+        out[valid] = content[inds[valid]]
+        ret[name] = out
+    return ret
 
-def calc_px(content_pt, content_phi):
-    out = np.zeros(content_pt.shape[0]-1, dtype=content_pt.dtype)
-    calc_px_kernel(content_pt, content_phi, out)
+def get_in_offsets_columns(columns, offsets, indices, mask_rows, mask_content):
+    """
+    get_in_offsets for several columns of the same objects, the objects are resolved only once.
+    columns is a dict of content arrays, returns a dict with the same keys. With indices of (nindices, nev),
+    every returned array has the same shape.
+    """
+    return get_at_indices(columns, resolve_in_offsets(offsets, indices, mask_rows, mask_content))
+
+def rank_in_offsets(content, offsets, mask_rows, mask_content, descending=True):
+    """Rank of every masked element within its event, 0 for the highest (lowest if not descending), -1 for the others"""
+    out = -np.ones(len(content), dtype=np.int64)
+    rank_in_offsets_kernel(content, offsets, mask_rows, mask_content, descending, out)
     return out
 
-def calc_py(content_pt, content_phi):
-    out = np.zeros(content_pt.shape[0]-1, dtype=content_pt.dtype)
-    calc_py_kernel(content_pt, content_phi, out)
+def topk_in_offsets(content, offsets, k, mask_rows, mask_content, descending=True):
+    """Content indices of the k highest (lowest if not descending) masked elements of every event, array of (nev, k) padded with -1"""
+    out = -np.ones((len(offsets) - 1, k), dtype=np.int64)
+    topk_in_offsets_kernel(content, offsets, mask_rows, mask_content, descending, out)
     return out
 
-def calc_pz(content_pt, content_eta):
-    out = np.zeros(content_pt.shape[0]-1, dtype=content_pt.dtype)
-    calc_pz_kernel(content_pt, content_eta, out)
-    return out
+def nth_in_offsets(content, offsets, n, mask_rows, mask_content, descending=True):
+    """Content index of the n-th (starting from 0) highest (lowest if not descending) masked element of every event, -1 if there is none"""
+    return np.ascontiguousarray(topk_in_offsets(content, offsets, n + 1, mask_rows, mask_content, descending)[:, n])
 
-def calc_en(content_pt, content_eta, content_mass):
-    out = np.zeros(content_pt.shape[0]-1, dtype=content_pt.dtype)
-    calc_en_kernel(content_pt, content_eta, content_mass, out)
+def index_in_offsets(content, offsets, index_to_get, mask_rows, mask_content):
+    """
+    Index within the event of the index_to_get-th (starting from 1) highest masked element, 0 if there is none.
+    Combined with the offsets it allows e.g. to access the jet with the 1st or 2nd highest btag score.
+    """
+    ind = nth_in_offsets(content, offsets, index_to_get - 1, mask_rows, mask_content)
+    return np.where(ind >= 0, ind - offsets[:-1], 0).astype(offsets.dtype)
+
+def calc_cartesian(content_pt, content_eta, content_phi, content_mass, out=None, dtype=np.float32):
+    """
+    Computes px, py, pz and the energy from pt, eta, phi and mass in one pass.
+    The results are written to out (a list of 4 arrays like content_pt) if given, otherwise new arrays of dtype.
+    """
+    if out is None:
+        out = [np.zeros(content_pt.shape[0], dtype=dtype) for i in range(4)]
+    assert(len(out) == 4 and all(o.shape == content_pt.shape for o in out))
+    calc_cartesian_kernel(content_pt, content_eta, content_phi, content_mass, *out)
     return out
 
 
-# functions preparing inputs for COBRA DNN architecture (not nice, but it works!!!)
+# functions preparing inputs for COBRA DNN architecture, one pass over the objects of every event per collection
+def dnn_feature_codes(feats, extra_feats):
+    return np.array([DNN_KINEMATIC_FEATURES[f] if f in DNN_KINEMATIC_FEATURES else DNN_NUM_KINEMATIC_FEATURES + extra_feats.index(f) for f in feats], dtype=np.int32)
+
 def make_jets_inputs(content, offsets, nobj, feats, mask_rows, mask_content):
-    
+    extra_feats = [f for f in feats if not f in DNN_KINEMATIC_FEATURES]
+    extras = np.zeros((len(extra_feats), len(content.pt)), dtype=np.float32)
+    for i, f in enumerate(extra_feats):
+        extras[i] = getattr(content, f)
     out = np.zeros((len(offsets) - 1, nobj, len(feats)), dtype=np.float32)
-    for f in feats:
-        if f == "px":
-            feature = calc_px(content.pt, content.phi)
-        elif f == "py":
-            feature = calc_py(content.pt, content.phi)
-        elif f == "pz":
-            feature = calc_pz(content.pt, content.eta)
-        elif f == "en":
-            feature = calc_en(content.pt, content.eta, content.mass)
-        else:
-            feature = getattr(content, f) 
-        dnn_jets_kernel(feature, offsets, feats.index(f), nobj, mask_rows, mask_content, out)
+    dnn_objects_kernel(content.pt, content.eta, content.phi, content.mass, extras, offsets,
+        dnn_feature_codes(feats, extra_feats), mask_rows, mask_content, out)
     return out
 
 def make_leps_inputs(electrons, muons, numEvents, feats, mask_rows, el_mask_content, mu_mask_content):
-
-    inds = np.zeros(numEvents, dtype=np.int32)
-
-    feature = {}
-    feature["pt"] = get_in_offsets(muons.pt, muons.offsets, inds, mask_rows, mu_mask_content) + get_in_offsets(electrons.pt, electrons.offsets, inds, mask_rows, el_mask_content)
-    feature["eta"] = get_in_offsets(muons.eta, muons.offsets, inds, mask_rows, mu_mask_content) + get_in_offsets(electrons.eta, electrons.offsets, inds, mask_rows, el_mask_content)
-    feature["phi"] = get_in_offsets(muons.phi, muons.offsets, inds, mask_rows, mu_mask_content) + get_in_offsets(electrons.phi, electrons.offsets, inds, mask_rows, el_mask_content)
-    feature["mass"] = get_in_offsets(muons.mass, muons.offsets, inds, mask_rows, mu_mask_content) + get_in_offsets(electrons.mass, electrons.offsets, inds, mask_rows, el_mask_content)
-
+    assert(all(f in DNN_KINEMATIC_FEATURES for f in feats))
     out = np.zeros((numEvents, 1, len(feats)), dtype=np.float32)
-    for f in feats:
-        if f == "px":
-            feature["px"] = calc_px(feature["pt"], feature["phi"])
-        elif f == "py":
-            feature["py"] = calc_py(feature["pt"], feature["phi"])
-        elif f == "pz":
-            feature["pz"] = calc_pz(feature["pt"], feature["eta"])
-        elif f == "en":
-            feature["en"] = calc_en(feature["pt"], feature["eta"], feature["mass"])
-        dnn_leps_kernel(feature[f], feats.index(f), mask_rows, out)
+    dnn_leps_kernel(muons.pt, muons.eta, muons.phi, muons.mass, muons.offsets, mu_mask_content,
+        electrons.pt, electrons.eta, electrons.phi, electrons.mass, electrons.offsets, el_mask_content,
+        dnn_feature_codes(feats, []), mask_rows, out)
     return out
 
 def make_met_inputs(content, numEvents, feats, mask_rows):
-
+    extra_feats = [f for f in feats if not f in DNN_KINEMATIC_FEATURES]
+    extras = np.zeros((len(extra_feats), numEvents), dtype=np.float32)
+    for i, f in enumerate(extra_feats):
+        extras[i] = content["MET_" + f]
     out = np.zeros((numEvents, len(feats)), dtype=np.float32)
-    for f in feats:
-        if f == "px":
-            feature = calc_px(content["MET_pt"], content["MET_phi"])
-        elif f == "py":
-            feature = calc_py(content["MET_pt"], content["MET_phi"])
-        else:
-            feature = content["MET_" + f]
-        dnn_met_kernel(feature, feats.index(f), mask_rows, out)
+    dnn_met_kernel(content["MET_pt"], content["MET_phi"], extras, dnn_feature_codes(feats, extra_feats), mask_rows, out)
     return out
 
 """
@@ -409,57 +619,218 @@ def get_lepton_SF_kernel(el_pt, el_eta, mu_pt, mu_eta, pdg_id, evaluator, name,
            out[iev] = evaluator["mu_"+name](mu_pt[iev], mu_eta[iev]) 
             
 
+#the references are stacked: offsets2 has shape (nref, nev+1) into the concatenated content of all references,
+#inds2[iref, iev] >= 0 compares only with the inds2-th masked object of the reference in the event
 @numba.njit(parallel=True)
-def mask_deltar_first_kernel(etas1, phis1, mask1, offsets1, etas2, phis2, mask2, offsets2, inds2, dr2, mask_out):
+def mask_deltar_several_kernel(etas1, phis1, mask1, offsets1, etas2, phis2, mask2, offsets2, inds2, dr2, mask_out, match_ref, match_idx, match_dr):
     
     for iev in numba.prange(len(offsets1)-1):
         a1 = offsets1[iev]
         b1 = offsets1[iev+1]
         
-        a2 = offsets2[iev]
-        b2 = offsets2[iev+1]
-        if not (inds2 is None):
-          masked = 0
-          for i in mask2[ a2:a2+inds2[iev] ]:
-            if not i:
-              masked += 1
-          a2 += inds2[iev] + masked
-        
         for idx1 in range(a1, b1):
             if not mask1[idx1]:
                 continue
                 
             eta1 = etas1[idx1]
             phi1 = phis1[idx1]
-            for idx2 in range(a2, b2):
-                if not mask2[idx2]:
-                    continue
-                eta2 = etas2[idx2]
-                phi2 = phis2[idx2]
-                
-                deta = abs(eta1 - eta2)
-                dphi = (phi1 - phi2 + math.pi) % (2*math.pi) - math.pi
-                
-                #if first object is closer than dr2, mask element will be *disabled*
-                passdr = ((deta**2 + dphi**2) < dr2)
-                mask_out[idx1] = mask_out[idx1] | passdr
-                if not (inds2 is None):
-                  break
-                
-def mask_deltar_first(objs1, mask1, objs2, mask2, drcut, inds2=None):
+            best = np.inf
+            for iref in range(offsets2.shape[0]):
+                a2 = offsets2[iref, iev]
+                b2 = offsets2[iref, iev+1]
+                nth = inds2[iref, iev]
+                imasked = 0
+                for idx2 in range(a2, b2):
+                    if not mask2[idx2]:
+                        continue
+                    if nth >= 0 and imasked < nth:
+                        imasked += 1
+                        continue
+                    eta2 = etas2[idx2]
+                    phi2 = phis2[idx2]
+                    
+                    deta = abs(eta1 - eta2)
+                    dphi = (phi1 - phi2 + math.pi) % (2*math.pi) - math.pi
+                    dr = deta**2 + dphi**2
+                    
+                    #if any reference object is closer than its dr2, mask element will be *disabled*
+                    if dr < dr2[iref]:
+                        mask_out[idx1] = True
+                    if dr < best:
+                        best = dr
+                        match_ref[idx1] = iref
+                        match_idx[idx1] = idx2 - a2
+                    if nth >= 0:
+                        break
+            if best < np.inf:
+                match_dr[idx1] = np.sqrt(best)
+
+def stack_deltar_references(objs1, refs):
+    nev = len(objs1.offsets) - 1
+    offsets2 = np.zeros((len(refs), nev + 1), dtype=np.int64)
+    inds2 = np.full((len(refs), nev), -1, dtype=np.int32)
+    dr2 = np.zeros(len(refs), dtype=np.float32)
+    shift = 0
+    for iref, ref in enumerate(refs):
+        objs2, mask2, drcut = ref[:3]
+        assert(mask2.shape == objs2.eta.shape)
+        assert(objs1.offsets.shape == objs2.offsets.shape)
+        offsets2[iref] = objs2.offsets + shift
+        shift += len(objs2.eta)
+        if len(ref) > 3 and not (ref[3] is None):
+            inds2[iref] = ref[3]
+        dr2[iref] = drcut**2
+    etas2 = np.concatenate([ref[0].eta for ref in refs])
+    phis2 = np.concatenate([ref[0].phi for ref in refs])
+    mask2 = np.concatenate([ref[1] for ref in refs])
+    return etas2, phis2, mask2, offsets2, inds2, dr2
+
+"""
+Cleans the objects in the first collection against several reference collections in one pass.
+refs is a list of (objs2, mask2, drcut) or (objs2, mask2, drcut, inds2), with inds2 the index of the only
+masked reference object to compare with in every event.
+Returns the mask of the objects that are farther than drcut from all the masked reference objects and,
+with return_match, a dict with the reference ("ref"), index in the event ("index") and deltaR ("dr") of the
+nearest compared reference object of every masked object (-1 if there is none).
+"""
+def mask_deltar_several(objs1, mask1, refs, return_match=False):
     assert(mask1.shape == objs1.eta.shape)
-    assert(mask2.shape == objs2.eta.shape)
-    assert(objs1.offsets.shape == objs2.offsets.shape)
     
-    mask_out = np.zeros_like(objs1.eta, dtype=np.bool)
-    mask_deltar_first_kernel(
+    etas2, phis2, mask2, offsets2, inds2, dr2 = stack_deltar_references(objs1, refs)
+    mask_out = np.zeros_like(objs1.eta, dtype=np.bool_)
+    match_ref = np.full(len(objs1.eta), -1, dtype=np.int32)
+    match_idx = np.full(len(objs1.eta), -1, dtype=np.int32)
+    match_dr = np.full(len(objs1.eta), -1, dtype=np.float32)
+    mask_deltar_several_kernel(
         objs1.eta, objs1.phi, mask1, objs1.offsets,
-        objs2.eta, objs2.phi, mask2, objs2.offsets, inds2,
-        drcut**2, mask_out
+        etas2, phis2, mask2, offsets2, inds2,
+        dr2, mask_out, match_ref, match_idx, match_dr
     )
     mask_out = np.invert(mask_out)
+    if return_match:
+        return mask_out, {"ref": match_ref, "index": match_idx, "dr": match_dr}
     return mask_out
 
+def mask_deltar_first(objs1, mask1, objs2, mask2, drcut, inds2=None):
+    return mask_deltar_several(objs1, mask1, [(objs2, mask2, drcut, inds2)])
+
+#the cells of the eta-phi grid are at least drcut wide, so every match is in the 3x3 cells around the object,
+#the eta axis of the grid covers [-DELTAR_GRID_ETA_MAX, DELTAR_GRID_ETA_MAX], the objects outside are put in the edge cells
+DELTAR_GRID_ETA_MAX = 6.0
+
+#the number of cells is also bounded by the mean number of objects per event nobj, more cells would only be empty
+def deltar_grid_dims(drcut, nobj):
+    assert(drcut > 0 and np.isfinite(drcut))
+    cell = max(drcut, math.sqrt(2*DELTAR_GRID_ETA_MAX*2*math.pi / max(nobj, 1)))
+    neta = max(int(2*DELTAR_GRID_ETA_MAX / cell), 1)
+    nphi = max(int(2*math.pi / cell), 1)
+    return neta, nphi
+
+@numba.njit
+def deltar_grid_cell_devfunc(eta, phi, neta, nphi):
+    ieta = min(max(int(math.floor((eta + DELTAR_GRID_ETA_MAX) * neta / (2*DELTAR_GRID_ETA_MAX))), 0), neta - 1)
+    iphi = min(int(((phi + math.pi) % (2*math.pi)) * nphi / (2*math.pi)), nphi - 1)
+    return ieta, iphi
+
+@numba.njit
+def lower_bound_devfunc(arr, start, end, val):
+    while start < end:
+        mid = (start + end) // 2
+        if arr[mid] < val:
+            start = mid + 1
+        else:
+            end = mid
+    return start
+
+#cells2 and sorted_idx2 are the cells and the indices of the second collection, sorted by cell in every event
+@numba.njit(parallel=True)
+def match_deltar_grid_kernel(etas1, phis1, mask1, offsets1, etas2, phis2, offsets2, cells2, sorted_idx2, dr2, neta, nphi, match_idx, match_dr):
+    for iev in numba.prange(len(offsets1)-1):
+        a1 = offsets1[iev]
+        b1 = offsets1[iev+1]
+        a2 = offsets2[iev]
+        b2 = offsets2[iev+1]
+
+        for idx1 in range(a1, b1):
+            if not mask1[idx1]:
+                continue
+            eta1 = etas1[idx1]
+            phi1 = phis1[idx1]
+            ieta1, iphi1 = deltar_grid_cell_devfunc(eta1, phi1, neta, nphi)
+            #with fewer than 3 cells in phi all of them are neighbours
+            if nphi >= 3:
+                dlo = -1
+                dhi = 2
+            else:
+                dlo = 0
+                dhi = nphi
+
+            best = dr2
+            ibest = -1
+            for ieta in range(max(ieta1 - 1, 0), min(ieta1 + 2, neta)):
+                for d in range(dlo, dhi):
+                    if nphi >= 3:
+                        iphi = (iphi1 + d) % nphi
+                    else:
+                        iphi = d
+                    icell = ieta*nphi + iphi
+                    k = lower_bound_devfunc(cells2, a2, b2, icell)
+                    while k < b2 and cells2[k] == icell:
+                        idx2 = sorted_idx2[k]
+                        deta = abs(eta1 - etas2[idx2])
+                        dphi = (phi1 - phis2[idx2] + math.pi) % (2*math.pi) - math.pi
+                        dr = deta**2 + dphi**2
+                        #ties are resolved by the storage order, as in a linear scan
+                        if dr < best or (dr == best and ibest >= 0 and idx2 < ibest):
+                            best = dr
+                            ibest = idx2
+                        k += 1
+            if ibest >= 0:
+                match_idx[idx1] = ibest - a2
+                match_dr[idx1] = np.sqrt(best)
+
+#cell of every masked object of the second collection, neta*nphi for the objects that are not masked
+@numba.njit(parallel=True)
+def deltar_grid_cells_kernel(etas, phis, mask, neta, nphi, out):
+    for i in numba.prange(len(etas)):
+        if mask[i]:
+            ieta, iphi = deltar_grid_cell_devfunc(etas[i], phis[i], neta, nphi)
+            out[i] = ieta*nphi + iphi
+        else:
+            out[i] = neta*nphi
+
+"""
+Matches every masked object of the first collection to the nearest masked object of the second collection
+(optionally only those with abs(pdgId) == pdgid) closer than drcut. The second collection is sorted once by
+event and cell of an eta-phi grid with cells of at least drcut, so only the objects in the neighbouring cells are
+compared, which is faster than a linear scan for large second collections (e.g. GenPart).
+Returns the index in the event of the match and the deltaR, -1 for the objects without a match.
+"""
+def match_deltar_grid(objs1, mask1, objs2, mask2, drcut, pdgid=None):
+    assert(mask1.shape == objs1.eta.shape)
+    assert(mask2.shape == objs2.eta.shape)
+    assert(objs1.offsets.shape == objs2.offsets.shape)
+
+    if not (pdgid is None):
+        mask2 = mask2 & (np.abs(objs2.pdgId) == pdgid)
+    neta, nphi = deltar_grid_dims(drcut, np.sum(mask2) / max(len(objs2.offsets) - 1, 1))
+
+    #sort the second collection by event and cell, the objects that are not masked go after the last cell
+    cells2 = np.zeros(len(objs2.eta), dtype=np.int64)
+    deltar_grid_cells_kernel(objs2.eta, objs2.phi, mask2, neta, nphi, cells2)
+    iev2 = get_parents(objs2.offsets, len(objs2.eta))
+    sorted_idx2 = np.argsort(iev2.astype(np.int64)*(neta*nphi + 1) + cells2, kind="stable").astype(np.int32)
+    cells2 = cells2[sorted_idx2].astype(np.int32)
+
+    match_idx = np.full(len(objs1.eta), -1, dtype=np.int32)
+    match_dr = np.full(len(objs1.eta), -1, dtype=np.float32)
+    match_deltar_grid_kernel(
+        objs1.eta, objs1.phi, mask1, objs1.offsets,
+        objs2.eta, objs2.phi, objs2.offsets, cells2, sorted_idx2,
+        drcut**2, neta, nphi, match_idx, match_dr
+    )
+    return match_idx, match_dr
+
 @numba.njit(parallel=True)
 def mask_overlappingAK4_kernel(etas1, phis1, mask1, offsets1, etas2, phis2, mask2, offsets2, tau32, tau21, dr2, tau32cut, tau21cut, mask_out):
     
@@ -506,12 +877,90 @@ def mask_overlappingAK4(objs1, mask1, objs2, mask2, drcut, tau32cut, tau21cut):
     mask_out = np.invert(mask_out)
     return mask_out
 
+#below this number of entries the parallel fill does not pay off
+HISTOGRAM_PARALLEL_MIN_ENTRIES = 100000
+HISTOGRAM_PARALLEL_MAX_BYTES = 2*1024**3
+
+def is_uniform_binning(bins):
+    widths = np.diff(bins)
+    return len(widths) > 0 and bool(np.allclose(widths, widths[0], rtol=1e-6, atol=0))
+
 def histogram_from_vector(data, weights, bins):        
+    bins = np.asarray(bins)
     out_w = np.zeros(len(bins) - 1, dtype=np.float64)
     out_w2 = np.zeros(len(bins) - 1, dtype=np.float64)
-    fill_histogram(data, weights, bins, out_w, out_w2)
+    uniform = is_uniform_binning(bins)
+    nchunks = min(numba.config.NUMBA_NUM_THREADS, len(data) // HISTOGRAM_PARALLEL_MIN_ENTRIES)
+    if nchunks > 1:
+        fill_histogram_parallel(data, weights, bins, uniform, nchunks, out_w, out_w2)
+    else:
+        fill_histogram(data, weights, bins, uniform, out_w, out_w2)
     return out_w, out_w2, bins
     
+def histogram_from_vector_nd(data, weights, bins):
+    """
+    Fill an N-dimensional histogram, data is the list of the values on every axis (or an array
+    of shape (ndim, nevents)) and bins the list of the edges of every axis.
+    Returns the contents and squared weights with one dimension per axis and the edges.
+    """
+    assert(len(data) == len(bins))
+    data = np.stack([np.asarray(d, dtype=np.float64) for d in data])
+    assert(data.shape[1] == len(weights))
+    bins = [np.asarray(b, dtype=np.float64) for b in bins]
+    shape = tuple(len(b) - 1 for b in bins)
+    edge_offsets = np.cumsum([0] + [len(b) for b in bins])
+    uniform = np.array([is_uniform_binning(b) for b in bins], dtype=np.bool_)
+    #row-major strides of the flattened histogram
+    strides = np.array([int(np.prod(shape[idim+1:])) for idim in range(len(shape))], dtype=np.int64)
+    out_w = np.zeros(int(np.prod(shape)), dtype=np.float64)
+    out_w2 = np.zeros(int(np.prod(shape)), dtype=np.float64)
+    nchunks = max(1, min(numba.config.NUMBA_NUM_THREADS, data.shape[1] // HISTOGRAM_PARALLEL_MIN_ENTRIES))
+    fill_histogram_nd(data, weights, np.concatenate(bins), edge_offsets, uniform, strides, nchunks, out_w, out_w2)
+    return out_w.reshape(shape), out_w2.reshape(shape), bins
+
+def histograms_from_vectors(data, masks, weights, bins):
+    """
+    Fill the histograms of every variable for every mask and weight in one pass over the events.
+    data, masks and weights are lists of per-event arrays (or arrays with one row per array), the events
+    which pass none of the masks are skipped by the kernel. bins is the list of the edges of each variable.
+    Returns the contents and squared weights with shape (nmasks, nweights, total number of bins)
+    and the offsets of the bins of each variable along the last axis.
+    """
+    assert(len(data) == len(bins))
+    #the kernel takes tuples of arrays of the same type, only the masks and weights of another type are converted
+    masks = tuple(np.ascontiguousarray(m, dtype=np.bool_) for m in masks)
+    wdtype = np.result_type(*weights) if len(weights) > 0 else np.float64
+    weights = tuple(np.ascontiguousarray(w, dtype=wdtype) for w in weights)
+    nev = len(masks[0]) if len(masks) > 0 else 0
+    assert(all(len(x) == nev for x in list(data) + list(masks) + list(weights)))
+    bins = [np.asarray(b, dtype=np.float64) for b in bins]
+    edge_offsets = np.cumsum([0] + [len(b) for b in bins])
+    bin_offsets = edge_offsets - np.arange(len(bins) + 1)
+    uniform = np.array([is_uniform_binning(b) for b in bins], dtype=np.bool_)
+    out_w = np.zeros((len(masks), len(weights), bin_offsets[-1]), dtype=np.float64)
+    out_w2 = np.zeros((len(masks), len(weights), bin_offsets[-1]), dtype=np.float64)
+    if len(bins) == 0 or len(masks) == 0 or len(weights) == 0:
+        return out_w, out_w2, bin_offsets
+
+    #the private copies of the histograms are limited to HISTOGRAM_PARALLEL_MAX_BYTES
+    nchunks = min(numba.config.NUMBA_NUM_THREADS, nev // HISTOGRAM_PARALLEL_MIN_ENTRIES,
+        HISTOGRAM_PARALLEL_MAX_BYTES // max(out_w.nbytes + out_w2.nbytes, 1))
+    #one pass for the variables of every array type
+    groups = {}
+    for ivar, x in enumerate(data):
+        x = np.asarray(x)
+        groups.setdefault(numba.typeof(x), []).append((ivar, x))
+    for group in groups.values():
+        ivars = [ivar for ivar, x in group]
+        group_bins = [bins[ivar] for ivar in ivars]
+        group_edge_offsets = np.cumsum([0] + [len(b) for b in group_bins])
+        args = (tuple(x for ivar, x in group), masks, weights, np.concatenate(group_bins), group_edge_offsets, bin_offsets[ivars], uniform[ivars])
+        if nchunks > 1:
+            fill_histograms_several_parallel(*args, nchunks, out_w, out_w2)
+        else:
+            fill_histograms_several(*args, 0, nev, out_w, out_w2)
+    return out_w, out_w2, bin_offsets
+
 @numba.njit(parallel=True)
 def get_bin_contents_kernel(values, edges, contents, out):
     for i in numba.prange(len(values)):
@@ -530,60 +979,79 @@ def get_lepton_SF(el_pt, el_eta, mu_pt, mu_eta, pdg_id, evaluator, name):
     get_lepton_SF_kernel(el_pt, el_eta, mu_pt, mu_eta, pdg_id, evaluator, name, out)
     return out
 
+#pz of the neutrino from the W mass constraint on the lepton and the MET, the optional outputs are empty arrays if not requested
 @numba.njit(parallel=True)
-def METzCalculator_kernel(A, B, tmproot, tmpsol1, tmpsol2, pzlep, pznu, mask_rows):
-  for i in numba.prange(len(tmpsol1)):
+def neutrino_pz_kernel(lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, mask_rows, M_W, pznu, root1, root2, nu_px, nu_py, nu_pz, nu_e):
+  for i in numba.prange(len(pznu)):
     if not mask_rows[i]:
+      #the events that are not selected keep the MET as the neutrino, with pz = 0
+      if len(nu_px) > 0:
+        nu_px[i] = met_pt[i]*np.cos(met_phi[i])
+        nu_py[i] = met_pt[i]*np.sin(met_phi[i])
+        nu_e[i] = met_pt[i]
       continue
-    if tmproot[i]<0: pznu[i] = - B[i]/(2*A[i])
-    else:
-      tmpsol1[i] = (-B[i] + np.sqrt(tmproot[i]))/(2.0*A[i])
-      tmpsol2[i] = (-B[i] - np.sqrt(tmproot[i]))/(2.0*A[i])
-      if (abs(tmpsol2[i]-pzlep[i]) < abs(tmpsol1[i]-pzlep[i])):
-        pznu[i] = tmpsol2[i]
-        #otherSol_ = tmpsol1
-      else:
-        pznu[i] = tmpsol1[i]
-        #otherSol_ = tmpsol2
-        #### if pznu is > 300 pick the most central root
-        if ( pznu[i] > 300. ):
-          if (abs(tmpsol1[i])<abs(tmpsol2[i]) ):
-            pznu[i] = tmpsol1[i]
-            #otherSol_ = tmpsol2
-          else:
-            pznu[i] = tmpsol2[i]
-            #otherSol_ = tmpsol1
-
-def METzCalculator(lepton, MET, mask_rows):
-    np.seterr(invalid='ignore') # to suppress warning from nonsense numbers in masked events
-    M_W = 80.4
-    M_lep = lepton.mass #.1056
-    elep = lepton.E
-    pxlep = lepton.x
-    pylep = lepton.y
-    pzlep = lepton.z
-    pxnu = MET.x
-    pynu = MET.y
-    pznu = 0
+    pt = np.float64(lep_pt[i])
+    pxlep = pt*np.cos(np.float64(lep_phi[i]))
+    pylep = pt*np.sin(np.float64(lep_phi[i]))
+    pzlep = pt*np.sinh(np.float64(lep_eta[i]))
+    M_lep = np.float64(lep_mass[i])
+    elep = np.sqrt(M_lep*M_lep + pt*pt + pzlep*pzlep)
+    pxnu = np.float64(met_pt[i])*np.cos(np.float64(met_phi[i]))
+    pynu = np.float64(met_pt[i])*np.sin(np.float64(met_phi[i]))
 
     a = M_W*M_W - M_lep*M_lep + 2.0*pxlep*pxnu + 2.0*pylep*pynu
     A = 4.0*(elep*elep - pzlep*pzlep)
-    #print(elep[np.isnan(A) & mask_rows], pzlep[np.isnan(A) & mask_rows])
     B = -4.0*a*pzlep
     C = 4.0*elep*elep*(pxnu*pxnu + pynu*pynu) - a*a
-    #print(a, A, B, C)
     tmproot = B*B - 4.0*A*C
 
-    tmpsol1 = np.zeros_like(A) #(-B + np.sqrt(tmproot))/(2.0*A)
-    tmpsol2 = np.zeros_like(A) #(-B - np.sqrt(tmproot))/(2.0*A)
-    pznu = np.zeros(len(M_lep), dtype=np.float32)
-    METzCalculator_kernel(A, B, tmproot, tmpsol1, tmpsol2, pzlep, pznu, mask_rows)
-
+    if tmproot<0:
+      #complex roots, take the real part
+      tmpsol1 = - B/(2*A)
+      tmpsol2 = tmpsol1
+      pz = tmpsol1
+    else:
+      tmpsol1 = (-B + np.sqrt(tmproot))/(2.0*A)
+      tmpsol2 = (-B - np.sqrt(tmproot))/(2.0*A)
+      if (abs(tmpsol2-pzlep) < abs(tmpsol1-pzlep)):
+        pz = tmpsol2
+      else:
+        pz = tmpsol1
+        #### if pznu is > 300 pick the most central root
+        if ( pz > 300. ):
+          if (abs(tmpsol1)<abs(tmpsol2) ):
+            pz = tmpsol1
+          else:
+            pz = tmpsol2
+    pznu[i] = pz
+    if len(root1) > 0:
+      root1[i] = tmpsol1
+      root2[i] = tmpsol2
+    if len(nu_px) > 0:
+      nu_px[i] = pxnu
+      nu_py[i] = pynu
+      nu_pz[i] = pz
+      nu_e[i] = np.sqrt(pxnu*pxnu + pynu*pynu + pz*pz)
+
+def neutrino_pz(lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, mask_rows, out_roots=None, out_p4=None, M_W=80.4):
+    """
+    Solves the W mass constraint on the lepton and the neutrino (with the MET as its transverse momentum) for pz
+    of the neutrino in every selected event, 0 in the other events. Of two real solutions, the one closest to pz of
+    the lepton is taken, or the most central one if it is above 300 GeV.
+    In the events that are not selected, pz is 0 and the neutrino four-vector is the MET.
+    Both solutions are written to out_roots (2 arrays) and the neutrino px, py, pz, E to out_p4 (4 arrays), if given.
+    """
+    empty = np.zeros(0, dtype=np.float32)
+    pznu = np.zeros(len(lep_pt), dtype=np.float32)
+    roots = out_roots if not (out_roots is None) else (empty, empty)
+    p4 = out_p4 if not (out_p4 is None) else (empty, empty, empty, empty)
+    assert(len(roots) == 2 and len(p4) == 4)
+    neutrino_pz_kernel(lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, mask_rows, M_W, pznu, *roots, *p4)
     return pznu
 
 @numba.njit(parallel=True)
 def calc_dr_kernel(phi1, eta1, phi2, eta2, mask, out):
-  for iobj in numba.prange(phi1.shape[0]-1):
+  for iobj in numba.prange(phi1.shape[0]):
     if not mask[iobj]:
       continue
     deta = abs(eta1[iobj] - eta2[iobj])
@@ -621,3 +1089,147 @@ def genPart_from_mother(genparts, daughterPdgId, motherPdgId, mask_rows):
 
     genPart_from_mother_kernel(daughters, genparts.offsets, genparts.pdgId, genparts.genPartIdxMother, motherPdgId, mask_rows, mask_out)
     return mask_out
+
+#kernels of best_combination, compiled once for every score function and combination size
+_best_combination_kernels = {}
+
+def make_best_combination_kernel(score, ncomb):
+    """
+    Kernel looping over the pairs (ncomb=2) or triplets (ncomb=3) of masked objects of every selected event.
+    score(px, py, pz, e, ref) is evaluated on the summed four-vector of every combination and the reference value
+    of the event, the combination with the lowest score below max_score is kept.
+    """
+    assert(ncomb in [2, 3])
+    key = (score, ncomb)
+    if key in _best_combination_kernels:
+        return _best_combination_kernels[key]
+    score_devfunc = numba.njit(score)
+
+    @numba.njit(parallel=True)
+    def best_combination_kernel(px, py, pz, e, offsets, mask_content, mask_rows, ref, max_score, best_idx, out_px, out_py, out_pz, out_e):
+        for iev in numba.prange(offsets.shape[0]-1):
+            if not mask_rows[iev]:
+                continue
+            start = offsets[iev]
+            end = offsets[iev + 1]
+            best = max_score
+            for i0 in range(start, end):
+                if not mask_content[i0]:
+                    continue
+                for i1 in range(i0 + 1, end):
+                    if not mask_content[i1]:
+                        continue
+                    if ncomb == 2:
+                        s = score_devfunc(px[i0] + px[i1], py[i0] + py[i1], pz[i0] + pz[i1], e[i0] + e[i1], ref[iev])
+                        if s < best:
+                            best = s
+                            best_idx[iev, 0] = i0
+                            best_idx[iev, 1] = i1
+                    else:
+                        for i2 in range(i1 + 1, end):
+                            if not mask_content[i2]:
+                                continue
+                            s = score_devfunc(px[i0] + px[i1] + px[i2], py[i0] + py[i1] + py[i2], pz[i0] + pz[i1] + pz[i2], e[i0] + e[i1] + e[i2], ref[iev])
+                            if s < best:
+                                best = s
+                                best_idx[iev, 0] = i0
+                                best_idx[iev, 1] = i1
+                                best_idx[iev, 2] = i2
+            if best_idx[iev, 0] >= 0:
+                for k in range(ncomb):
+                    out_px[iev] += px[best_idx[iev, k]]
+                    out_py[iev] += py[best_idx[iev, k]]
+                    out_pz[iev] += pz[best_idx[iev, k]]
+                    out_e[iev] += e[best_idx[iev, k]]
+
+    _best_combination_kernels[key] = best_combination_kernel
+    return best_combination_kernel
+
+def best_combination(objs, mask_content, mask_rows, ref, score, ncomb=2, max_score=np.inf):
+    """
+    Find the pair (ncomb=2) or triplet (ncomb=3) of masked objects in every selected event minimizing
+    score(px, py, pz, e, ref) of their summed four-vector, see make_best_combination_kernel.
+    The score is a plain python function using the math module, it is compiled for the backend.
+    
+    objs: JaggedStruct with pt, eta, phi and mass
+    ref: reference value of every event passed to the score, array of (nev, )
+
+    Returns the content indices of the best combination, array of (nev, ncomb) with -1 in the events without one,
+    and its four-vector as a dict of pt, eta, phi and mass, which are 0 in the events without a combination.
+    """
+    assert(mask_content.shape == objs.pt.shape)
+    assert(mask_rows.shape[0] == objs.offsets.shape[0] - 1)
+    nev = objs.offsets.shape[0] - 1
+
+    px, py, pz, e = objs.cartesian(dtype=np.float64)
+
+    best_idx = -np.ones((nev, ncomb), dtype=np.int64)
+    out = [np.zeros(nev, dtype=np.float64) for i in range(4)]
+    kernel = make_best_combination_kernel(score, ncomb)
+    kernel(px, py, pz, e, objs.offsets, mask_content, mask_rows, ref.astype(np.float64), max_score, best_idx, *out)
+    return best_idx, cartesian_to_ptetaphim(*out)
+
+#four-vectors stored as separate x, y, z, t arrays, see utils.LorentzVectorArray.
+#parents maps every output element to the element of a flat (one per event) operand, it is empty if the operand has the layout of the output
+@numba.njit(parallel=True)
+def p4_to_ptetaphim_kernel(x, y, z, t, pt, eta, phi, mass):
+    for i in numba.prange(x.shape[0]):
+        pt2 = x[i]**2 + y[i]**2
+        pt[i] = np.sqrt(pt2)
+        if pt2 > 0:
+            eta[i] = np.arcsinh(z[i] / pt[i])
+        else:
+            eta[i] = 0
+        phi[i] = np.arctan2(y[i], x[i])
+        mass[i] = np.sqrt(max(t[i]**2 - pt2 - z[i]**2, 0))
+
+@numba.njit(parallel=True)
+def p4_add_kernel(x1, y1, z1, t1, parents1, x2, y2, z2, t2, parents2, x, y, z, t):
+    for i in numba.prange(x.shape[0]):
+        i1 = np.int64(i)
+        if parents1.shape[0] > 0:
+            i1 = parents1[i]
+        i2 = np.int64(i)
+        if parents2.shape[0] > 0:
+            i2 = parents2[i]
+        x[i] = x1[i1] + x2[i2]
+        y[i] = y1[i1] + y2[i2]
+        z[i] = z1[i1] + z2[i2]
+        t[i] = t1[i1] + t2[i2]
+
+#boost by the velocity (bx, by, bz), as TLorentzVector::Boost
+@numba.njit(parallel=True)
+def p4_boost_kernel(x1, y1, z1, t1, bx, by, bz, parents, x, y, z, t):
+    for i in numba.prange(x.shape[0]):
+        ib = np.int64(i)
+        if parents.shape[0] > 0:
+            ib = parents[i]
+        b2 = bx[ib]**2 + by[ib]**2 + bz[ib]**2
+        if b2 >= 1:
+            x[i] = np.nan
+            y[i] = np.nan
+            z[i] = np.nan
+            t[i] = np.nan
+            continue
+        gamma = 1.0 / np.sqrt(1.0 - b2)
+        bp = bx[ib]*x1[i] + by[ib]*y1[i] + bz[ib]*z1[i]
+        gamma2 = (gamma - 1.0) / b2 if b2 > 0 else 0.0
+        x[i] = x1[i] + gamma2*bp*bx[ib] + gamma*bx[ib]*t1[i]
+        y[i] = y1[i] + gamma2*bp*by[ib] + gamma*by[ib]*t1[i]
+        z[i] = z1[i] + gamma2*bp*bz[ib] + gamma*bz[ib]*t1[i]
+        t[i] = gamma*(t1[i] + bp)
+
+def cartesian_to_ptetaphim(px, py, pz, e):
+    out = [np.zeros(len(px), dtype=np.float32) for i in range(4)]
+    p4_to_ptetaphim_kernel(px, py, pz, e, *out)
+    return dict(zip(["pt", "eta", "phi", "mass"], out))
+
+def p4_add(p1, parents1, p2, parents2, num_items):
+    out = [np.zeros(num_items, dtype=np.float32) for i in range(4)]
+    p4_add_kernel(*p1, parents1, *p2, parents2, *out)
+    return out
+
+def p4_boost(p, bx, by, bz, parents):
+    out = [np.zeros(len(p[0]), dtype=np.float32) for i in range(4)]
+    p4_boost_kernel(*p, bx, by, bz, parents, *out)
+    return out
@@ -23,18 +23,6 @@ def searchsorted_devfunc(arr, val):
             break
     return ret
 
-@cuda.jit(device=True)
-def searchsorted_devfunc2D(arr_x, arr_y, val_x, val_y):
-    ret = -1
-    for i in range(len(arr_x)):
-        for j in range(len(arr_y)):
-            #if val <= arr[i]:
-            if val_x < arr_x[i+1] and val_y <arr_y[i+1]:
-                ret_i = i
-                ret_j = j
-                break
-    return ret_i, ret_j
-
 @cuda.jit
 def searchsorted_kernel(vals, arr, inds_out):
     xi = cuda.grid(1)
@@ -62,6 +50,68 @@ def fill_histogram(data, weights, bins, out_w, out_w2):
             cuda.atomic.add(out_w, bin_idx, weights[i])
             cuda.atomic.add(out_w2, bin_idx, weights[i]**2)
 
+#same binning as backend_cpu.histogram_bin_devfunc: under- and overflow go to the first and last bin,
+#nan goes to the first bin, with uniform binning the bin is computed directly, otherwise by binary search
+@cuda.jit(device=True)
+def histogram_bin_devfunc(bins, val, uniform):
+    nbins = len(bins) - 1
+    if math.isnan(val) or val < bins[0]:
+        return 0
+    if val >= bins[nbins]:
+        return nbins - 1
+    if not uniform:
+        #binary search for the last edge <= val
+        lo = 0
+        hi = nbins
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if bins[mid] <= val:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+    ibin = int((val - bins[0]) / (bins[nbins] - bins[0]) * nbins)
+    #correct for the rounding close to the edges
+    if ibin >= nbins:
+        ibin = nbins - 1
+    if val < bins[ibin]:
+        ibin -= 1
+    elif val >= bins[ibin + 1]:
+        ibin += 1
+    return ibin
+
+#fill the histograms of several variables for several masks and weights, data has shape (nvars, nevents),
+#masks (nmasks, nevents) and weights (nweights, nevents), see backend_cpu.fill_histograms_several for the binning
+@cuda.jit
+def fill_histograms_several(data, masks, weights, bins, edge_offsets, bin_offsets, uniform, out_w, out_w2):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for i in range(xi, data.shape[1], xstride):
+        for ivar in range(data.shape[0]):
+            bin_idx = histogram_bin_devfunc(bins[edge_offsets[ivar]:edge_offsets[ivar+1]], data[ivar, i], uniform[ivar])
+            bin_idx += bin_offsets[ivar]
+            for imask in range(masks.shape[0]):
+                if not masks[imask, i]:
+                    continue
+                for iw in range(weights.shape[0]):
+                    cuda.atomic.add(out_w, (imask, iw, bin_idx), weights[iw, i])
+                    cuda.atomic.add(out_w2, (imask, iw, bin_idx), weights[iw, i]**2)
+
+#N-dimensional histogram, data has shape (ndim, nevents), see backend_cpu.fill_histogram_nd for the binning
+@cuda.jit
+def fill_histogram_nd(data, weights, bins, edge_offsets, uniform, strides, out_w, out_w2):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for i in range(xi, data.shape[1], xstride):
+        bin_idx = 0
+        for idim in range(data.shape[0]):
+            ibin = histogram_bin_devfunc(bins[edge_offsets[idim]:edge_offsets[idim+1]], data[idim, i], uniform[idim])
+            bin_idx += ibin*strides[idim]
+        cuda.atomic.add(out_w, bin_idx, weights[i])
+        cuda.atomic.add(out_w2, bin_idx, weights[i]**2)
+
 @cuda.jit
 def select_opposite_sign_muons_cudakernel(muon_charges_content, muon_charges_offsets, content_mask_in, content_mask_out):
     xi = cuda.grid(1)
@@ -108,6 +158,16 @@ def sum_in_offsets_cudakernel(content, offsets, mask_rows, mask_content, out):
             if mask_content[ielem]:
                 out[iev] += content[ielem]
 
+#index of the event of every object
+@cuda.jit
+def get_parents_cudakernel(offsets, out):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for iev in range(xi, offsets.shape[0]-1, xstride):
+        for ielem in range(offsets[iev], offsets[iev + 1]):
+            out[ielem] = iev
+
 @cuda.jit
 def multiply_in_offsets_cudakernel(content, offsets, mask_rows, mask_content, out):
     xi = cuda.grid(1)
@@ -146,81 +206,100 @@ def max_in_offsets_cudakernel(content, offsets, mask_rows, mask_content, out):
         out[iev] = accum
 
 @cuda.jit
-def calc_px_cudakernel(content_pt, content_phi, out):
+def calc_cartesian_cudakernel(content_pt, content_eta, content_phi, content_mass, out_px, out_py, out_pz, out_en):
     xi = cuda.grid(1)
     xstride = cuda.gridsize(1)
 
-    for iobj in range(xi, content_pt.shape[0]-1, xstride):
-        out[iobj] = content_pt[iobj] * math.cos(content_phi[iobj])
+    for iobj in range(xi, content_pt.shape[0], xstride):
+        pt = float(content_pt[iobj])
+        sinh_eta = math.sinh(float(content_eta[iobj]))
+        out_px[iobj] = pt * math.cos(float(content_phi[iobj]))
+        out_py[iobj] = pt * math.sin(float(content_phi[iobj]))
+        out_pz[iobj] = pt * sinh_eta
+        out_en[iobj] = math.sqrt(float(content_mass[iobj])**2 + (1+sinh_eta**2)*pt**2)
 
-@cuda.jit
-def calc_py_cudakernel(content_pt, content_phi, out):
-    xi = cuda.grid(1)
-    xstride = cuda.gridsize(1)
-
-    for iobj in range(xi, content_pt.shape[0]-1, xstride):
-        out[iobj] = content_pt[iobj] * math.sin(content_phi[iobj])
+#codes of the DNN input features, see backend_cpu.DNN_KINEMATIC_FEATURES
+DNN_KINEMATIC_FEATURES = {"pt": 0, "eta": 1, "phi": 2, "mass": 3, "px": 4, "py": 5, "pz": 6, "en": 7}
+DNN_NUM_KINEMATIC_FEATURES = len(DNN_KINEMATIC_FEATURES)
 
-@cuda.jit
-def calc_pz_cudakernel(content_pt, content_eta, out):
-    xi = cuda.grid(1)
-    xstride = cuda.gridsize(1)
-
-    for iobj in range(xi, content_pt.shape[0]-1, xstride):
-        out[iobj] = content_pt[iobj] * math.sinh(content_eta[iobj])
-
-@cuda.jit
-def calc_en_cudakernel(content_pt, content_eta, content_mass, out):
-    xi = cuda.grid(1)
-    xstride = cuda.gridsize(1)
-
-    for iobj in range(xi, content_pt.shape[0]-1, xstride):
-        out[iobj] = math.sqrt(content_mass[iobj]**2 + (1+math.sinh(content_eta[iobj])**2)*content_pt[iobj]**2)
+@cuda.jit(device=True)
+def dnn_feature_devfunc(code, pt, eta, phi, mass, extras, ielem):
+    if code == 0:
+        return pt
+    elif code == 1:
+        return eta
+    elif code == 2:
+        return phi
+    elif code == 3:
+        return mass
+    elif code == 4:
+        return pt * math.cos(phi)
+    elif code == 5:
+        return pt * math.sin(phi)
+    elif code == 6:
+        return pt * math.sinh(eta)
+    elif code == 7:
+        return math.sqrt(mass**2 + (1+math.sinh(eta)**2)*pt**2)
+    return extras[code - DNN_NUM_KINEMATIC_FEATURES, ielem]
 
 @cuda.jit
-def dnn_jets_cudakernel(content, offsets, feats_indx, nobj, mask_rows, mask_content, out):
+def dnn_objects_cudakernel(pt, eta, phi, mass, extras, offsets, codes, mask_rows, mask_content, out):
     xi = cuda.grid(1)
     xstride = cuda.gridsize(1)
 
+    nobj = out.shape[1]
     for iev in range(xi, offsets.shape[0]-1, xstride):
         if not mask_rows[iev]:
             continue
         start = offsets[iev]
         end = offsets[iev + 1]
 
-        for idx in range(nobj):
-            index_to_get = 0
-            for ielem in range(start, end):
-                if mask_content[ielem]:
-                    if index_to_get == idx:
-                        out[iev][idx][feats_indx] = content[ielem]
-                        break
-                    else:
-                        index_to_get += 1
-
+        iobj = 0
+        for ielem in range(start, end):
+            if iobj >= nobj:
+                break
+            if not mask_content[ielem]:
+                continue
+            for ifeat in range(codes.shape[0]):
+                out[iev, iobj, ifeat] = dnn_feature_devfunc(codes[ifeat], pt[ielem], eta[ielem], phi[ielem], mass[ielem], extras, ielem)
+            iobj += 1
 
 @cuda.jit
-def dnn_leps_cudakernel(content, feats_indx, mask_rows, out):
+def dnn_leps_cudakernel(mu_pt, mu_eta, mu_phi, mu_mass, mu_offsets, mu_mask_content,
+        el_pt, el_eta, el_phi, el_mass, el_offsets, el_mask_content, extras, codes, mask_rows, out):
     xi = cuda.grid(1)
     xstride = cuda.gridsize(1)
 
-    for iev in range(xi, content.shape[0]-1, xstride):
+    for iev in range(xi, mu_offsets.shape[0]-1, xstride):
         if not mask_rows[iev]:
             continue
-
-        out[iev][0][feats_indx] = content[iev]
-
+        imu = -1
+        for ielem in range(mu_offsets[iev], mu_offsets[iev + 1]):
+            if mu_mask_content[ielem]:
+                imu = ielem
+                break
+        iel = -1
+        for ielem in range(el_offsets[iev], el_offsets[iev + 1]):
+            if el_mask_content[ielem]:
+                iel = ielem
+                break
+        if imu >= 0 and (iel < 0 or mu_pt[imu] > el_pt[iel]):
+            for ifeat in range(codes.shape[0]):
+                out[iev, 0, ifeat] = dnn_feature_devfunc(codes[ifeat], mu_pt[imu], mu_eta[imu], mu_phi[imu], mu_mass[imu], extras, imu)
+        elif iel >= 0:
+            for ifeat in range(codes.shape[0]):
+                out[iev, 0, ifeat] = dnn_feature_devfunc(codes[ifeat], el_pt[iel], el_eta[iel], el_phi[iel], el_mass[iel], extras, iel)
 
 @cuda.jit
-def dnn_met_cudakernel(content, feats_indx, mask_rows, out):
+def dnn_met_cudakernel(pt, phi, extras, codes, mask_rows, out):
     xi = cuda.grid(1)
     xstride = cuda.gridsize(1)
 
-    for iev in range(xi, content.shape[0]-1, xstride):
+    for iev in range(xi, pt.shape[0], xstride):
         if not mask_rows[iev]:
             continue
-
-        out[iev][feats_indx] = content[iev]
+        for ifeat in range(codes.shape[0]):
+            out[iev, ifeat] = dnn_feature_devfunc(codes[ifeat], pt[iev], 0.0, phi[iev], 0.0, extras, iev)
 
 @cuda.jit
 def min_in_offsets_cudakernel(content, offsets, mask_rows, mask_content, out):
@@ -264,6 +343,82 @@ def get_in_offsets_cudakernel(content, offsets, indices, mask_rows, mask_content
                 else:
                     index_to_get += 1
         
+@cuda.jit
+def resolve_in_offsets_cudakernel(offsets, indices, mask_rows, mask_content, out):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for iev in range(xi, offsets.shape[0]-1, xstride):
+        if not mask_rows[iev]:
+            continue
+        start = offsets[iev]
+        end = offsets[iev + 1]
+
+        index_to_get = 0
+        for ielem in range(start, end):
+            if mask_content[ielem]:
+                for r in range(indices.shape[0]):
+                    if index_to_get == indices[r, iev]:
+                        out[r, iev] = ielem
+                index_to_get += 1
+
+@cuda.jit
+def get_at_indices_cudakernel(content, indices, mask_rows, out):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for iev in range(xi, indices.shape[0], xstride):
+        if not mask_rows[iev]:
+            continue
+        if indices[iev] >= 0:
+            out[iev] = content[indices[iev]]
+
+@cuda.jit(device=True)
+def rank_in_event_devfunc(content, mask_content, start, end, i, descending):
+    c = content[i]
+    rank = 0
+    for j in range(start, end):
+        if j == i or not mask_content[j]:
+            continue
+        if descending:
+            better = content[j] > c
+        else:
+            better = content[j] < c
+        if better or (content[j] == c and j < i):
+            rank += 1
+    return rank
+
+@cuda.jit
+def rank_in_offsets_cudakernel(content, offsets, mask_rows, mask_content, descending, out):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for iev in range(xi, offsets.shape[0]-1, xstride):
+        if not mask_rows[iev]:
+            continue
+        start = offsets[iev]
+        end = offsets[iev + 1]
+        for i in range(start, end):
+            if mask_content[i]:
+                out[i] = rank_in_event_devfunc(content, mask_content, start, end, i, descending)
+
+@cuda.jit
+def topk_in_offsets_cudakernel(content, offsets, mask_rows, mask_content, descending, out):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+    k = out.shape[1]
+
+    for iev in range(xi, offsets.shape[0]-1, xstride):
+        if not mask_rows[iev]:
+            continue
+        start = offsets[iev]
+        end = offsets[iev + 1]
+        for i in range(start, end):
+            if mask_content[i]:
+                rank = rank_in_event_devfunc(content, mask_content, start, end, i, descending)
+                if rank < k:
+                    out[iev, rank] = i
+
 @cuda.jit
 def min_in_offsets_cudakernel(content, offsets, mask_rows, mask_content, out):
     xi = cuda.grid(1)
@@ -294,6 +449,12 @@ def sum_in_offsets(struct, content, mask_rows, mask_content, dtype=None):
     cuda.synchronize()
     return sum_offsets
 
+def get_parents(offsets, num_objects):
+    out = cupy.zeros(num_objects, dtype=cupy.int64)
+    get_parents_cudakernel[32, 1024](offsets, out)
+    cuda.synchronize()
+    return out
+
 def multiply_in_offsets(struct, content, mask_rows, mask_content, dtype=None):
     if not dtype:
         dtype = content.dtype
@@ -322,12 +483,54 @@ def select_muons_opposite_sign(muons, in_mask):
 def get_in_offsets(content, offsets, indices, mask_rows, mask_content):
     #out = cupy.zeros(len(offsets) - 1, dtype=content.dtype)
     out = -999.*cupy.ones(len(offsets) - 1, dtype=content.dtype) #to avoid histos being filled with 0 for non-existing objects, i.e. in events with no fat jets
-    get_in_offsets_cudakernel[32, 1024](content, offsets, indices, mask_rows, mask_content, out)
+    if mask_content is None:
+        get_at_indices_cudakernel[32, 1024](content, indices, mask_rows, out)
+    else:
+        get_in_offsets_cudakernel[32, 1024](content, offsets, indices, mask_rows, mask_content, out)
     cuda.synchronize()
     return out
 
+def resolve_in_offsets(offsets, indices, mask_rows, mask_content):
+    indices = cupy.asarray(indices)
+    out = -cupy.ones((1, ) + indices.shape if indices.ndim == 1 else indices.shape, dtype=cupy.int64)
+    resolve_in_offsets_cudakernel[32, 1024](offsets, indices.reshape(out.shape), mask_rows, mask_content, out)
+    cuda.synchronize()
+    return out.reshape(indices.shape)
+
+def get_at_indices(columns, inds):
+    valid = inds >= 0
+    ret = {}
+    for name, content in columns.items():
+        out = -999.*cupy.ones(inds.shape, dtype=content.dtype)
+        out[valid] = content[inds[valid]]
+        ret[name] = out
+    return ret
+
+def get_in_offsets_columns(columns, offsets, indices, mask_rows, mask_content):
+    return get_at_indices(columns, resolve_in_offsets(offsets, indices, mask_rows, mask_content))
+
+def rank_in_offsets(content, offsets, mask_rows, mask_content, descending=True):
+    out = -cupy.ones(len(content), dtype=cupy.int64)
+    rank_in_offsets_cudakernel[32, 1024](content, offsets, mask_rows, mask_content, descending, out)
+    cuda.synchronize()
+    return out
+
+def topk_in_offsets(content, offsets, k, mask_rows, mask_content, descending=True):
+    out = -cupy.ones((len(offsets) - 1, k), dtype=cupy.int64)
+    topk_in_offsets_cudakernel[32, 1024](content, offsets, mask_rows, mask_content, descending, out)
+    cuda.synchronize()
+    return out
+
+def nth_in_offsets(content, offsets, n, mask_rows, mask_content, descending=True):
+    return cupy.ascontiguousarray(topk_in_offsets(content, offsets, n + 1, mask_rows, mask_content, descending)[:, n])
+
+def index_in_offsets(content, offsets, index_to_get, mask_rows, mask_content):
+    ind = nth_in_offsets(content, offsets, index_to_get - 1, mask_rows, mask_content)
+    return cupy.where(ind >= 0, ind - offsets[:-1], 0).astype(offsets.dtype)
+
 """
-For all events (N), mask the objects in the first collection (M1) if they are closer than dr2 to any object in the second collection (M2).
+For all events (N), mask the objects in the first collection (M1) if they are closer than dr2 to any object in the reference collections (M2),
+the references are concatenated along M2.
 
     etas1: etas of the first object, array of (M1, )
     phis1: phis of the first object, array of (M1, )
@@ -337,13 +540,16 @@ For all events (N), mask the objects in the first collection (M1) if they are cl
     etas2: etas of the second object, array of (M2, )
     phis2: phis of the second object, array of (M2, )
     mask2: mask (enabled) of the second object, array of (M2, )
-    offsets2: offsets of the second object, array of (N, )
+    offsets2: offsets of the references into M2, array of (nref, N+1)
+    inds2: index of the only masked object of the reference to compare with, -1 for all, array of (nref, N)
+    dr2: squared deltaR cut of every reference, array of (nref, )
     
     mask_out: output mask, array of (M1, )
+    match_ref, match_idx, match_dr: reference, index in the event and deltaR of the nearest object, arrays of (M1, )
 
 """
 @cuda.jit
-def mask_deltar_first_cudakernel(etas1, phis1, mask1, offsets1, etas2, phis2, mask2, offsets2, dr2, mask_out):
+def mask_deltar_several_cudakernel(etas1, phis1, mask1, offsets1, etas2, phis2, mask2, offsets2, inds2, dr2, mask_out, match_ref, match_idx, match_dr):
     xi = cuda.grid(1)
     xstride = cuda.gridsize(1)
     
@@ -351,43 +557,202 @@ def mask_deltar_first_cudakernel(etas1, phis1, mask1, offsets1, etas2, phis2, ma
         a1 = offsets1[iev]
         b1 = offsets1[iev+1]
         
-        a2 = offsets2[iev]
-        b2 = offsets2[iev+1]
-        
         for idx1 in range(a1, b1):
             if not mask1[idx1]:
                 continue
                 
             eta1 = etas1[idx1]
             phi1 = phis1[idx1]
-            for idx2 in range(a2, b2):
-                if not mask2[idx2]:
-                    continue
-                eta2 = etas2[idx2]
-                phi2 = phis2[idx2]
-                
-                deta = abs(eta1 - eta2)
-                dphi = (phi1 - phi2 + math.pi) % (2*math.pi) - math.pi
-                
-                #if first object is closer than dr2, mask element will be *disabled*
-                passdr = ((deta**2 + dphi**2) < dr2)
-                mask_out[idx1] = mask_out[idx1] | passdr
-                
-def mask_deltar_first(objs1, mask1, objs2, mask2, drcut):
+            best = math.inf
+            for iref in range(offsets2.shape[0]):
+                a2 = offsets2[iref, iev]
+                b2 = offsets2[iref, iev+1]
+                nth = inds2[iref, iev]
+                imasked = 0
+                for idx2 in range(a2, b2):
+                    if not mask2[idx2]:
+                        continue
+                    if nth >= 0 and imasked < nth:
+                        imasked += 1
+                        continue
+                    eta2 = etas2[idx2]
+                    phi2 = phis2[idx2]
+                    
+                    deta = abs(eta1 - eta2)
+                    dphi = (phi1 - phi2 + math.pi) % (2*math.pi) - math.pi
+                    dr = deta**2 + dphi**2
+                    
+                    #if any reference object is closer than its dr2, mask element will be *disabled*
+                    if dr < dr2[iref]:
+                        mask_out[idx1] = True
+                    if dr < best:
+                        best = dr
+                        match_ref[idx1] = iref
+                        match_idx[idx1] = idx2 - a2
+                    if nth >= 0:
+                        break
+            if best < math.inf:
+                match_dr[idx1] = math.sqrt(best)
+
+def stack_deltar_references(objs1, refs):
+    nev = len(objs1.offsets) - 1
+    offsets2 = cupy.zeros((len(refs), nev + 1), dtype=cupy.int64)
+    inds2 = cupy.full((len(refs), nev), -1, dtype=cupy.int32)
+    dr2 = cupy.zeros(len(refs), dtype=cupy.float32)
+    shift = 0
+    for iref, ref in enumerate(refs):
+        objs2, mask2, drcut = ref[:3]
+        assert(mask2.shape == objs2.eta.shape)
+        assert(objs1.offsets.shape == objs2.offsets.shape)
+        offsets2[iref] = objs2.offsets + shift
+        shift += len(objs2.eta)
+        if len(ref) > 3 and not (ref[3] is None):
+            inds2[iref] = ref[3]
+        dr2[iref] = drcut**2
+    etas2 = cupy.concatenate([ref[0].eta for ref in refs])
+    phis2 = cupy.concatenate([ref[0].phi for ref in refs])
+    mask2 = cupy.concatenate([ref[1] for ref in refs])
+    return etas2, phis2, mask2, offsets2, inds2, dr2
+
+def mask_deltar_several(objs1, mask1, refs, return_match=False):
     assert(mask1.shape == objs1.eta.shape)
-    assert(mask2.shape == objs2.eta.shape)
-    assert(objs1.offsets.shape == objs2.offsets.shape)
     
-    mask_out = cupy.zeros_like(objs1.eta, dtype=cupy.bool)
-    mask_deltar_first_cudakernel[32, 1024](
+    etas2, phis2, mask2, offsets2, inds2, dr2 = stack_deltar_references(objs1, refs)
+    mask_out = cupy.zeros_like(objs1.eta, dtype=cupy.bool_)
+    match_ref = cupy.full(len(objs1.eta), -1, dtype=cupy.int32)
+    match_idx = cupy.full(len(objs1.eta), -1, dtype=cupy.int32)
+    match_dr = cupy.full(len(objs1.eta), -1, dtype=cupy.float32)
+    mask_deltar_several_cudakernel[32, 1024](
         objs1.eta, objs1.phi, mask1, objs1.offsets,
-        objs2.eta, objs2.phi, mask2, objs2.offsets,
-        drcut**2, mask_out
+        etas2, phis2, mask2, offsets2, inds2,
+        dr2, mask_out, match_ref, match_idx, match_dr
     )
     cuda.synchronize()
     mask_out = cupy.invert(mask_out)
+    if return_match:
+        return mask_out, {"ref": match_ref, "index": match_idx, "dr": match_dr}
     return mask_out
 
+def mask_deltar_first(objs1, mask1, objs2, mask2, drcut, inds2=None):
+    return mask_deltar_several(objs1, mask1, [(objs2, mask2, drcut, inds2)])
+
+#the cells of the eta-phi grid are at least drcut wide, so every match is in the 3x3 cells around the object,
+#the eta axis of the grid covers [-DELTAR_GRID_ETA_MAX, DELTAR_GRID_ETA_MAX], the objects outside are put in the edge cells
+DELTAR_GRID_ETA_MAX = 6.0
+
+#the number of cells is also bounded by the mean number of objects per event nobj, more cells would only be empty
+def deltar_grid_dims(drcut, nobj):
+    assert(drcut > 0 and np.isfinite(drcut))
+    cell = max(drcut, math.sqrt(2*DELTAR_GRID_ETA_MAX*2*math.pi / max(nobj, 1)))
+    neta = max(int(2*DELTAR_GRID_ETA_MAX / cell), 1)
+    nphi = max(int(2*math.pi / cell), 1)
+    return neta, nphi
+
+@cuda.jit(device=True)
+def deltar_grid_cell_devfunc(eta, phi, neta, nphi):
+    ieta = min(max(int(math.floor((eta + DELTAR_GRID_ETA_MAX) * neta / (2*DELTAR_GRID_ETA_MAX))), 0), neta - 1)
+    iphi = min(int(((phi + math.pi) % (2*math.pi)) * nphi / (2*math.pi)), nphi - 1)
+    return ieta, iphi
+
+@cuda.jit(device=True)
+def lower_bound_devfunc(arr, start, end, val):
+    while start < end:
+        mid = (start + end) // 2
+        if arr[mid] < val:
+            start = mid + 1
+        else:
+            end = mid
+    return start
+
+#cells2 and sorted_idx2 are the cells and the indices of the second collection, sorted by cell in every event
+@cuda.jit
+def match_deltar_grid_cudakernel(etas1, phis1, mask1, offsets1, etas2, phis2, offsets2, cells2, sorted_idx2, dr2, neta, nphi, match_idx, match_dr):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for iev in range(xi, len(offsets1)-1, xstride):
+        a1 = offsets1[iev]
+        b1 = offsets1[iev+1]
+        a2 = offsets2[iev]
+        b2 = offsets2[iev+1]
+
+        for idx1 in range(a1, b1):
+            if not mask1[idx1]:
+                continue
+            eta1 = etas1[idx1]
+            phi1 = phis1[idx1]
+            ieta1, iphi1 = deltar_grid_cell_devfunc(eta1, phi1, neta, nphi)
+            #with fewer than 3 cells in phi all of them are neighbours
+            if nphi >= 3:
+                dlo = -1
+                dhi = 2
+            else:
+                dlo = 0
+                dhi = nphi
+
+            best = dr2
+            ibest = -1
+            for ieta in range(max(ieta1 - 1, 0), min(ieta1 + 2, neta)):
+                for d in range(dlo, dhi):
+                    if nphi >= 3:
+                        iphi = (iphi1 + d) % nphi
+                    else:
+                        iphi = d
+                    icell = ieta*nphi + iphi
+                    k = lower_bound_devfunc(cells2, a2, b2, icell)
+                    while k < b2 and cells2[k] == icell:
+                        idx2 = sorted_idx2[k]
+                        deta = abs(eta1 - etas2[idx2])
+                        dphi = (phi1 - phis2[idx2] + math.pi) % (2*math.pi) - math.pi
+                        dr = deta**2 + dphi**2
+                        #ties are resolved by the storage order, as in a linear scan
+                        if dr < best or (dr == best and ibest >= 0 and idx2 < ibest):
+                            best = dr
+                            ibest = idx2
+                        k += 1
+            if ibest >= 0:
+                match_idx[idx1] = ibest - a2
+                match_dr[idx1] = math.sqrt(best)
+
+#cell of every masked object of the second collection, neta*nphi for the objects that are not masked
+@cuda.jit
+def deltar_grid_cells_cudakernel(etas, phis, mask, neta, nphi, out):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+    for i in range(xi, len(etas), xstride):
+        if mask[i]:
+            ieta, iphi = deltar_grid_cell_devfunc(etas[i], phis[i], neta, nphi)
+            out[i] = ieta*nphi + iphi
+        else:
+            out[i] = neta*nphi
+
+def match_deltar_grid(objs1, mask1, objs2, mask2, drcut, pdgid=None):
+    assert(mask1.shape == objs1.eta.shape)
+    assert(mask2.shape == objs2.eta.shape)
+    assert(objs1.offsets.shape == objs2.offsets.shape)
+
+    if not (pdgid is None):
+        mask2 = mask2 & (cupy.abs(objs2.pdgId) == pdgid)
+    neta, nphi = deltar_grid_dims(drcut, int(cupy.sum(mask2)) / max(len(objs2.offsets) - 1, 1))
+
+    #sort the second collection by event and cell, the objects that are not masked go after the last cell
+    cells2 = cupy.zeros(len(objs2.eta), dtype=cupy.int64)
+    deltar_grid_cells_cudakernel[32, 1024](objs2.eta, objs2.phi, mask2, neta, nphi, cells2)
+    cuda.synchronize()
+    iev2 = get_parents(objs2.offsets, len(objs2.eta))
+    sorted_idx2 = cupy.argsort(iev2.astype(cupy.int64)*(neta*nphi + 1) + cells2).astype(cupy.int32)
+    cells2 = cells2[sorted_idx2].astype(cupy.int32)
+
+    match_idx = cupy.full(len(objs1.eta), -1, dtype=cupy.int32)
+    match_dr = cupy.full(len(objs1.eta), -1, dtype=cupy.float32)
+    match_deltar_grid_cudakernel[32, 1024](
+        objs1.eta, objs1.phi, mask1, objs1.offsets,
+        objs2.eta, objs2.phi, objs2.offsets, cells2, sorted_idx2,
+        drcut**2, neta, nphi, match_idx, match_dr
+    )
+    cuda.synchronize()
+    return match_idx, match_dr
+
 @cuda.jit
 def mask_overlappingAK4_cudakernel(etas1, phis1, mask1, offsets1, etas2, phis2, mask2, offsets2, tau32, tau21, dr2, tau32cut, tau21cut, mask_out):
     xi = cuda.grid(1)
@@ -444,6 +809,43 @@ def histogram_from_vector(data, weights, bins):
         fill_histogram[32, 1024](data, weights, bins, out_w, out_w2)
     return cupy.asnumpy(out_w), cupy.asnumpy(out_w2), cupy.asnumpy(bins)
 
+def is_uniform_binning(bins):
+    widths = np.diff(bins)
+    return len(widths) > 0 and bool(np.allclose(widths, widths[0], rtol=1e-6, atol=0))
+
+def histogram_from_vector_nd(data, weights, bins):
+    assert(len(data) == len(bins))
+    data = cupy.stack([cupy.asarray(d, dtype=cupy.float64) for d in data])
+    weights = cupy.asarray(weights, dtype=cupy.float64)
+    assert(data.shape[1] == len(weights))
+    bins = [cupy.asarray(b, dtype=cupy.float64) for b in bins]
+    shape = tuple(len(b) - 1 for b in bins)
+    edge_offsets = np.cumsum([0] + [len(b) for b in bins])
+    uniform = np.array([is_uniform_binning(cupy.asnumpy(b)) for b in bins], dtype=np.bool_)
+    strides = np.array([int(np.prod(shape[idim+1:])) for idim in range(len(shape))], dtype=np.int64)
+    out_w = cupy.zeros(int(np.prod(shape)), dtype=cupy.float64)
+    out_w2 = cupy.zeros(int(np.prod(shape)), dtype=cupy.float64)
+    if not data.shape[1] == 0:
+        fill_histogram_nd[32, 1024](data, weights, cupy.concatenate(bins), cupy.asarray(edge_offsets), cupy.asarray(uniform), cupy.asarray(strides), out_w, out_w2)
+    return cupy.asnumpy(out_w).reshape(shape), cupy.asnumpy(out_w2).reshape(shape), [cupy.asnumpy(b) for b in bins]
+
+#data, masks and weights are lists of per-event arrays, see backend_cpu.histograms_from_vectors,
+#they are stacked here as the kernel takes one array of each
+def histograms_from_vectors(data, masks, weights, bins):
+    assert(len(data) == len(bins))
+    bins = [cupy.asarray(b, dtype=cupy.float64) for b in bins]
+    edge_offsets = np.cumsum([0] + [len(b) for b in bins])
+    bin_offsets = edge_offsets - np.arange(len(bins) + 1)
+    uniform = np.array([is_uniform_binning(cupy.asnumpy(b)) for b in bins], dtype=np.bool_)
+    out_w = cupy.zeros((len(masks), len(weights), int(bin_offsets[-1])), dtype=cupy.float64)
+    out_w2 = cupy.zeros((len(masks), len(weights), int(bin_offsets[-1])), dtype=cupy.float64)
+    if len(bins) > 0 and len(masks) > 0 and len(weights) > 0 and len(masks[0]) > 0:
+        data = cupy.stack([cupy.asarray(x, dtype=cupy.float64) for x in data])
+        masks = cupy.stack([cupy.asarray(m, dtype=cupy.bool_) for m in masks])
+        weights = cupy.stack([cupy.asarray(w, dtype=cupy.float64) for w in weights])
+        assert(data.shape[1] == masks.shape[1] and data.shape[1] == weights.shape[1])
+        fill_histograms_several[32, 1024](data, masks, weights, cupy.concatenate(bins), cupy.asarray(edge_offsets), cupy.asarray(bin_offsets), cupy.asarray(uniform), out_w, out_w2)
+    return cupy.asnumpy(out_w), cupy.asnumpy(out_w2), bin_offsets
 
 @cuda.jit
 def get_bin_contents_cudakernel(values, edges, contents, out):
@@ -463,7 +865,8 @@ def get_bin_contents2D_cudakernel(values_x, values_y, edges_x, edges_y, contents
     for i in range(xi, len(values_x), xstride):
         v_x = values_x[i]
         v_y = values_y[i]
-        ibin, jbin = searchsorted_devfunc2D(edges_x, edges_y, v_x, v_y)
+        ibin = searchsorted_devfunc(edges_x, v_x)
+        jbin = searchsorted_devfunc(edges_y, v_y)
         if ibin>=0 and ibin < contents.shape[0] and jbin>=0 and jbin < contents.shape[1]:
             out[i] = contents[ibin, jbin]
 
@@ -473,86 +876,279 @@ def get_bin_contents(values, edges, contents, out):
     get_bin_contents_cudakernel[32, 1024](values, edges, contents, out)
 
 def get_bin_contents2D(values_x, values_y, edges, contents, out):
-    get_bin_contents2D_cudakernel(values_x, values_y, edges[0], edges[1], contents, out)
+    get_bin_contents2D_cudakernel[32, 1024](values_x, values_y, edges[0], edges[1], contents, out)
 
-def calc_px(content_pt, content_phi):
-    out = cupy.zeros(content_pt.shape[0] - 1, dtype=cupy.float32)
-    calc_px_cudakernel(content_pt, content_phi, out)
+def calc_cartesian(content_pt, content_eta, content_phi, content_mass, out=None, dtype=np.float32):
+    if out is None:
+        out = [cupy.zeros(content_pt.shape[0], dtype=dtype) for i in range(4)]
+    assert(len(out) == 4 and all(o.shape == content_pt.shape for o in out))
+    calc_cartesian_cudakernel[32, 1024](content_pt, content_eta, content_phi, content_mass, *out)
     cuda.synchronize()
     return out
 
-def calc_py(content_pt, content_phi):
-    out = cupy.zeros(content_pt.shape[0] - 1, dtype=cupy.float32)
-    calc_py_cudakernel(content_pt, content_phi, out)
+# functions preparing inputs for COBRA DNN architecture, one pass over the objects of every event per collection
+def dnn_feature_codes(feats, extra_feats):
+    return cupy.array([DNN_KINEMATIC_FEATURES[f] if f in DNN_KINEMATIC_FEATURES else DNN_NUM_KINEMATIC_FEATURES + extra_feats.index(f) for f in feats], dtype=cupy.int32)
+
+def make_jets_inputs(content, offsets, nobj, feats, mask_rows, mask_content):
+    extra_feats = [f for f in feats if not f in DNN_KINEMATIC_FEATURES]
+    extras = cupy.zeros((len(extra_feats), len(content.pt)), dtype=cupy.float32)
+    for i, f in enumerate(extra_feats):
+        extras[i] = getattr(content, f)
+    out = cupy.zeros((len(offsets) - 1, nobj, len(feats)), dtype=cupy.float32)
+    dnn_objects_cudakernel[32, 1024](content.pt, content.eta, content.phi, content.mass, extras, offsets,
+        dnn_feature_codes(feats, extra_feats), mask_rows, mask_content, out)
     cuda.synchronize()
     return out
 
-def calc_pz(content_pt, content_eta):
-    out = cupy.zeros(content_pt.shape[0] - 1, dtype=cupy.float32)
-    calc_pz_cudakernel(content_pt, content_eta, out)
+def make_leps_inputs(electrons, muons, numEvents, feats, mask_rows, el_mask_content, mu_mask_content):
+    assert(all(f in DNN_KINEMATIC_FEATURES for f in feats))
+    out = cupy.zeros((numEvents, 1, len(feats)), dtype=cupy.float32)
+    dnn_leps_cudakernel[32, 1024](muons.pt, muons.eta, muons.phi, muons.mass, muons.offsets, mu_mask_content,
+        electrons.pt, electrons.eta, electrons.phi, electrons.mass, electrons.offsets, el_mask_content,
+        cupy.zeros((1, 1), dtype=cupy.float32), dnn_feature_codes(feats, []), mask_rows, out)
     cuda.synchronize()
     return out
 
-def calc_en(content_pt, content_eta, content_mass):
-    out = cupy.zeros(content_pt.shape[0] - 1, dtype=cupy.float32)
-    calc_en_cudakernel(content_pt, content_eta, content_mass, out)
+def make_met_inputs(content, numEvents, feats, mask_rows):
+    extra_feats = [f for f in feats if not f in DNN_KINEMATIC_FEATURES]
+    extras = cupy.zeros((len(extra_feats), numEvents), dtype=cupy.float32)
+    for i, f in enumerate(extra_feats):
+        extras[i] = content["MET_" + f]
+    out = cupy.zeros((numEvents, len(feats)), dtype=cupy.float32)
+    dnn_met_cudakernel[32, 1024](content["MET_pt"], content["MET_phi"], extras, dnn_feature_codes(feats, extra_feats), mask_rows, out)
     cuda.synchronize()
     return out
 
-# functions preparing inputs for COBRA DNN architecture (not nice, but it works!!!)
-def make_jets_inputs(content, offsets, nobj, feats, mask_rows, mask_content):
 
-    out = cupy.zeros((len(offsets) - 1, nobj, len(feats)), dtype=cupy.float32)
-    for f in feats:
-        if f == "px":
-            feature = calc_px(content.pt, content.phi)
-        elif f == "py":
-            feature = calc_py(content.pt, content.phi)
-        elif f == "pz":
-            feature = calc_pz(content.pt, content.eta)
-        elif f == "en":
-            feature = calc_en(content.pt, content.eta, content.mass)
+@cuda.jit
+def neutrino_pz_cudakernel(lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, mask_rows, M_W, pznu, root1, root2, nu_px, nu_py, nu_pz, nu_e):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for i in range(xi, len(pznu), xstride):
+        if not mask_rows[i]:
+            #the events that are not selected keep the MET as the neutrino, with pz = 0
+            if len(nu_px) > 0:
+                nu_px[i] = met_pt[i]*math.cos(met_phi[i])
+                nu_py[i] = met_pt[i]*math.sin(met_phi[i])
+                nu_e[i] = met_pt[i]
+            continue
+        pt = float(lep_pt[i])
+        pxlep = pt*math.cos(float(lep_phi[i]))
+        pylep = pt*math.sin(float(lep_phi[i]))
+        pzlep = pt*math.sinh(float(lep_eta[i]))
+        M_lep = float(lep_mass[i])
+        elep = math.sqrt(M_lep*M_lep + pt*pt + pzlep*pzlep)
+        pxnu = float(met_pt[i])*math.cos(float(met_phi[i]))
+        pynu = float(met_pt[i])*math.sin(float(met_phi[i]))
+
+        a = M_W*M_W - M_lep*M_lep + 2.0*pxlep*pxnu + 2.0*pylep*pynu
+        A = 4.0*(elep*elep - pzlep*pzlep)
+        B = -4.0*a*pzlep
+        C = 4.0*elep*elep*(pxnu*pxnu + pynu*pynu) - a*a
+        tmproot = B*B - 4.0*A*C
+
+        if tmproot < 0:
+            #complex roots, take the real part
+            tmpsol1 = - B/(2*A)
+            tmpsol2 = tmpsol1
+            pz = tmpsol1
         else:
-            feature = getattr(content, f)
-        dnn_jets_cudakernel(feature, offsets, feats.index(f), nobj, mask_rows, mask_content, out)
+            tmpsol1 = (-B + math.sqrt(tmproot))/(2.0*A)
+            tmpsol2 = (-B - math.sqrt(tmproot))/(2.0*A)
+            if abs(tmpsol2-pzlep) < abs(tmpsol1-pzlep):
+                pz = tmpsol2
+            else:
+                pz = tmpsol1
+                #### if pznu is > 300 pick the most central root
+                if pz > 300.:
+                    if abs(tmpsol1) < abs(tmpsol2):
+                        pz = tmpsol1
+                    else:
+                        pz = tmpsol2
+        pznu[i] = pz
+        if len(root1) > 0:
+            root1[i] = tmpsol1
+            root2[i] = tmpsol2
+        if len(nu_px) > 0:
+            nu_px[i] = pxnu
+            nu_py[i] = pynu
+            nu_pz[i] = pz
+            nu_e[i] = math.sqrt(pxnu*pxnu + pynu*pynu + pz*pz)
+
+def neutrino_pz(lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, mask_rows, out_roots=None, out_p4=None, M_W=80.4):
+    empty = cupy.zeros(0, dtype=cupy.float32)
+    pznu = cupy.zeros(len(lep_pt), dtype=cupy.float32)
+    roots = out_roots if not (out_roots is None) else (empty, empty)
+    p4 = out_p4 if not (out_p4 is None) else (empty, empty, empty, empty)
+    assert(len(roots) == 2 and len(p4) == 4)
+    neutrino_pz_cudakernel[32, 1024](lep_pt, lep_eta, lep_phi, lep_mass, met_pt, met_phi, mask_rows, M_W, pznu, *roots, *p4)
+    cuda.synchronize()
+    return pznu
+
+@cuda.jit
+def calc_dr_cudakernel(phi1, eta1, phi2, eta2, mask, out):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for iobj in range(xi, phi1.shape[0], xstride):
+        if not mask[iobj]:
+            continue
+        deta = abs(eta1[iobj] - eta2[iobj])
+        dphi = (phi1[iobj] - phi2[iobj] + math.pi) % (2*math.pi) - math.pi
+        out[iobj] = math.sqrt(deta**2 + dphi**2)
+
+def calc_dr(objs1_phi, objs1_eta, objs2_phi, objs2_eta, mask):
+    assert(objs1_phi.shape == objs1_eta.shape)
+    assert(objs2_phi.shape == objs2_eta.shape)
+    assert(objs1_phi.shape == objs2_phi.shape)
+    assert(objs1_phi.shape == mask.shape)
+
+    out = cupy.zeros_like(objs1_phi)
+    calc_dr_cudakernel[32, 1024](objs1_phi, objs1_eta, objs2_phi, objs2_eta, mask, out)
     cuda.synchronize()
     return out
 
-def make_leps_inputs(electrons, muons, numEvents, feats, mask_rows, el_mask_content, mu_mask_content):
+#kernels of best_combination, compiled once for every score function and combination size
+_best_combination_kernels = {}
 
-    inds = cupy.zeros(numEvents, dtype=cupy.int32)
+def make_best_combination_kernel(score, ncomb):
+    assert(ncomb in [2, 3])
+    key = (score, ncomb)
+    if key in _best_combination_kernels:
+        return _best_combination_kernels[key]
+    score_devfunc = cuda.jit(device=True)(score)
 
-    feature = {}
-    feature["pt"] = get_in_offsets(muons.pt, muons.offsets, inds, mask_rows, mu_mask_content) + get_in_offsets(electrons.pt, electrons.offsets, inds, mask_rows, el_mask_content)
-    feature["eta"] = get_in_offsets(muons.eta, muons.offsets, inds, mask_rows, mu_mask_content) + get_in_offsets(electrons.eta, electrons.offsets, inds, mask_rows, el_mask_content)
-    feature["phi"] = get_in_offsets(muons.phi, muons.offsets, inds, mask_rows, mu_mask_content) + get_in_offsets(electrons.phi, electrons.offsets, inds, mask_rows, el_mask_content)
-    feature["mass"] = get_in_offsets(muons.mass, muons.offsets, inds, mask_rows, mu_mask_content) + get_in_offsets(electrons.mass, electrons.offsets, inds, mask_rows, el_mask_content)
+    @cuda.jit
+    def best_combination_cudakernel(px, py, pz, e, offsets, mask_content, mask_rows, ref, max_score, best_idx, out_px, out_py, out_pz, out_e):
+        xi = cuda.grid(1)
+        xstride = cuda.gridsize(1)
 
-    out = cupy.zeros((numEvents, 1, len(feats)), dtype=cupy.float32)
-    for f in feats:
-        if f == "px":
-            feature["px"] = calc_px(feature["pt"], feature["phi"])
-        elif f == "py":
-            feature["py"] = calc_py(feature["pt"], feature["phi"])
-        elif f == "pz":
-            feature["pz"] = calc_pz(feature["pt"], feature["eta"])
-        elif f == "en":
-            feature["en"] = calc_en(feature["pt"], feature["eta"], feature["mass"])
-        dnn_leps_cudakernel(feature[f], feats.index(f), mask_rows, out)
+        for iev in range(xi, offsets.shape[0]-1, xstride):
+            if not mask_rows[iev]:
+                continue
+            start = offsets[iev]
+            end = offsets[iev + 1]
+            best = max_score
+            for i0 in range(start, end):
+                if not mask_content[i0]:
+                    continue
+                for i1 in range(i0 + 1, end):
+                    if not mask_content[i1]:
+                        continue
+                    if ncomb == 2:
+                        s = score_devfunc(px[i0] + px[i1], py[i0] + py[i1], pz[i0] + pz[i1], e[i0] + e[i1], ref[iev])
+                        if s < best:
+                            best = s
+                            best_idx[iev, 0] = i0
+                            best_idx[iev, 1] = i1
+                    else:
+                        for i2 in range(i1 + 1, end):
+                            if not mask_content[i2]:
+                                continue
+                            s = score_devfunc(px[i0] + px[i1] + px[i2], py[i0] + py[i1] + py[i2], pz[i0] + pz[i1] + pz[i2], e[i0] + e[i1] + e[i2], ref[iev])
+                            if s < best:
+                                best = s
+                                best_idx[iev, 0] = i0
+                                best_idx[iev, 1] = i1
+                                best_idx[iev, 2] = i2
+            if best_idx[iev, 0] >= 0:
+                for k in range(ncomb):
+                    out_px[iev] += px[best_idx[iev, k]]
+                    out_py[iev] += py[best_idx[iev, k]]
+                    out_pz[iev] += pz[best_idx[iev, k]]
+                    out_e[iev] += e[best_idx[iev, k]]
+
+    _best_combination_kernels[key] = best_combination_cudakernel
+    return best_combination_cudakernel
+
+def best_combination(objs, mask_content, mask_rows, ref, score, ncomb=2, max_score=np.inf):
+    assert(mask_content.shape == objs.pt.shape)
+    assert(mask_rows.shape[0] == objs.offsets.shape[0] - 1)
+    nev = objs.offsets.shape[0] - 1
+
+    px, py, pz, e = objs.cartesian(dtype=cupy.float64)
+
+    best_idx = -cupy.ones((nev, ncomb), dtype=cupy.int64)
+    out = [cupy.zeros(nev, dtype=cupy.float64) for i in range(4)]
+    kernel = make_best_combination_kernel(score, ncomb)
+    kernel[32, 1024](px, py, pz, e, objs.offsets, mask_content, mask_rows, cupy.asarray(ref, dtype=cupy.float64), max_score, best_idx, *out)
     cuda.synchronize()
-    return out
+    return best_idx, cartesian_to_ptetaphim(*out)
 
-def make_met_inputs(content, numEvents, feats, mask_rows):
+@cuda.jit
+def p4_to_ptetaphim_cudakernel(x, y, z, t, pt, eta, phi, mass):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
 
-    out = cupy.zeros((numEvents, len(feats)), dtype=cupy.float32)
-    for f in feats:
-        if f == "px":
-            feature = calc_px(content["MET_pt"], content["MET_phi"])
-        elif f == "py":
-            feature = calc_py(content["MET_pt"], content["MET_phi"])
+    for i in range(xi, x.shape[0], xstride):
+        pt2 = x[i]**2 + y[i]**2
+        pt[i] = math.sqrt(pt2)
+        if pt2 > 0:
+            eta[i] = math.asinh(z[i] / pt[i])
         else:
-            feature = content["MET_" + f]
-        dnn_met_cudakernel(feature, feats.index(f), mask_rows, out)
+            eta[i] = 0
+        phi[i] = math.atan2(y[i], x[i])
+        mass[i] = math.sqrt(max(t[i]**2 - pt2 - z[i]**2, 0))
+
+@cuda.jit
+def p4_add_cudakernel(x1, y1, z1, t1, parents1, x2, y2, z2, t2, parents2, x, y, z, t):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for i in range(xi, x.shape[0], xstride):
+        i1 = i
+        if parents1.shape[0] > 0:
+            i1 = parents1[i]
+        i2 = i
+        if parents2.shape[0] > 0:
+            i2 = parents2[i]
+        x[i] = x1[i1] + x2[i2]
+        y[i] = y1[i1] + y2[i2]
+        z[i] = z1[i1] + z2[i2]
+        t[i] = t1[i1] + t2[i2]
+
+@cuda.jit
+def p4_boost_cudakernel(x1, y1, z1, t1, bx, by, bz, parents, x, y, z, t):
+    xi = cuda.grid(1)
+    xstride = cuda.gridsize(1)
+
+    for i in range(xi, x.shape[0], xstride):
+        ib = i
+        if parents.shape[0] > 0:
+            ib = parents[i]
+        b2 = bx[ib]**2 + by[ib]**2 + bz[ib]**2
+        if b2 >= 1:
+            x[i] = math.nan
+            y[i] = math.nan
+            z[i] = math.nan
+            t[i] = math.nan
+            continue
+        gamma = 1.0 / math.sqrt(1.0 - b2)
+        bp = bx[ib]*x1[i] + by[ib]*y1[i] + bz[ib]*z1[i]
+        gamma2 = 0.0
+        if b2 > 0:
+            gamma2 = (gamma - 1.0) / b2
+        x[i] = x1[i] + gamma2*bp*bx[ib] + gamma*bx[ib]*t1[i]
+        y[i] = y1[i] + gamma2*bp*by[ib] + gamma*by[ib]*t1[i]
+        z[i] = z1[i] + gamma2*bp*bz[ib] + gamma*bz[ib]*t1[i]
+        t[i] = gamma*(t1[i] + bp)
+
+def cartesian_to_ptetaphim(px, py, pz, e):
+    out = [cupy.zeros(len(px), dtype=cupy.float32) for i in range(4)]
+    p4_to_ptetaphim_cudakernel[32, 1024](px, py, pz, e, *out)
+    cuda.synchronize()
+    return dict(zip(["pt", "eta", "phi", "mass"], out))
+
+def p4_add(p1, parents1, p2, parents2, num_items):
+    out = [cupy.zeros(num_items, dtype=cupy.float32) for i in range(4)]
+    p4_add_cudakernel[32, 1024](*p1, parents1, *p2, parents2, *out)
     cuda.synchronize()
     return out
 
+def p4_boost(p, bx, by, bz, parents):
+    out = [cupy.zeros(len(p[0]), dtype=cupy.float32) for i in range(4)]
+    p4_boost_cudakernel[32, 1024](*p, bx, by, bz, parents, *out)
+    cuda.synchronize()
+    return out
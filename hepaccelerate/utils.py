@@ -2,8 +2,14 @@ import sys
 import os
 import time
 import json
+import fcntl
+import shutil
+import threading
+import traceback
+import subprocess
 import numpy as np
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 import uproot
 
@@ -28,10 +34,55 @@ class Histogram:
         self.contents_w2 = np.array(contents_w2)
         self.edges = np.array(edges)
     
+    def same_edges(self, other):
+        #histograms filled with the same binning usually share the edges array
+        return self.edges is other.edges or np.array_equal(self.edges, other.edges)
+
+    def copy(self):
+        #the edges are not modified in place, so they can be shared
+        h = self.__class__.__new__(self.__class__)
+        h.__dict__.update(self.__dict__)
+        h.contents = self.contents.copy()
+        h.contents_w2 = self.contents_w2.copy()
+        return h
+
     def __add__(self, other):
-        assert(np.all(self.edges == other.edges))
+        assert(self.same_edges(other))
         return Histogram(self.contents +  other.contents, self.contents_w2 +  other.contents_w2, self.edges)
 
+    def __iadd__(self, other):
+        assert(self.same_edges(other))
+        self.contents = _add_inplace(self.contents, other.contents)
+        self.contents_w2 = _add_inplace(self.contents_w2, other.contents_w2)
+        return self
+
+def _add_inplace(arr, other):
+    #integer contents (e.g. filled with counts) are promoted when adding floats
+    if np.result_type(arr, other) == arr.dtype:
+        arr += other
+        return arr
+    return arr + other
+
+class HistogramND(Histogram):
+    """
+    Histogram with several axes, contents and contents_w2 have one dimension per axis
+    and edges is the list of the bin edges of every axis.
+    """
+    def __init__(self, contents, contents_w2, edges):
+        self.contents = np.array(contents)
+        self.contents_w2 = np.array(contents_w2)
+        self.edges = [np.array(e) for e in edges]
+        assert(self.contents.shape == tuple(len(e) - 1 for e in self.edges))
+
+    def same_edges(self, other):
+        if self.edges is other.edges:
+            return True
+        return len(self.edges) == len(other.edges) and all(e0 is e1 or np.array_equal(e0, e1) for e0, e1 in zip(self.edges, other.edges))
+
+    def __add__(self, other):
+        assert(self.same_edges(other))
+        return HistogramND(self.contents +  other.contents, self.contents_w2 +  other.contents_w2, self.edges)
+
 class JaggedStruct(object):
     def __init__(self, offsets, attrs_data, numpy_lib):
         self.numpy_lib = numpy_lib
@@ -50,9 +101,25 @@ class JaggedStruct(object):
     
         self.masks = {}
         self.masks["all"] = self.make_mask()
+        self._cartesian = {}
     
     def make_mask(self):
         return self.numpy_lib.ones(self.num_items, dtype=self.numpy_lib.bool)
+
+    def cartesian(self, dtype=None):
+        """
+        px, py, pz and energy of the objects, computed from pt, eta, phi and mass in one kernel.
+        They are cached per dtype until one of these attributes is replaced (e.g. by a systematic variation).
+        """
+        if dtype is None:
+            dtype = self.numpy_lib.float32
+        src = (self.pt, self.eta, self.phi, self.mass)
+        key = np.dtype(dtype).str
+        cached = self._cartesian.get(key, None)
+        if cached is None or any(a is not b for a, b in zip(cached[0], src)):
+            out = get_backend(self.numpy_lib).calc_cartesian(*src, dtype=dtype)
+            self._cartesian[key] = (src, out)
+        return self._cartesian[key][1]
     
     def mask(self, name):
         if not name in self.masks.keys():
@@ -65,6 +132,9 @@ class JaggedStruct(object):
             size_tot += v.size
         return size_tot
     
+    def nbytes(self):
+        return self.offsets.nbytes + sum(v.nbytes for v in self.attrs_data.values())
+
     def numevents(self):
         return len(self.offsets) - 1
 
@@ -83,9 +153,49 @@ class JaggedStruct(object):
             numpy_lib=numpy_lib
         )
 
+    def select_events(self, start, stop):
+        """View of the objects in the events [start, stop), the attributes are not copied"""
+        first = int(self.offsets[start])
+        last = int(self.offsets[stop])
+        return JaggedStruct(
+            self.offsets[start:stop+1] - first,
+            {k: v[first:last] for k, v in self.attrs_data.items()},
+            numpy_lib=self.numpy_lib
+        )
+
     def savez(self, path):
         with open(path, "wb") as of:
             self.numpy_lib.savez(of, offsets=self.offsets, **self.attrs_data)
+
+    def save_columns(self, path, prefix, skip=[]):
+        """
+        Write the offsets and every attribute as a separate raw .npy file
+        named <prefix>.<column>.npy in the directory path.
+        The attributes in skip and the offsets, if they are already in path, are not written again.
+        Returns the list of attribute names that were written.
+        """
+        fn = os.path.join(path, "{0}.offsets.npy".format(prefix))
+        if not os.path.isfile(fn):
+            save_column(fn, self.offsets)
+        written = []
+        for k, v in self.attrs_data.items():
+            if k in skip:
+                continue
+            save_column(os.path.join(path, "{0}.{1}.npy".format(prefix, k)), v)
+            written += [k]
+        return written
+
+    @staticmethod
+    def load_columns(path, prefix, attrs, numpy_lib):
+        """
+        Open the columns written by save_columns. On the CPU the columns are memory-mapped,
+        such that only the columns that are actually accessed are read from disk.
+        """
+        return JaggedStruct(
+            load_column(os.path.join(path, "{0}.offsets.npy".format(prefix)), numpy_lib),
+            {k: load_column(os.path.join(path, "{0}.{1}.npy".format(prefix, k)), numpy_lib) for k in attrs},
+            numpy_lib=numpy_lib
+        )
     
     @staticmethod 
     def load(path, numpy_lib):
@@ -110,12 +220,138 @@ class JaggedStruct(object):
         new_attrs_data = {k: self.numpy_lib.array(v) for k, v in self.attrs_data.items()}
         self.offsets = new_offsets
         self.attrs_data = new_attrs_data
+        self._cartesian = {}
  
     def __getattr__(self, attr):
         if attr in self.attrs_data.keys():
             return self.attrs_data[attr]
         return self.__getattribute__(attr)
  
+def get_backend(numpy_lib):
+    if numpy_lib is np:
+        import hepaccelerate.backend_cpu as ha
+    else:
+        import hepaccelerate.backend_cuda as ha
+    return ha
+
+class LorentzVectorArray(object):
+    """
+    Four-vectors as float32 x, y, z, t arrays (struct of arrays) on the device of numpy_lib, either one per object
+    of a jagged collection (with offsets) or one per event (flat, without offsets).
+    pt, eta, phi and mass are computed together in one kernel when first accessed.
+    Adding a flat array to a jagged one adds the vector of every event to all its objects.
+    """
+    def __init__(self, x, y, z, t, numpy_lib, offsets=None):
+        self.numpy_lib = numpy_lib
+        self.x, self.y, self.z, self.t = [numpy_lib.ascontiguousarray(v, dtype=numpy_lib.float32) for v in (x, y, z, t)]
+        self.offsets = offsets
+        self._ptetaphim = None
+        self._parents = None
+
+    @staticmethod
+    def from_cartesian(x, y, z, t, numpy_lib, offsets=None):
+        return LorentzVectorArray(x, y, z, t, numpy_lib, offsets)
+
+    @staticmethod
+    def from_ptetaphim(pt, eta, phi, mass, numpy_lib, offsets=None):
+        ha = get_backend(numpy_lib)
+        ret = LorentzVectorArray(*ha.calc_cartesian(pt, eta, phi, mass), numpy_lib, offsets)
+        ret._ptetaphim = {k: numpy_lib.asarray(v, dtype=numpy_lib.float32) for k, v in zip(["pt", "eta", "phi", "mass"], (pt, eta, phi, mass))}
+        return ret
+
+    def __len__(self):
+        return len(self.x)
+
+    def is_jagged(self):
+        return not (self.offsets is None)
+
+    def components(self):
+        return (self.x, self.y, self.z, self.t)
+
+    #index of the event of every object
+    def parents(self):
+        if self._parents is None:
+            self._parents = get_backend(self.numpy_lib).get_parents(self.offsets, len(self))
+        return self._parents
+
+    def ptetaphim(self):
+        if self._ptetaphim is None:
+            self._ptetaphim = get_backend(self.numpy_lib).cartesian_to_ptetaphim(*self.components())
+        return self._ptetaphim
+
+    @property
+    def E(self):
+        return self.t
+
+    @property
+    def pt(self):
+        return self.ptetaphim()["pt"]
+
+    @property
+    def eta(self):
+        return self.ptetaphim()["eta"]
+
+    @property
+    def phi(self):
+        return self.ptetaphim()["phi"]
+
+    @property
+    def mass(self):
+        return self.ptetaphim()["mass"]
+
+    #the parents map the objects of a jagged operand to the vectors of a flat one, they are empty for the same layout
+    def __add__(self, other):
+        empty = self.numpy_lib.zeros(0, dtype=self.numpy_lib.int64)
+        if self.is_jagged() == other.is_jagged():
+            assert(len(self) == len(other))
+            parents1, parents2, layout = empty, empty, self
+        elif self.is_jagged():
+            assert(len(other) == len(self.offsets) - 1)
+            parents1, parents2, layout = empty, self.parents(), self
+        else:
+            assert(len(self) == len(other.offsets) - 1)
+            parents1, parents2, layout = other.parents(), empty, other
+        ha = get_backend(self.numpy_lib)
+        out = ha.p4_add(self.components(), parents1, other.components(), parents2, len(layout))
+        ret = LorentzVectorArray(*out, self.numpy_lib, layout.offsets)
+        ret._parents = layout._parents
+        return ret
+
+    def boost(self, bx, by, bz):
+        """
+        Boosts by the velocity (bx, by, bz), with one value per vector or, for a jagged array, per event.
+        """
+        parents = self.numpy_lib.zeros(0, dtype=self.numpy_lib.int64)
+        if self.is_jagged() and len(bx) != len(self):
+            assert(len(bx) == len(self.offsets) - 1)
+            parents = self.parents()
+        ha = get_backend(self.numpy_lib)
+        ret = LorentzVectorArray(*ha.p4_boost(self.components(), bx, by, bz, parents), self.numpy_lib, self.offsets)
+        ret._parents = self._parents
+        return ret
+
+    #boosts to the rest frame of other, e.g. of a flat array of candidates for every object of the event,
+    #the velocity is computed in double precision as it is close to 1 for light objects
+    def boost_to_rest_frame(self, other):
+        t = other.t.astype(self.numpy_lib.float64)
+        return self.boost(-other.x/t, -other.y/t, -other.z/t)
+
+def save_column(path, arr):
+    #cupy arrays have to be transferred to the host before writing
+    if hasattr(arr, "get"):
+        arr = arr.get()
+    #the columns are memory-mapped by load_column, write to a temporary file first such that readers never see a partial file
+    with open(path + ".tmp", "wb") as fi:
+        np.save(fi, np.ascontiguousarray(arr))
+    os.replace(path + ".tmp", path)
+
+def load_column(path, numpy_lib):
+    #copy-on-write mapping: the analysis may modify arrays in place without touching the cache
+    arr = np.load(path, mmap_mode="c")
+    if numpy_lib is np:
+        return arr
+    return numpy_lib.array(arr)
+
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.ndarray):
@@ -147,16 +383,761 @@ class Results(dict):
             d_ret[k] = d1[k]
 
         return d_ret
+
+    def __iadd__(self, other):
+        """
+        Add other in place, the histograms of this Results are modified without new allocations.
+        The entries missing here are copied, such that other can still be used afterwards.
+        """
+        if isinstance(other, Accumulator):
+            other = other.to_results()
+        for k, v in other.items():
+            if k in self:
+                self[k] += v
+            else:
+                self[k] = _copy_value(v)
+        return self
     
     def save_json(self, outfn):
         with open(outfn, "w") as fi:
             fi.write(json.dumps(dict(self), indent=2, cls=NumpyEncoder))
 
+    def save_hbin(self, outfn):
+        save_hbin(self, outfn)
+
+def _copy_value(v):
+    if isinstance(v, Results):
+        ret = Results({})
+        ret += v
+        return ret
+    if isinstance(v, Histogram):
+        return v.copy()
+    return v
+
+class Accumulator(object):
+    """
+    Sum of Results with preallocated storage: the contents and squared weights of all the histograms
+    are kept in one contiguous float64 buffer, indexed by the key of every histogram (the tuple of the
+    keys of the nested Results). Adding Results or another Accumulator is done in place, and an
+    Accumulator is pickled as one buffer, which makes it cheap to send between processes.
+    The distinct bin edges are stored once, the histograms refer to them by index.
+    """
+    def __init__(self, results=None):
+        self.index = OrderedDict()
+        self.edges = []
+        self.buffer = np.zeros(0, dtype=np.float64)
+        self.size = 0
+        if not results is None:
+            self += results
+
+    def __len__(self):
+        return len(self.index)
+
+    def _edges_id(self, h):
+        for iedges, edges in enumerate(self.edges):
+            if edges[0] is h.__class__ and h.same_edges(edges[1]):
+                return iedges
+        #only the binning of the histogram is kept
+        template = h.__class__.__new__(h.__class__)
+        template.__dict__.update(h.__dict__)
+        template.contents = None
+        template.contents_w2 = None
+        self.edges += [(h.__class__, template)]
+        return len(self.edges) - 1
+
+    def _allocate(self, key, h):
+        n, n2 = h.contents.size, h.contents_w2.size
+        if self.size + n + n2 > len(self.buffer):
+            buffer = np.zeros(max(2*len(self.buffer), self.size + n + n2), dtype=np.float64)
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+        #edges of the first histogram with the same binning, (offset, shape of the contents, shape of the squared weights)
+        entry = (self._edges_id(h), self.size, h.contents.shape, h.contents_w2.shape)
+        self.index[key] = entry
+        self.size += n + n2
+        return entry
+
+    def add_histogram(self, key, h):
+        entry = self.index.get(key, None)
+        if entry is None:
+            entry = self._allocate(key, h)
+        else:
+            #the edges of the histograms from the same analysis are usually the same object
+            cls, h0 = self.edges[entry[0]]
+            assert(cls is h.__class__ and h0.same_edges(h))
+        iedges, offset, shape, shape_w2 = entry
+        n = h.contents.size
+        self.buffer[offset:offset+n] += h.contents.ravel()
+        self.buffer[offset+n:offset+n+h.contents_w2.size] += h.contents_w2.ravel()
+
+    def add_results(self, results, prefix=()):
+        for k, v in results.items():
+            if isinstance(v, dict):
+                self.add_results(v, prefix + (k, ))
+            elif isinstance(v, Histogram):
+                self.add_histogram(prefix + (k, ), v)
+            else:
+                raise TypeError("Accumulator: unsupported result {0} of type {1}".format(prefix + (k, ), type(v)))
+
+    def merge(self, other):
+        """Add another Accumulator, in one vectorized addition if both have the same layout"""
+        same_edges = len(self.edges) == len(other.edges) and all(
+            e0[0] is e1[0] and e0[1].same_edges(e1[1]) for e0, e1 in zip(self.edges, other.edges))
+        if same_edges and self.size == other.size and list(self.index.items()) == list(other.index.items()):
+            self.buffer[:self.size] += other.buffer[:other.size]
+        else:
+            for key, h in other.histograms():
+                self.add_histogram(key, h)
+
+    def __iadd__(self, other):
+        if isinstance(other, Accumulator):
+            self.merge(other)
+        else:
+            self.add_results(other)
+        return self
+
+    def histograms(self):
+        """Iterate over the (key, histogram) pairs, the contents are views of the buffer"""
+        for key, (iedges, offset, shape, shape_w2) in self.index.items():
+            cls, h0 = self.edges[iedges]
+            n = int(np.prod(shape))
+            h = cls.__new__(cls)
+            h.__dict__.update(h0.__dict__)
+            h.contents = self.buffer[offset:offset+n].reshape(shape)
+            h.contents_w2 = self.buffer[offset+n:offset+n+int(np.prod(shape_w2))].reshape(shape_w2)
+            yield key, h
+
+    def to_results(self):
+        """Nested Results with copies of the histograms"""
+        ret = Results({})
+        for key, h in self.histograms():
+            d = ret
+            for k in key[:-1]:
+                if not k in d:
+                    d[k] = Results({})
+                d = d[k]
+            d[key[-1]] = h.copy()
+        return ret
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["buffer"] = self.buffer[:self.size]
+        return state
+
+#Binary result files (.hbin): the magic string, the length of the JSON index as a little-endian uint64,
+#the index and, aligned to HBIN_ALIGN bytes, the float64 contents, squared weights and edges of all the histograms.
+#The index maps the name of every histogram (the keys of nested Results joined by "/") to its class
+#and to the offset and shape of each of its arrays in the data.
+HBIN_MAGIC = b"HEPHBIN1"
+HBIN_ALIGN = 64
+
+def _flatten_results(results, prefix=""):
+    for k, v in results.items():
+        if isinstance(v, dict):
+            yield from _flatten_results(v, prefix + k + "/")
+        elif isinstance(v, Histogram):
+            yield prefix + k, v
+        else:
+            raise TypeError("save_hbin: unsupported result {0} of type {1}".format(prefix + k, type(v)))
+
+def save_hbin(results, outfn):
+    """Write the histograms of (nested) Results to a binary result file"""
+    index = OrderedDict()
+    arrays = []
+    offset = 0
+    for name, h in _flatten_results(results):
+        edges = h.edges if isinstance(h, HistogramND) else [h.edges]
+        entry = {"class": h.__class__.__name__}
+        for an, arr in [("contents", h.contents), ("contents_w2", h.contents_w2)] + [("edges", e) for e in edges]:
+            arr = np.asarray(arr, dtype=np.float64)
+            item = [offset, list(arr.shape)]
+            if an == "edges":
+                entry.setdefault("edges", []).append(item)
+            else:
+                entry[an] = item
+            arrays += [arr]
+            offset += arr.size
+        index[name] = entry
+
+    header = json.dumps({"version": 1, "histograms": index}).encode("utf-8")
+    data_offset = len(HBIN_MAGIC) + 8 + len(header)
+    padding = (HBIN_ALIGN - data_offset % HBIN_ALIGN) % HBIN_ALIGN
+    tmpfn = outfn + ".tmp"
+    with open(tmpfn, "wb") as fi:
+        fi.write(HBIN_MAGIC)
+        fi.write(np.array([len(header)], dtype="<u8").tobytes())
+        fi.write(header)
+        fi.write(b"\0" * padding)
+        for arr in arrays:
+            fi.write(arr.astype("<f8", copy=False).tobytes())
+    os.replace(tmpfn, outfn)
+
+class HBinFile(object):
+    """
+    Reader of a binary result file, the data are memory-mapped and a histogram is loaded by name
+    without reading the others. The arrays of the returned histograms are read-only views of the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fi:
+            magic = fi.read(len(HBIN_MAGIC))
+            if magic != HBIN_MAGIC:
+                raise ValueError("{0} is not a binary result file".format(path))
+            header_size = int(np.frombuffer(fi.read(8), dtype="<u8")[0])
+            header = json.loads(fi.read(header_size).decode("utf-8"))
+        self.index = header["histograms"]
+        data_offset = len(HBIN_MAGIC) + 8 + header_size
+        data_offset += (HBIN_ALIGN - data_offset % HBIN_ALIGN) % HBIN_ALIGN
+        if os.path.getsize(path) > data_offset:
+            self.data = np.memmap(path, dtype="<f8", mode="r", offset=data_offset)
+        else:
+            self.data = np.zeros(0, dtype="<f8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data = None
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _array(self, item):
+        offset, shape = item
+        return self.data[offset:offset+int(np.prod(shape))].reshape(shape)
+
+    def __getitem__(self, name):
+        entry = self.index[name]
+        edges = [self._array(e) for e in entry["edges"]]
+        cls = HistogramND if entry["class"] == "HistogramND" else Histogram
+        h = cls.__new__(cls)
+        h.contents = self._array(entry["contents"])
+        h.contents_w2 = self._array(entry["contents_w2"])
+        h.edges = edges if cls is HistogramND else edges[0]
+        return h
+
+    def get_dict(self, name):
+        """Histogram as a dict of copied arrays, as in the JSON output"""
+        h = self[name]
+        edges = [np.array(e) for e in h.edges] if isinstance(h, HistogramND) else np.array(h.edges)
+        return {"contents": np.array(h.contents), "contents_w2": np.array(h.contents_w2), "edges": edges}
+
+    def to_results(self):
+        """Load all the histograms in (nested) Results"""
+        ret = Results({})
+        for name in self.keys():
+            d = ret
+            keys = name.split("/")
+            for k in keys[:-1]:
+                if not k in d:
+                    d[k] = Results({})
+                d = d[k]
+            d[keys[-1]] = self[name].copy()
+        return ret
+
+def load_histogram(path, name):
+    """Load one histogram from a JSON or binary result file, as a dict with the contents, contents_w2 and edges"""
+    if path.endswith(".hbin"):
+        with HBinFile(path) as fi:
+            return fi.get_dict(name)
+    with open(path) as fi:
+        return json.load(fi)[name]
+
+def _results_from_json(d):
+    ret = Results({})
+    for k, v in d.items():
+        if isinstance(v, dict) and set(v.keys()) == set(["contents", "contents_w2", "edges"]):
+            #N-dimensional histograms have one list of edges per axis
+            if isinstance(v["edges"], list) and len(v["edges"]) > 0 and isinstance(v["edges"][0], list):
+                ret[k] = HistogramND(v["contents"], v["contents_w2"], v["edges"])
+            else:
+                ret[k] = Histogram(v["contents"], v["contents_w2"], v["edges"])
+        elif isinstance(v, dict):
+            ret[k] = _results_from_json(v)
+        else:
+            raise TypeError("unsupported entry {0} in the JSON results".format(k))
+    return ret
+
+def load_results(path):
+    """Load a JSON or binary result file in Results"""
+    if path.endswith(".hbin"):
+        with HBinFile(path) as fi:
+            return fi.to_results()
+    with open(path) as fi:
+        return _results_from_json(json.load(fi))
+
+def json_to_hbin(jsonfn, hbinfn=None):
+    """Convert a JSON result file to the binary format, by default next to it with the .hbin extension"""
+    if hbinfn is None:
+        hbinfn = os.path.splitext(jsonfn)[0] + ".hbin"
+    save_hbin(load_results(jsonfn), hbinfn)
+    return hbinfn
+
+def tree_reduce(items):
+    """
+    Sum the items pairwise in a binary tree as they arrive, such that at most log2(n)
+    partial sums are held in memory and every item takes part in log2(n) additions.
+    The items are added in place into the earlier ones, so they should not be used afterwards.
+    """
+    stack = []
+    for item in items:
+        level = 0
+        while len(stack) > 0 and stack[-1][0] == level:
+            left = stack.pop()[1]
+            left += item
+            item = left
+            level += 1
+        stack.append((level, item))
+    ret = None
+    while len(stack) > 0:
+        item = stack.pop()[1]
+        if not ret is None:
+            item += ret
+        ret = item
+    if ret is None:
+        ret = Results({})
+    return ret
+
+CACHE_VERSION = 1
+
+def empty_manifest(source=None):
+    return {"version": CACHE_VERSION, "source": source, "last_access": time.time(), "branches": [], "structs": {}, "eventvars": []}
+
+def root_file_uuid(fi):
+    """UUID stored in the header of an open ROOT file, as a hex string"""
+    #uproot3 keeps it in the file context, uproot4 on the file object
+    uuid = getattr(getattr(fi, "_context", None), "uuid", None)
+    if uuid is None:
+        uuid = getattr(getattr(fi, "file", None), "uuid", None)
+    if uuid is None:
+        return None
+    if isinstance(uuid, bytes):
+        return uuid.hex()
+    return str(uuid)
+
+def source_fingerprint(fn, fi=None):
+    """Identify the version of a source ROOT file by its size, modification time and UUID"""
+    ret = {"path": fn, "size": None, "mtime": None, "uuid": None}
+    if os.path.isfile(fn):
+        st = os.stat(fn)
+        ret["size"] = st.st_size
+        ret["mtime"] = st.st_mtime
+    if fi is None:
+        fi = uproot.open(fn)
+    ret["uuid"] = root_file_uuid(fi)
+    return ret
+
+def read_manifest(path):
+    with open(os.path.join(path, "manifest.json"), "r") as fi:
+        manifest = json.load(fi)
+    if manifest.get("version") != CACHE_VERSION:
+        raise IOError("Cache in {0} has version {1}, expected {2}".format(path, manifest.get("version"), CACHE_VERSION))
+    return manifest
+
+def write_manifest(path, manifest):
+    #write to a temporary file first such that a crashed job never leaves a truncated manifest
+    fn = os.path.join(path, "manifest.json")
+    with open(fn + ".tmp", "w") as fi:
+        json.dump(manifest, fi, indent=2)
+    os.replace(fn + ".tmp", fn)
+
+@contextmanager
+def cache_lock(path, shared=False, blocking=True):
+    """
+    Lock on a cache entry, exclusive for the jobs writing or removing the entry and shared for those reading it,
+    such that concurrent jobs do not write the same entry or remove it while it is used.
+    Yields whether the lock was acquired, which is always the case when blocking.
+    """
+    flags = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB)
+    fn = os.path.join(path, ".lock")
+    while True:
+        os.makedirs(path, exist_ok=True)
+        fi = open(fn, "a")
+        try:
+            fcntl.flock(fi, flags)
+        except BlockingIOError:
+            fi.close()
+            yield False
+            return
+        #the entry may have been removed while waiting, the lock is then held on a deleted file
+        try:
+            same = os.path.samestat(os.fstat(fi.fileno()), os.stat(fn))
+        except FileNotFoundError:
+            same = False
+        if same:
+            break
+        fi.close()
+        if not blocking:
+            yield False
+            return
+    try:
+        yield True
+    finally:
+        fcntl.flock(fi, fcntl.LOCK_UN)
+        fi.close()
+
+class CacheManager(object):
+    """
+    Keeps track of the entries under a cache location: detects entries that are stale with respect to
+    their source ROOT file and keeps the total size below a quota by evicting the least recently used entries.
+    """
+    def __init__(self, location, quota=None, check_remote=False):
+        self.location = location
+        #maximum size in bytes, None for unlimited
+        self.quota = quota
+        #remote files can only be validated through their UUID, which requires opening them
+        self.check_remote = check_remote
+
+    def entries(self):
+        """Yield (path, manifest) for every complete entry in the cache"""
+        for dirpath, dirnames, filenames in os.walk(self.location):
+            if not "manifest.json" in filenames:
+                continue
+            try:
+                yield dirpath, read_manifest(dirpath)
+            except (IOError, ValueError):
+                yield dirpath, None
+
+    @staticmethod
+    def entry_size(path):
+        return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+
+    def is_stale(self, manifest):
+        if manifest is None or manifest.get("source") is None:
+            return True
+        source = manifest["source"]
+        fn = source["path"]
+        if os.path.isfile(fn):
+            st = os.stat(fn)
+            return st.st_size != source["size"] or st.st_mtime != source["mtime"]
+        if self.check_remote and not source["uuid"] is None:
+            return root_file_uuid(uproot.open(fn)) != source["uuid"]
+        return False
+
+    def touch(self, path):
+        """Mark the entry as used now"""
+        with cache_lock(path):
+            #the entry may have been removed in the meantime
+            if not os.path.isfile(os.path.join(path, "manifest.json")):
+                return
+            manifest = read_manifest(path)
+            manifest["last_access"] = time.time()
+            write_manifest(path, manifest)
+
+    @staticmethod
+    def remove(path):
+        """Removes the entry unless another job holds its lock, returns whether it was removed"""
+        with cache_lock(path, blocking=False) as locked:
+            if locked:
+                shutil.rmtree(path, ignore_errors=True)
+        return locked
+
+    @staticmethod
+    def clear(path):
+        """Removes the content of an entry but keeps its lock file, to be called while holding the lock"""
+        for name in os.listdir(path):
+            if name == ".lock":
+                continue
+            fn = os.path.join(path, name)
+            if os.path.isdir(fn):
+                shutil.rmtree(fn, ignore_errors=True)
+            else:
+                os.remove(fn)
+
+    def inspect(self):
+        ret = []
+        for path, manifest in self.entries():
+            ret += [{
+                "path": path,
+                "source": None if manifest is None else manifest["source"]["path"],
+                "size": self.entry_size(path),
+                "last_access": 0 if manifest is None else manifest["last_access"],
+                "branches": 0 if manifest is None else len(manifest["branches"]),
+                "stale": self.is_stale(manifest),
+            }]
+        return ret
+
+    def enforce_quota(self, keep=[], dryrun=False):
+        """
+        Remove the least recently used entries until the cache fits in the quota.
+        Entries in keep, e.g. the ones used by the current job, and those locked by other jobs are not removed.
+        Returns the list of removed entries.
+        """
+        if self.quota is None:
+            return []
+        entries = [
+            (0 if manifest is None else manifest["last_access"], path, self.entry_size(path))
+            for path, manifest in self.entries()
+        ]
+        keep = [os.path.abspath(k) for k in keep]
+        total = sum(e[2] for e in entries)
+        removed = []
+        for last_access, path, size in sorted(entries):
+            if total <= self.quota:
+                break
+            if os.path.abspath(path) in keep:
+                continue
+            if not dryrun and not self.remove(path):
+                continue
+            total -= size
+            removed += [path]
+        return removed
+
+    def prune(self, dryrun=False):
+        """Remove stale entries and enforce the quota, returns the list of removed entries"""
+        removed = []
+        for path, manifest in self.entries():
+            if self.is_stale(manifest):
+                if not dryrun and not self.remove(path):
+                    continue
+                removed += [path]
+        return removed + [r for r in self.enforce_quota(dryrun=dryrun) if not r in removed]
+
 def progress(count, total, status=''):
     sys.stdout.write('.')
     sys.stdout.flush()
 
 
+def prefetch(items, depth=1, max_bytes=None, sizeof=None):
+    """
+    Iterate over items in a background thread, such that the next items are already produced
+    (e.g. read from disk and decompressed) while the current one is being processed.
+    At most depth items are produced ahead. If max_bytes is given, no new item is produced
+    while the items held in memory, including the one being processed, exceed max_bytes
+    as measured by sizeof(item).
+    """
+    if depth <= 0:
+        for item in items:
+            yield item
+        return
+
+    cond = threading.Condition()
+    queue = deque()
+    state = {"bytes": 0, "done": False, "stop": False, "error": None}
+
+    def can_produce():
+        if state["stop"]:
+            return True
+        return len(queue) < depth and (max_bytes is None or state["bytes"] < max_bytes)
+
+    def producer():
+        try:
+            it = iter(items)
+            while True:
+                with cond:
+                    cond.wait_for(can_produce)
+                    if state["stop"]:
+                        return
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                nbytes = 0 if sizeof is None else sizeof(item)
+                with cond:
+                    queue.append((item, nbytes))
+                    state["bytes"] += nbytes
+                    cond.notify_all()
+        except BaseException as e:
+            with cond:
+                state["error"] = e
+        finally:
+            with cond:
+                state["done"] = True
+                cond.notify_all()
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    nbytes_current = 0
+    try:
+        while True:
+            with cond:
+                #the previous item has been processed, release it
+                state["bytes"] -= nbytes_current
+                nbytes_current = 0
+                cond.notify_all()
+                cond.wait_for(lambda: len(queue) > 0 or state["done"])
+                if len(queue) == 0:
+                    if not state["error"] is None:
+                        raise state["error"]
+                    return
+                item, nbytes_current = queue.popleft()
+            yield item
+    finally:
+        with cond:
+            state["stop"] = True
+            cond.notify_all()
+
+class WorkQueue(object):
+    """
+    Coordinator of a local work queue: the tasks are handed out over a socket to long-lived worker
+    processes (see run_worker), which send back the Results of every task as an Accumulator. They are
+    summed in place as they arrive, failed tasks are retried up to max_retries times, also if the worker died,
+    and crashed workers are restarted.
+    """
+    ENV = "HEPACCELERATE_WORKQUEUE"
+
+    def __init__(self, tasks, max_retries=2, verbose=False):
+        self.tasks = list(tasks)
+        self.max_retries = max_retries
+        self.verbose = verbose
+
+    def run(self, command, nworkers):
+        """
+        Start nworkers subprocesses running command and process all the tasks.
+        Returns the summed Results and the list of tasks that failed more than max_retries times,
+        or were left when all the workers exited. They are not printed, that is up to the caller.
+        """
+        from multiprocessing.connection import Listener
+
+        cond = threading.Condition()
+        state = {"pending": deque(range(len(self.tasks))), "retries": [0]*len(self.tasks),
+            "ndone": 0, "failed": [], "results": Accumulator(), "nconn": 0, "closed": False}
+
+        def finished():
+            return state["ndone"] + len(state["failed"]) == len(self.tasks)
+
+        def fail(itask, reason):
+            #called with the condition held
+            #the tasks failing every attempt are only reported by the caller, from the returned list
+            state["retries"][itask] += 1
+            if self.verbose:
+                print("WorkQueue: attempt {0} of task {1} {2} failed: {3}".format(state["retries"][itask], itask, self.tasks[itask], reason))
+            if state["retries"][itask] > self.max_retries:
+                state["failed"] += [self.tasks[itask]]
+            else:
+                state["pending"].append(itask)
+            cond.notify_all()
+
+        def serve(conn):
+            itask = None
+            try:
+                while True:
+                    msg, itask_ret, payload = conn.recv()
+                    with cond:
+                        if msg == "done":
+                            state["results"] += payload
+                            state["ndone"] += 1
+                            if self.verbose:
+                                print("WorkQueue: task {0} done, {1}/{2}".format(itask_ret, state["ndone"], len(self.tasks)))
+                            cond.notify_all()
+                        elif msg == "error":
+                            fail(itask_ret, payload)
+                        itask = None
+                        cond.wait_for(lambda: len(state["pending"]) > 0 or finished())
+                        if finished():
+                            break
+                        itask = state["pending"].popleft()
+                    conn.send((itask, self.tasks[itask]))
+                conn.send(None)
+            except (EOFError, OSError):
+                #the worker died, put back its task
+                if not itask is None:
+                    with cond:
+                        fail(itask, "worker disconnected")
+            finally:
+                conn.close()
+                with cond:
+                    state["nconn"] -= 1
+                    cond.notify_all()
+
+        authkey = os.urandom(16)
+        listener = Listener(("localhost", 0), authkey=authkey)
+        env = dict(os.environ)
+        env[self.ENV] = "{0}:{1}:{2}".format(listener.address[0], listener.address[1], authkey.hex())
+
+        def accept():
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception:
+                    #the listener was closed, or the connection was not authenticated
+                    if state["closed"]:
+                        return
+                    continue
+                with cond:
+                    state["nconn"] += 1
+                threading.Thread(target=serve, args=(conn, ), daemon=True).start()
+
+        t0 = time.time()
+        procs = [subprocess.Popen(command, env=env) for i in range(nworkers)]
+        threading.Thread(target=accept, daemon=True).start()
+        try:
+            with cond:
+                nrestarts = 0
+                while not finished():
+                    cond.wait(timeout=1.0)
+                    #replace the workers that crashed as long as there is work left
+                    for iproc, proc in enumerate(procs):
+                        if not proc.poll() in [None, 0] and len(state["pending"]) > 0 and nrestarts < nworkers*self.max_retries:
+                            if self.verbose:
+                                print("WorkQueue: worker exited with code {0}, restarting it".format(proc.returncode))
+                            procs[iproc] = subprocess.Popen(command, env=env)
+                            nrestarts += 1
+                    if state["nconn"] == 0 and all(not proc.poll() is None for proc in procs):
+                        if self.verbose:
+                            print("WorkQueue: all workers exited with {0} tasks left".format(len(state["pending"])))
+                        state["failed"] += [self.tasks[itask] for itask in state["pending"]]
+                        state["pending"].clear()
+                        cond.notify_all()
+        finally:
+            state["closed"] = True
+            listener.close()
+            for proc in procs:
+                try:
+                    proc.wait(timeout=60)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        t1 = time.time()
+        if self.verbose:
+            print("WorkQueue: processed {0} tasks with {1} workers in {2:.1f} seconds, {3} failed".format(
+                len(self.tasks), nworkers, t1 - t0, len(state["failed"]))
+            )
+        return state["results"].to_results(), state["failed"]
+
+def run_worker(process):
+    """
+    Worker of a WorkQueue, started by the coordinator: pull tasks until there are none left
+    and send back the Results of process(task), or the traceback if it failed.
+    """
+    from multiprocessing.connection import Client
+
+    host, port, authkey = os.environ[WorkQueue.ENV].split(":")
+    conn = Client((host, int(port)), authkey=bytes.fromhex(authkey))
+    conn.send(("ready", None, None))
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        itask, payload = task
+        try:
+            ret = process(payload)
+            if isinstance(ret, Results):
+                ret = Accumulator(ret)
+            conn.send(("done", itask, ret))
+        except Exception:
+            conn.send(("error", itask, traceback.format_exc()))
+    conn.close()
+
+#state of the worker processes of NanoAODDataset.analyze_parallel, set before forking
+_worker_state = {}
+
+def _init_worker(nthreads):
+    import numba
+    numba.set_num_threads(nthreads)
+
+def _analyze_worker(task):
+    dataset = _worker_state["dataset"]
+    return Accumulator(_worker_state["func"](dataset.select_chunk(*task)))
+
 class Dataset(object):
     def __init__(self, filenames, arrays_to_load, treename):
         self.filenames = filenames
@@ -165,6 +1146,15 @@ class Dataset(object):
         self.treename = treename
         self.do_progress = False
 
+    def read_arrays(self, tt, nthreads=1, entrystart=None, entrystop=None):
+        if nthreads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                arrs = tt.arrays(self.arrays_to_load, entrystart=entrystart, entrystop=entrystop, executor=executor)
+        else:
+            arrs = tt.arrays(self.arrays_to_load, entrystart=entrystart, entrystop=entrystop)
+        return arrs
+
     def preload(self, nthreads=1, verbose=False):
         if verbose:
             print("Loading data from {0} ROOT files to memory".format(len(self.filenames)))
@@ -172,12 +1162,7 @@ class Dataset(object):
         for ifn, fn in enumerate(self.filenames):
             fi = uproot.open(fn)
             tt = fi.get(self.treename)
-            if nthreads > 1:
-                from concurrent.futures import ThreadPoolExecutor
-                with ThreadPoolExecutor(max_workers=nthreads) as executor:
-                    arrs = tt.arrays(self.arrays_to_load, executor=executor)
-            else:
-                arrs = tt.arrays(self.arrays_to_load)
+            arrs = self.read_arrays(tt, nthreads)
             self.data_host += [arrs]
             if self.do_progress:
                 progress(ifn, len(self.filenames))
@@ -186,6 +1171,18 @@ class Dataset(object):
         if verbose:
             print("Loaded {0:.2E} events in {1:.1f} seconds, {2:.2E} Hz".format(len(self), dt, len(self)/dt))
 
+    def iterate(self, entrysteps, nthreads=1):
+        """
+        Yield (ifn, entrystart, entrystop, arrays) for consecutive ranges of at most entrysteps events of every file.
+        Only one range is held in memory at a time.
+        """
+        for ifn, fn in enumerate(self.filenames):
+            fi = uproot.open(fn)
+            tt = fi.get(self.treename)
+            for entrystart in range(0, tt.numentries, entrysteps):
+                entrystop = min(entrystart + entrysteps, tt.numentries)
+                yield ifn, entrystart, entrystop, self.read_arrays(tt, nthreads, entrystart, entrystop)
+
     def num_events_raw(self):
         nev = 0
         for arrs in self.data_host:
@@ -203,6 +1200,7 @@ class NanoAODDataset(Dataset):
         self.names_structs = names_structs
         self.names_eventvars = names_eventvars
         self.cache_prefix = ""
+        self.cache_manager = None
          
         #lists of data, one per file
         self.structs = {}
@@ -226,6 +1224,15 @@ class NanoAODDataset(Dataset):
                 tot += self.eventvars[ifile][evvar].size
         return tot
  
+    def nbytes(self):
+        """Size of the objects and event variables in bytes"""
+        tot = 0
+        for structname in self.names_structs:
+            tot += sum(struct.nbytes() for struct in self.structs[structname])
+        for evvars in self.eventvars:
+            tot += sum(v.nbytes for v in evvars.values())
+        return tot
+ 
     def __repr__(self):
         s = "NanoAODDataset(files={0}, events={1}, {2})".format(len(self.filenames), len(self), ", ".join(self.structs.keys()))
         return s
@@ -270,9 +1277,61 @@ class NanoAODDataset(Dataset):
         if self.do_progress:
             print("Made objects in {0:.2E} events in {1:.1f} seconds, {2:.2E} Hz".format(len(self), dt, len(self)/dt))
 
+    def make_chunk(self, ifn, entrystart, entrystop):
+        """Dataset holding the events [entrystart, entrystop) of the file ifn"""
+        chunk = NanoAODDataset([self.filenames[ifn]], self.arrays_to_load, self.treename, self.names_structs, self.names_eventvars)
+        chunk.entrystart = entrystart
+        chunk.entrystop = entrystop
+        return chunk
+
+    def event_ranges(self, entrysteps=None):
+        """List of (ifn, entrystart, entrystop) covering the loaded events, one per file if entrysteps is None"""
+        ranges = []
+        for ifn in range(len(self.filenames)):
+            nev_file = self.structs[self.names_structs[0]][ifn].numevents()
+            steps = nev_file if entrysteps is None else entrysteps
+            for entrystart in range(0, nev_file, max(steps, 1)):
+                ranges += [(ifn, entrystart, min(entrystart + steps, nev_file))]
+        return ranges
+
+    def select_chunk(self, ifn, entrystart, entrystop):
+        """Dataset with a range of the loaded events of one file, the arrays are views of this dataset"""
+        chunk = self.make_chunk(ifn, entrystart, entrystop)
+        for structname in self.names_structs:
+            chunk.structs[structname] = [self.structs[structname][ifn].select_events(entrystart, entrystop)]
+        chunk.eventvars = [{k: v[entrystart:entrystop] for k, v in self.eventvars[ifn].items()}]
+        return chunk
+
+    def iterate_chunks(self, entrysteps, nthreads=1, verbose=False):
+        """
+        Yield datasets of at most entrysteps events, such that the memory needed for the analysis
+        is bounded by the chunk size rather than by the number of files.
+        If the data were already loaded (e.g. from the cache), the chunks are views of the loaded data,
+        otherwise every chunk is read from the ROOT files only when it is needed.
+        """
+        t0 = time.time()
+        nev = 0
+        if len(self.eventvars) > 0:
+            for ifn, entrystart, entrystop in self.event_ranges(entrysteps):
+                nev += entrystop - entrystart
+                yield self.select_chunk(ifn, entrystart, entrystop)
+        else:
+            for ifn, entrystart, entrystop, arrs in self.iterate(entrysteps, nthreads):
+                chunk = self.make_chunk(ifn, entrystart, entrystop)
+                chunk.data_host = [arrs]
+                chunk.make_objects()
+                #the structs hold a copy of the data, release the raw arrays
+                chunk.data_host = []
+                nev += entrystop - entrystart
+                yield chunk
+        t1 = time.time()
+        dt = t1 - t0
+        if verbose:
+            print("iterate_chunks: processed {0:.2E} events in chunks of {1} in {2:.1f} seconds, {3:.2E} Hz".format(nev, entrysteps, dt, nev/dt))
+
     def analyze(self, analyze_data, verbose=False, **kwargs):
         t0 = time.time()
-        rets = []
+        ret = None
         for ifile in range(len(self.filenames)):
             data = {}
             #for structname in self.names_structs:
@@ -281,13 +1340,73 @@ class NanoAODDataset(Dataset):
                 data[structname] = struct[ifile]
             data["num_events"] = self.structs[structname][ifile].numevents()
             data["eventvars"] = self.eventvars[ifile]
-            ret = analyze_data(data, **kwargs)
-            rets += [ret]
+            #identifies the events, e.g. to reuse the cached DNN predictions among the variations
+            data["chunk"] = (self.filenames[ifile], getattr(self, "entrystart", None), getattr(self, "entrystop", None))
+            ret_file = analyze_data(data, **kwargs)
+            #the results of the following files are added in place to those of the first one
+            if ret is None:
+                ret = ret_file
+            else:
+                ret += ret_file
         t1 = time.time()
         dt = t1 - t0
         if verbose:
             print("analyze: processed analysis with {0:.2E} events in {1:.1f} seconds, {2:.2E} Hz".format(len(self), dt, len(self)/dt))
-        return sum(rets, Results({}))
+        if ret is None:
+            ret = Results({})
+        return ret
+
+    def analyze_parallel(self, func, workers, entrysteps=None, nthreads=None, warmup=True, verbose=False):
+        """
+        Run func(chunk) -> Results on the loaded events split in ranges of entrysteps events
+        (one per file by default) in a pool of worker processes, and sum the returned Results.
+        The workers send back their Results as an Accumulator, which is summed in place.
+        The workers are forked from this process, such that they share the loaded data as well as
+        the JIT-compiled kernels and the corrections already loaded here. With warmup, the first range
+        is processed in this process before forking, such that the kernels are compiled only once.
+        Every worker uses nthreads numba threads, by default the available threads split evenly.
+        Only the CPU backend is supported, with a fork-safe numba threading layer (e.g. workqueue).
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        import numba
+
+        t0 = time.time()
+        tasks = self.event_ranges(entrysteps)
+        if nthreads is None:
+            nthreads = max(1, numba.config.NUMBA_NUM_THREADS // workers)
+
+        ret = Accumulator()
+        if warmup and len(tasks) > 0 and not _worker_state.get("warm", False):
+            ret += func(self.select_chunk(*tasks[0]))
+            tasks = tasks[1:]
+            _worker_state["warm"] = True
+
+        if workers <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                ret += func(self.select_chunk(*task))
+        else:
+            #the state is inherited by the forked workers rather than pickled
+            _worker_state["dataset"] = self
+            _worker_state["func"] = func
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                    initializer=_init_worker, initargs=(nthreads, )) as executor:
+                    for acc in executor.map(_analyze_worker, tasks):
+                        ret += acc
+            finally:
+                _worker_state.pop("dataset")
+                _worker_state.pop("func")
+
+        ret = ret.to_results()
+        t1 = time.time()
+        dt = t1 - t0
+        if verbose:
+            print("analyze_parallel: processed analysis with {0:.2E} events with {1} workers in {2:.1f} seconds, {3:.2E} Hz".format(
+                len(self), workers, dt, len(self)/dt)
+            )
+        return ret
 
     def to_cache(self, nthreads=1, verbose=False):
         if self.do_progress:
@@ -302,6 +1421,9 @@ class NanoAODDataset(Dataset):
                 results = executor.map(self.to_cache_worker, range(len(self.filenames)))
             results = [r for r in results]
 
+        if not self.cache_manager is None:
+            self.cache_manager.enforce_quota(keep=[self.get_cache_entry(fn) for fn in self.filenames])
+
         t1 = time.time()
         dt = t1 - t0
         if verbose:
@@ -309,23 +1431,46 @@ class NanoAODDataset(Dataset):
                 dt, len(self), len(self)/dt
             ))
     
+    def get_cache_entry(self, fn):
+        """Directory holding the cached columns of the ROOT file fn"""
+        bfn = os.path.basename(fn).replace(".root", "")
+        dn = os.path.dirname(self.get_cache_dir(fn))
+        return os.path.join(dn, bfn)
+
     def to_cache_worker(self, ifn):
         if self.do_progress:
             progress(ifn, len(self.filenames))
         fn = self.filenames[ifn] 
-        bfn = os.path.basename(fn).replace(".root", "")
-        dn = os.path.dirname(self.get_cache_dir(fn))
+        dn = self.get_cache_entry(fn)
 
         #maybe directory was already created by another worker
         try:
             os.makedirs(dn)
-        except FileExistsError as e:
+        except FileExistsError:
             pass
 
-        for structname in self.names_structs:
-            self.structs[structname][ifn].savez(os.path.join(dn, bfn + ".{0}.npz".format(structname)))
-        with open(os.path.join(dn, bfn + ".eventvars.npz"), "wb") as fi:
-            self.numpy_lib.savez(fi, **self.eventvars[ifn])
+        with cache_lock(dn):
+            manifest = None
+            if os.path.isfile(os.path.join(dn, "manifest.json")):
+                manifest = read_manifest(dn)
+            if manifest is None or self.cache_is_stale(manifest):
+                #the columns left by an outdated or incomplete entry are not reused
+                CacheManager.clear(dn)
+                manifest = empty_manifest(source_fingerprint(fn))
+            manifest["last_access"] = time.time()
+
+            #the columns already in the entry are never rewritten
+            for structname in self.names_structs:
+                cached = manifest["structs"].setdefault(structname, [])
+                cached += self.structs[structname][ifn].save_columns(dn, structname, skip=cached)
+            for k, v in self.eventvars[ifn].items():
+                if not k in manifest["eventvars"]:
+                    save_column(os.path.join(dn, "eventvars.{0}.npy".format(k)), v)
+                    manifest["eventvars"] += [k]
+            manifest["branches"] += [b for b in self.arrays_to_load if not b in manifest["branches"]]
+
+            #the manifest is written last, an entry without it is incomplete and will not be used
+            write_manifest(dn, manifest)
 
     def from_cache(self, nthreads=1, verbose=False):
         t0 = time.time()
@@ -345,6 +1490,9 @@ class NanoAODDataset(Dataset):
                 self.structs[structname] = [r[1][structname] for r in results]
             self.eventvars = [r[2] for r in results] 
 
+        if not self.cache_manager is None:
+            self.cache_manager.enforce_quota(keep=[self.get_cache_entry(fn) for fn in self.filenames])
+
         t1 = time.time()
         dt = t1 - t0
         if verbose:
@@ -356,19 +1504,92 @@ class NanoAODDataset(Dataset):
         if self.do_progress:
             progress(ifn, len(self.filenames))
         fn = self.filenames[ifn]
-        bfn = os.path.basename(fn).replace(".root", "")
-        
-        dn = os.path.dirname(self.get_cache_dir(fn))
+        dn = self.get_cache_entry(fn)
 
-        loaded_structs = {}
-        for struct in self.names_structs:
-            loaded_structs[struct]= JaggedStruct.load(os.path.join(dn, bfn+".{0}.npz".format(struct)), self.numpy_lib)
-        with open(os.path.join(dn, bfn+".eventvars.npz"), "rb") as fi:
-            npz_file = self.numpy_lib.load(fi)
-            if hasattr(npz_file, "npz_file"):
-                npz_file = npz_file.npz_file
-            eventvars = {k: self.numpy_lib.array(npz_file[k]) for k in npz_file.files}
+        while True:
+            #the columns are opened under the shared lock, such that the entry is not removed meanwhile
+            with cache_lock(dn, shared=True):
+                manifest = None
+                if os.path.isfile(os.path.join(dn, "manifest.json")):
+                    manifest = read_manifest(dn)
+                if not (manifest is None or self.cache_is_stale(manifest) or any(not b in manifest["branches"] for b in self.arrays_to_load)):
+                    loaded_structs = {}
+                    for struct in self.names_structs:
+                        loaded_structs[struct] = JaggedStruct.load_columns(dn, struct, manifest["structs"][struct], self.numpy_lib)
+                    eventvars = {k: load_column(os.path.join(dn, "eventvars.{0}.npy".format(k)), self.numpy_lib) for k in manifest["eventvars"]}
+                    break
+            #outdated or incomplete entries are recreated or extended under the exclusive lock of the entry
+            self.extend_cache_worker(ifn)
+
+        if not self.cache_manager is None:
+            self.cache_manager.touch(dn)
         return ifn, loaded_structs, eventvars
+
+    def cache_is_stale(self, manifest):
+        if self.cache_manager is None:
+            return CacheManager(self.cache_prefix).is_stale(manifest)
+        return self.cache_manager.is_stale(manifest)
+
+    def extend_cache_worker(self, ifn):
+        """
+        Read only the branches that are requested but not yet in the cache entry of the file from ROOT
+        and append them to the entry. If the entry does not exist yet or is outdated, it is created from scratch.
+        Returns the updated manifest.
+        """
+        fn = self.filenames[ifn]
+        dn = self.get_cache_entry(fn)
+
+        try:
+            os.makedirs(dn)
+        except FileExistsError:
+            pass
+
+        with cache_lock(dn):
+            #another job may have extended the entry while we were waiting for the lock
+            manifest = None
+            if os.path.isfile(os.path.join(dn, "manifest.json")):
+                manifest = read_manifest(dn)
+                if self.cache_is_stale(manifest):
+                    print("cache entry {0} is outdated with respect to {1}, recreating it".format(dn, fn))
+                    manifest = None
+            fi = uproot.open(fn)
+            if manifest is None:
+                #the columns left by an outdated or incomplete entry are not reused
+                CacheManager.clear(dn)
+                manifest = empty_manifest(source_fingerprint(fn, fi))
+            manifest["last_access"] = time.time()
+            missing = [b for b in self.arrays_to_load if not b in manifest["branches"]]
+            if len(missing) == 0:
+                write_manifest(dn, manifest)
+                return manifest
+
+            #a branch that would not be saved would be read again every time the entry is loaded
+            unknown = [b for b in missing if not b in self.names_eventvars and not any(b.startswith(s + "_") for s in self.names_structs)]
+            if len(unknown) > 0:
+                raise ValueError("branches {0} are neither event variables nor attributes of {1}, they cannot be cached".format(unknown, self.names_structs))
+
+            tt = fi.get(self.treename)
+            arrs = tt.arrays(missing)
+            for k, v in arrs.items():
+                name = str(k, 'ascii')
+                if name in self.names_eventvars:
+                    save_column(os.path.join(dn, "eventvars.{0}.npy".format(name)), np.array(v))
+                    manifest["eventvars"] += [name]
+                for structname in self.names_structs:
+                    prefix = structname + "_"
+                    if not name.startswith(prefix):
+                        continue
+                    #the offsets are shared by all the attributes of the struct
+                    fn_offsets = os.path.join(dn, "{0}.offsets.npy".format(structname))
+                    if not os.path.isfile(fn_offsets):
+                        save_column(fn_offsets, np.array(v.offsets))
+                    manifest["structs"].setdefault(structname, [])
+                    attr = name.replace(prefix, "")
+                    save_column(os.path.join(dn, "{0}.{1}.npy".format(structname, attr)), np.array(v.content))
+                    manifest["structs"][structname] += [attr]
+            manifest["branches"] += missing
+            write_manifest(dn, manifest)
+        return manifest
  
     def num_objects_loaded(self, structname):
         n_objects = 0
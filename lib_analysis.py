@@ -1,4 +1,6 @@
 import os, glob
+import math
+import hashlib
 import argparse
 import json
 import numpy as np
@@ -6,9 +8,7 @@ import numpy as np
 import uproot
 import hepaccelerate
 
-from hepaccelerate.utils import Results, NanoAODDataset, Histogram, choose_backend
-
-from uproot_methods import TLorentzVectorArray
+from hepaccelerate.utils import Results, NanoAODDataset, Histogram, HistogramND, LorentzVectorArray, choose_backend
 
 NUMPY_LIB = None
 ha = None
@@ -55,9 +55,11 @@ def lepton_selection(leps, cuts, year):
     return good_leps, veto_leps
 
 ### Jet selection
-def jet_selection(jets, leps, mask_leps, cuts):
+def jet_selection(jets, leps, mask_leps, cuts, jets_pass_dr=None):
 
-    jets_pass_dr = ha.mask_deltar_first(jets, jets.masks["all"], leps, mask_leps, cuts["dr"])
+    #the cleaning from leptons can be computed once and passed, it does not depend on the jet energy
+    if jets_pass_dr is None:
+        jets_pass_dr = ha.mask_deltar_first(jets, jets.masks["all"], leps, mask_leps, cuts["dr"])
     jets.masks["pass_dr"] = jets_pass_dr
     good_jets = (jets.pt > cuts["pt"]) & (NUMPY_LIB.abs(jets.eta) < cuts["eta"]) & (jets.jetId >= cuts["jetId"]) & jets_pass_dr
     if cuts["type"] == "jet":
@@ -166,53 +168,136 @@ def compute_btag_weights(jets, mask_rows, mask_content, sf, btagalgorithm):
 
 ############################################# HIGH LEVEL VARIABLES (DNN evaluation, ...) ############################################
 
-def evaluate_DNN(jets, good_jets, electrons, good_electrons, muons, good_muons, scalars, mask_events, DNN, DNN_model):
-    
-        # make inputs (defined in backend (not extremely nice))
-        jets_feats = ha.make_jets_inputs(jets, jets.offsets, 10, ["pt","eta","phi","en","px","py","pz", "btagDeepB"], mask_events, good_jets)
-        met_feats = ha.make_met_inputs(scalars, nEvents, ["phi","pt","sumEt","px","py"], mask_events)
-        leps_feats = ha.make_leps_inputs(electrons, muons, nEvents, ["pt","eta","phi","en","px","py","pz"], mask_events, good_electrons, good_muons)
-
-        inputs = [jets_feats, leps_feats, met_feats]
-
-        if DNN.startswith("ffwd"):
-            inputs = [NUMPY_LIB.reshape(x, (x.shape[0], -1)) for x in inputs]
-            inputs = NUMPY_LIB.hstack(inputs)
-            # numpy transfer needed for keras
-            inputs = NUMPY_LIB.asnumpy(inputs)
-
-        if DNN.startswith("cmb"):
-            # numpy transfer needed for keras
-            if not isinstance(jets_feats, np.ndarray):
-                inputs = [NUMPY_LIB.asnumpy(x) for x in inputs]
-
-        # fix in case inputs are empty
-        if jets_feats.shape[0] == 0:
-            DNN_pred = NUMPY_LIB.zeros(nEvents, dtype=NUMPY_LIB.float32)
+#inputs of the COBRA (cmb) and feed-forward (ffwd) architectures, a list of tensors with events along the first axis
+def make_DNN_inputs(jets, good_jets, electrons, good_electrons, muons, good_muons, scalars, mask_events, DNN):
+    nEvents = len(mask_events)
+    # make inputs (defined in backend (not extremely nice))
+    jets_feats = ha.make_jets_inputs(jets, jets.offsets, 10, ["pt","eta","phi","en","px","py","pz", "btagDeepB"], mask_events, good_jets)
+    met_feats = ha.make_met_inputs(scalars, nEvents, ["phi","pt","sumEt","px","py"], mask_events)
+    leps_feats = ha.make_leps_inputs(electrons, muons, nEvents, ["pt","eta","phi","en","px","py","pz"], mask_events, good_electrons, good_muons)
+
+    inputs = [jets_feats, leps_feats, met_feats]
+    if DNN.startswith("ffwd"):
+        inputs = [NUMPY_LIB.hstack([NUMPY_LIB.reshape(x, (x.shape[0], -1)) for x in inputs])]
+    return inputs
+
+class DNNInference:
+    """
+    Runs the DNN on the selected events only, in batches of batch_size, and scatters the predictions back to all events
+    (zero for the events that are not selected).
+    The predictions of a chunk are cached by a hash of the selected inputs, so that the variations which do not change
+    the inputs (e.g. the weight-only variations) reuse them. The cache is cleared when a different chunk is evaluated,
+    calls without a chunk keep it (the hash covers the inputs and the selected events).
+    """
+    def __init__(self, DNN, DNN_model, batch_size=10000):
+        self.DNN = DNN
+        self.DNN_model = DNN_model
+        self.batch_size = batch_size
+        self.chunk = None
+        self.cache = {}
+        self.num_predicted = 0
+        self.num_cached = 0
+
+    @staticmethod
+    def inputs_hash(inputs, sel):
+        h = hashlib.sha1(sel.tobytes())
+        for x in inputs:
+            h.update(str(x.shape).encode())
+            h.update(np.ascontiguousarray(x).tobytes())
+        return h.hexdigest()
+
+    def predict(self, inputs):
+        nsel = inputs[0].shape[0]
+        preds = []
+        for start in range(0, nsel, self.batch_size):
+            batch = [x[start:start + self.batch_size] for x in inputs]
+            if len(batch) == 1:
+                batch = batch[0]
+            preds += [np.asarray(self.DNN_model.predict_on_batch(batch))]
+        pred = np.concatenate(preds)
+        if self.DNN.endswith("binary"):
+            pred = np.reshape(pred, pred.shape[0])
+        return pred
+
+    #chunk identifies the events (e.g. the file name and the event range), the cached predictions are reused only within it
+    def __call__(self, jets, good_jets, electrons, good_electrons, muons, good_muons, scalars, mask_events, chunk=None):
+        if chunk is not None and chunk != self.chunk:
+            self.cache = {}
+            self.chunk = chunk
+
+        nEvents = len(mask_events)
+        inputs = make_DNN_inputs(jets, good_jets, electrons, good_electrons, muons, good_muons, scalars, mask_events, self.DNN)
+
+        # compact the selected events, numpy transfer needed for keras
+        sel = NUMPY_LIB.nonzero(mask_events)[0]
+        sel_inputs = [NUMPY_LIB.asnumpy(x[sel]) for x in inputs]
+        sel = NUMPY_LIB.asnumpy(sel)
+
+        key = self.inputs_hash(sel_inputs, sel)
+        if key in self.cache:
+            pred = self.cache[key]
+            self.num_cached += len(sel)
         else:
-            # run prediction (done on GPU)
-            DNN_pred = DNN_model.predict(inputs, batch_size = 10000)
-            # in case of NUMPY_LIB is cupy: transfer numpy output back to cupy array for further computation
-            DNN_pred = NUMPY_LIB.array(DNN_model.predict(inputs, batch_size = 10000))
-            if DNN.endswith("binary"):
-                DNN_pred = NUMPY_LIB.reshape(DNN_pred, DNN_pred.shape[0])
-
+            if len(sel) == 0:
+                pred = None
+            else:
+                pred = self.predict(sel_inputs)
+                self.num_predicted += len(sel)
+            self.cache[key] = pred
+
+        if pred is None:
+            return NUMPY_LIB.zeros(nEvents, dtype=NUMPY_LIB.float32)
+        # in case of NUMPY_LIB is cupy: transfer numpy output back to cupy array for further computation
+        DNN_pred = NUMPY_LIB.zeros((nEvents, ) + pred.shape[1:], dtype=NUMPY_LIB.float32)
+        DNN_pred[NUMPY_LIB.array(sel)] = NUMPY_LIB.array(pred)
         return DNN_pred
 
+def evaluate_DNN(jets, good_jets, electrons, good_electrons, muons, good_muons, scalars, mask_events, DNN, DNN_model, inference=None, chunk=None):
+    if inference is None:
+        inference = DNNInference(DNN, DNN_model)
+    return inference(jets, good_jets, electrons, good_electrons, muons, good_muons, scalars, mask_events, chunk=chunk)
+
 # calculate simple object variables
 def calculate_variable_features(z, mask_events, indices, var):
 
     name, coll, mask_content, inds, feats = z
     idx = indices[inds]
 
+    feats_values = ha.get_in_offsets_columns({f: getattr(coll, f) for f in feats}, getattr(coll, "offsets"), idx, mask_events, mask_content)
     for f in feats:
-        var[inds+"_"+name+"_"+f] = ha.get_in_offsets(getattr(coll, f), getattr(coll, "offsets"), idx, mask_events, mask_content)
+        var[inds+"_"+name+"_"+f] = feats_values[f]
     
 ####################################################### Simple helpers  #############################################################
 
 def get_histogram(data, weights, bins):
     return Histogram(*ha.histogram_from_vector(data, weights, bins))
 
+#data and bins are the lists of the values and edges of every axis
+def get_histogram_nd(data, weights, bins):
+    return HistogramND(*ha.histogram_from_vector_nd(data, weights, bins))
+
+#histograms of several variables for several masks and weights, filled in one pass over the events
+#variables, masks and weights are dicts of per-event arrays, bins a dict with the edges of each variable
+#returns a dict {(variable, mask, weight): Histogram}
+def get_histograms(variables, masks, weights, bins):
+    var_names = list(variables.keys())
+    mask_names = list(masks.keys())
+    weight_names = list(weights.keys())
+    if len(var_names) == 0 or len(mask_names) == 0 or len(weight_names) == 0:
+        return {}
+
+    #the arrays are passed as they are, the kernel skips the events passing none of the masks
+    contents, contents_w2, bin_offsets = ha.histograms_from_vectors(
+        [variables[vn] for vn in var_names], [masks[mn] for mn in mask_names], [weights[wn] for wn in weight_names], [bins[vn] for vn in var_names])
+    ret = {}
+    for ivar, vn in enumerate(var_names):
+        a, b = bin_offsets[ivar], bin_offsets[ivar+1]
+        edges = NUMPY_LIB.asnumpy(bins[vn])
+        for imask, mn in enumerate(mask_names):
+            for iw, wn in enumerate(weight_names):
+                ret[(vn, mn, wn)] = Histogram(contents[imask, iw, a:b], contents_w2[imask, iw, a:b], edges)
+    return ret
+
 def remove_inf_nan(arr):
     arr[np.isinf(arr)] = 0
     arr[np.isnan(arr)] = 0
@@ -237,33 +322,22 @@ def r2_score0(y_true,y_pred):
     return 1. - K.sum( K.square(y_true[:,0] - y_pred[:,0]) ) / K.sum( K.square(y_true[:,0] - K.mean(y_true[:,0]) ) )
 
 def select_lepton_p4(objs1, mask1, objs2, mask2, indices, mask_rows):
-  selected_obj1 = {}
-  selected_obj2 = {}
   feats = ['pt','eta','phi','mass']
-  for feat in feats:
-    selected_obj1[feat] = ha.get_in_offsets(getattr(objs1,feat), objs1.offsets, indices, mask_rows, mask1)
-    selected_obj2[feat] = ha.get_in_offsets(getattr(objs2,feat), objs2.offsets, indices, mask_rows, mask2)
+  selected_obj1 = ha.get_in_offsets_columns({feat: getattr(objs1,feat) for feat in feats}, objs1.offsets, indices, mask_rows, mask1)
+  selected_obj2 = ha.get_in_offsets_columns({feat: getattr(objs2,feat) for feat in feats}, objs2.offsets, indices, mask_rows, mask2)
   select_1_or_2 = (selected_obj1['pt'] > selected_obj2['pt'])
   selected_feats = {}
   for feat in feats:
     selected_feats[feat] = NUMPY_LIB.where(select_1_or_2, selected_obj1[feat], selected_obj2[feat])
-  selected_p4 = TLorentzVectorArray.from_ptetaphim(selected_feats['pt'], selected_feats['eta'], selected_feats['phi'], selected_feats['mass'])
+  selected_p4 = LorentzVectorArray.from_ptetaphim(selected_feats['pt'], selected_feats['eta'], selected_feats['phi'], selected_feats['mass'], NUMPY_LIB)
   return selected_p4
 
+#score of a hadronic W candidate: mass difference to the leptonic W (ref)
+def w_mass_difference(px, py, pz, e, ref):
+  m2 = e**2 - px**2 - py**2 - pz**2
+  return abs(ref - math.sqrt(max(m2, 0.)))
+
 def hadronic_W(jets, jets_mask, lepWp4, mask_rows):
-  from itertools import combinations
-  init = -999.*np.zeros(len(jets.offsets) - 1, dtype=np.float32) 
-  hadW = TLorentzVectorArray.from_ptetaphim(init.copy(), init.copy(), init.copy(), init.copy())
-  for iev in range(jets.offsets.shape[0]-1):
-    if not mask_rows[iev]: continue
-    start = jets.offsets[iev]
-    end = jets.offsets[iev + 1]
-    smallestDiffW = 9999.
-    for jpair in combinations(jets.p4[start:end][jets_mask[start:end]], 2):
-      tmphadW = jpair[0] + jpair[1]
-      tmpDiff = abs(lepWp4[iev].mass - tmphadW.mass)
-      if tmpDiff<smallestDiffW:
-        smallestDiffW = tmpDiff
-        for feat in ['pt','eta','phi','mass']:
-          getattr(hadW, feat)[iev] = getattr(tmphadW, feat)
-  return hadW
+  #pair of masked jets with the mass closest to the leptonic W, zero in the events without a pair
+  best_idx, hadW = ha.best_combination(jets, jets_mask, mask_rows, NUMPY_LIB.asarray(lepWp4.mass), w_mass_difference, ncomb=2, max_score=9999.)
+  return LorentzVectorArray.from_ptetaphim(hadW['pt'], hadW['eta'], hadW['phi'], hadW['mass'], NUMPY_LIB)
@@ -0,0 +1,28 @@
+import os, argparse, time
+
+from hepaccelerate.utils import CacheManager
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Inspect and prune the dataset cache created by run_analysis.py')
+  parser.add_argument('command', choices=['inspect', 'prune'], help='inspect: list the cache entries, prune: remove stale entries and enforce the quota')
+  parser.add_argument('--cache-location', action='store', help='Path prefix of the cache', type=str, default=os.path.join(os.getcwd(), 'cache'))
+  parser.add_argument('--quota', action='store', help='Maximum size of the cache in GB, least recently used entries are evicted beyond it', type=float, default=None)
+  parser.add_argument('--check-remote', action='store_true', help='Validate entries of remote (xrootd) files against the UUID of the source, requires opening them')
+  parser.add_argument('--dryrun', action='store_true', help='Only print the entries that would be removed')
+  args = parser.parse_args()
+
+  manager = CacheManager(args.cache_location, quota=None if args.quota is None else args.quota*1e9, check_remote=args.check_remote)
+
+  if args.command == 'inspect':
+    entries = sorted(manager.inspect(), key=lambda e: e['last_access'])
+    for e in entries:
+      last_access = time.strftime('%Y-%m-%d %H:%M', time.localtime(e['last_access']))
+      print(f"{e['size']/1e6:10.1f} MB  {last_access}  {e['branches']:5d} branches  {'STALE ' if e['stale'] else ''}{e['path']}")
+    total = sum(e['size'] for e in entries)
+    nstale = sum(e['stale'] for e in entries)
+    print(f'{len(entries)} entries, {nstale} stale, {total/1e9:.2f} GB in total')
+  else:
+    removed = manager.prune(dryrun=args.dryrun)
+    for r in removed:
+      print(f"{'would remove' if args.dryrun else 'removed'} {r}")
+    print(f'{len(removed)} entries removed')
@@ -0,0 +1,120 @@
+import os, re, argparse, time
+from glob import glob
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from hepaccelerate.utils import Accumulator, HBinFile, load_results, tree_reduce
+
+def find_outputs(outdir, samples):
+  """Job outputs out_<sample>_<variation>_<job>.json/.hbin under outdir, as {(directory, sample, variation): {job: path}}"""
+  #the longest sample name matching a file wins, some names are prefixes of others
+  samples = sorted(samples, key=len, reverse=True)
+  pattern = re.compile(r'^out_(.+)_(\d+)\.(json|hbin)$')
+  outputs = defaultdict(dict)
+  for dirpath, dirnames, filenames in os.walk(outdir):
+    for fn in filenames:
+      m = pattern.match(fn)
+      if m is None:
+        continue
+      name, job = m.group(1), int(m.group(2))
+      #the outputs of a run without variations are out_<sample>__<job> or out_<sample>_<job>
+      s = next((s for s in samples if name == s or name.startswith(s+'_')), None)
+      if s is None:
+        continue
+      rn = name[len(s)+1:]
+      #the .hbin file converted from a JSON output replaces it
+      if job in outputs[(dirpath, s, rn)] and fn.endswith('.json'):
+        continue
+      outputs[(dirpath, s, rn)][job] = os.path.join(dirpath, fn)
+  return outputs
+
+def accumulate(paths):
+  """Sum the histograms of the files one at a time, the binary files are read histogram by histogram"""
+  acc = Accumulator()
+  for path in paths:
+    if path.endswith('.hbin'):
+      with HBinFile(path) as fi:
+        for name in fi.keys():
+          acc.add_histogram(tuple(name.split('/')), fi[name])
+    else:
+      acc += load_results(path)
+  return acc
+
+def job_indices(job_directory, sample):
+  """Indices of the job scripts <job>.job (slurm) or <job>.sh (condor) of a sample"""
+  names = [os.path.basename(j).split('.')[0] for j in glob(os.path.join(job_directory, sample, '*'))]
+  return sorted(int(n) for n in names if n.isdigit())
+
+def missing_jobs(jobs, expected=None):
+  #without the job scripts, the gaps in the job indices are reported
+  if expected is None:
+    expected = range(max(jobs) + 1)
+  return [j for j in expected if not j in jobs]
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Merge the per-job outputs of run_analysis.py into out_<sample>_<variation>_merged files')
+  parser.add_argument('-o','--output-directory', type=str, required=True, help='directory with the job outputs, searched recursively')
+  parser.add_argument('-s','--samples', default='submission/allSamples_2017.txt', help='file with the list of samples')
+  parser.add_argument('-j','--job-directory', type=str, default=None, help='directory with the job scripts <sample>/<job>.job, to report the jobs without output')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes merging the files')
+  parser.add_argument('--files-per-task', type=int, default=20, help='number of files summed by a process before the partial sums are merged in a tree')
+  parser.add_argument('--output-format', choices=['json', 'hbin'], default='json', help='format of the merged files')
+  parser.add_argument('--allow-missing', action='store_true', help='merge the outputs even if some jobs have no output')
+  args = parser.parse_args()
+
+  samples = [l.strip() for l in open(args.samples).readlines() if l.strip()!='']
+  outputs = find_outputs(args.output_directory, samples)
+  if args.job_directory is None:
+    print('without --job-directory only the gaps in the job indices are reported, missing jobs after the last output are not')
+
+  t0 = time.time()
+  tasks = []
+  for key in sorted(outputs):
+    dirpath, s, rn = key
+    jobs = outputs[key]
+    expected = None if args.job_directory is None else job_indices(args.job_directory, s)
+    missing = missing_jobs(jobs, expected)
+    if len(missing) > 0:
+      print(f'{s} {rn}: {len(jobs)} outputs, missing jobs {" ".join(map(str, missing))}')
+      if not args.allow_missing:
+        continue
+    paths = [jobs[j] for j in sorted(jobs)]
+    tasks += [(key, paths[i:i+args.files_per_task]) for i in range(0, len(paths), args.files_per_task)]
+
+  def write(key, merged):
+    dirpath, s, rn = key
+    outfn = os.path.join(dirpath, f'out_{s}_{rn}_merged.{args.output_format}')
+    if args.output_format == 'hbin':
+      merged.save_hbin(outfn)
+    else:
+      merged.save_json(outfn)
+    print(f'{outfn}: {len(outputs[key])} outputs')
+
+  #every process sums a group of files into an Accumulator, which is sent back as a single buffer.
+  #The partial sums of an output are merged in a binary tree as they arrive, the merged output is
+  #written as soon as all its groups are done. At most 2*workers groups are submitted and not yet merged,
+  #such that only the outputs in progress are held in memory.
+  with ProcessPoolExecutor(max_workers=args.workers) as executor:
+    remaining = iter(tasks)
+    pending = deque()
+    def submit():
+      while len(pending) < 2*args.workers:
+        task = next(remaining, None)
+        if task is None:
+          return
+        key, paths = task
+        pending.append((key, executor.submit(accumulate, paths)))
+
+    def results(key):
+      #the groups of an output are submitted one after the other, the futures are dropped once their result is taken
+      while len(pending) > 0 and pending[0][0] == key:
+        yield pending.popleft()[1].result()
+        submit()
+
+    submit()
+    nmerged = 0
+    while len(pending) > 0:
+      key = pending[0][0]
+      write(key, tree_reduce(results(key)).to_results())
+      nmerged += 1
+  print(f'merged {nmerged} outputs in {time.time()-t0:.1f} seconds')
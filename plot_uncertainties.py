@@ -1,13 +1,16 @@
-import json,argparse,sys,os
+import argparse,sys,os
 import numpy as np
 import matplotlib.pyplot as plt
 import mplhep as hep
 from glob import glob
 from itertools import cycle
+from hepaccelerate.utils import load_histogram
 
 def load_mc(indir,uncName,histToLoad,sample):
     #json_file = glob( os.path.join(indir,f'*ttHTobb_{uncName}.json') )
-    json_file = glob( os.path.join(indir,f'*{sample}_{uncName}*json') )
+    json_file = glob( os.path.join(indir,f'*{sample}_{uncName}*json') ) + glob( os.path.join(indir,f'*{sample}_{uncName}*hbin') )
+    #a converted .hbin file is preferred to the JSON file it was made from
+    json_file = [fn for fn in json_file if not (fn.endswith('json') and os.path.splitext(fn)[0]+'.hbin' in json_file)]
     if len(json_file)>1:
         json_file = input('Which file?\n'+'\n'.join(map(str,json_file))+'\n')
     elif len(json_file)==0:
@@ -15,8 +18,8 @@ def load_mc(indir,uncName,histToLoad,sample):
         sys.exit(0)
     else:
         json_file = json_file[0]
-    with open(json_file) as f:
-        return json.load(f)[histToLoad]
+    #binary result files give random access to single histograms
+    return load_histogram(json_file, histToLoad)
 
 def rebin(bins, counts, yerr, rebin_factor):
     new_bins   = bins[::rebin_factor]
@@ -4,9 +4,8 @@ import json
 import numpy as np
 
 import uproot
-from uproot_methods import TLorentzVectorArray
 #import hepaccelerate
-from hepaccelerate.utils import Results, NanoAODDataset, Histogram, choose_backend
+from hepaccelerate.utils import Results, NanoAODDataset, Histogram, LorentzVectorArray, CacheManager, WorkQueue, run_worker, choose_backend, prefetch
 
 #import itertools
 #from lib_analysis import mse0,mae0,r2_score0
@@ -14,91 +13,19 @@ from hepaccelerate.utils import Results, NanoAODDataset, Histogram, choose_backe
 from definitions_analysis import histogram_settings
 
 import lib_analysis
-from lib_analysis import vertex_selection, lepton_selection, jet_selection, load_puhist_target, compute_pu_weights, compute_lepton_weights, compute_btag_weights, chunks, calculate_variable_features, select_lepton_p4, hadronic_W, get_histogram
+from lib_analysis import vertex_selection, lepton_selection, jet_selection, load_puhist_target, compute_pu_weights, compute_lepton_weights, compute_btag_weights, chunks, calculate_variable_features, select_lepton_p4, hadronic_W, get_histogram, get_histograms, get_histogram_nd, DNNInference, evaluate_DNN
 
 from pdb import set_trace
 import sys
 
-#This function will be called for every file in the dataset
-def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, is_mc=True, lumimask=None, cat=False, boosted=False, uncertainty=None, uncertaintyName=None, parametersName=None, extraCorrection=None):
-    #Output structure that will be returned and added up among the files.
-    #Should be relatively small.
-    ret = Results()
-
+#Selections and weights that no systematic variation changes, shared by all the variations of a file
+def analyze_data_common(data, sample, NUMPY_LIB=None, parameters={}, is_mc=True, lumimask=None):
     muons     = data["Muon"]
     electrons = data["Electron"]
     scalars   = data["eventvars"]
     jets      = data["Jet"]
     fatjets   = data["FatJet"]
-    if is_mc:
-      genparts  = data['GenPart']
-
-    if args.year=='2017':
-      metstruct = 'METFixEE2017'
-    else:
-      metstruct = 'MET'
-
-    if is_mc and uncertaintyName.startswith('jes') and not sample.startswith('ttH'):
-        jesMerged = {
-                'Absolute'                    : ['AbsoluteMPFBias','AbsoluteScale','Fragmentation','PileUpDataMC','PileUpPtRef','RelativeFSR','SinglePionECAL','SinglePionHCAL'],
-                f'Absolute_{args.year}'       : ['AbsoluteStat','RelativeStatFSR','TimePtEta'],
-                'BBEC1'                       : ['PileUpPtBB','PileUpPtEC1','RelativePtBB'],
-                'EC2'                         : ['PileUpPtEC2'],
-                'HF'                          : ['PileUpPtHF','RelativeJERHF','RelativePtHF'],
-                f'BBEC1_{args.year}'          : ['RelativeJEREC1','RelativePtEC1','RelativeStatEC'],
-                f'EC2_{args.year}'            : ['RelativePtEC2'],
-                f'RelativeSample_{args.year}' : ['RelativeSample'],
-                f'HF_{args.year}'             : ['RelativeStatHF']
-                }
-        variation = 'Up' if uncertaintyName.endswith('Up') else 'Down'
-        jesName = uncertaintyName.split('jes')[-1].split(variation)[0]
-        if not hasattr(jets,f'pt_jes{jesName}{variation}'):
-            def sumInQuadrature(arr):
-                if len(arr)==1:
-                    return arr
-                else:
-                    return NUMPY_LIB.sqrt(NUMPY_LIB.sum(NUMPY_LIB.square(NUMPY_LIB.array(arr,dtype=NUMPY_LIB.float32)), axis=0))
-
-            for struct in [fatjets,jets]:
-                for var in ['pt','mass']:
-                    c = sumInQuadrature([getattr(struct,f'{var}_nom')-getattr(struct,f'{var}_jes{jesNameSplit}{variation}') for jesNameSplit in jesMerged[jesName]])
-                    setattr(struct, f'{var}_jes{jesName}{variation}', getattr(struct, f'{var}_nom')+(c if variation=='Up' else -c) )
-
-            c = sumInQuadrature([getattr(fatjets,'msoftdrop_nom')-getattr(fatjets,f'msoftdrop_jes{jesNameSplit}{variation}') for jesNameSplit in jesMerged[jesName]])
-            setattr(fatjets, f'msoftdrop_jes{jesName}{variation}', fatjets.msoftdrop_nom+(c if variation=='Up' else -c) )
-            for var in ['pt','phi']:
-                c = sumInQuadrature([scalars[f'{metstruct}_{var}_jer']-scalars[f'{metstruct}_{var}_jes{jesNameSplit}{variation}'] for jesNameSplit in jesMerged[jesName]])
-                scalars[f'{metstruct}_{var}_jes{jesName}{variation}'] = scalars[f'{metstruct}_{var}_nom']+(c if variation=='Up' else -c)
-            set_trace()
-    if uncertainty is not None:
-        if len(uncertainty)!=2: raise Exception(f'Invalid uncertainty {uncertainty}')
-        evUnc, objUnc = uncertainty
-        if len(evUnc)%2!=0: raise Exception(f'Invalid uncertainty for events {evUnc}')
-        for oldVar,newVar in zip(evUnc[::2],evUnc[1::2]):
-            scalars[oldVar] = scalars[newVar].copy()
-
-        if len(objUnc)%3!=0: raise Exception(f'Invalid uncertainty for objects {objUnc}')
-        for struct,oldBranch,newBranch in zip(objUnc[::3],objUnc[1::3],objUnc[2::3]):
-            if struct=='FatJet':
-              if not oldBranch=='bbtagSF_DDBvL_M1':
-                setattr(fatjets, oldBranch, getattr(fatjets,newBranch).copy())
-            elif struct=='Jet':
-                setattr(jets, oldBranch, getattr(jets,newBranch).copy())
-            else:
-                raise Exception(f'Problem with uncertainty on {struct}, {oldBranch}, {newBranch}')
-    
-    if extraCorrection is not None:
-      for e in extraCorrection:
-          fatjets.msoftdrop /= getattr(fatjets, f'msoftdrop_corr_{e}')
-    jets.p4 = TLorentzVectorArray.from_ptetaphim(jets.pt, jets.eta, jets.phi, jets.mass)
-
-    METp4 = TLorentzVectorArray.from_ptetaphim(scalars[metstruct+"_pt"], 0, scalars[metstruct+"_phi"], 0)
-    nEvents = muons.numevents()
-
-    indices = {
-        "leading"    : NUMPY_LIB.zeros(nEvents, dtype=NUMPY_LIB.int32),
-        "subleading" : NUMPY_LIB.ones(nEvents, dtype=NUMPY_LIB.int32)
-        }
+    nEvents   = muons.numevents()
 
     mask_events = NUMPY_LIB.ones(nEvents, dtype=NUMPY_LIB.bool)
 
@@ -116,37 +43,24 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
         mask_lumi = lumimask(scalars["run"], scalars["luminosityBlock"])
         mask_events = mask_events & mask_lumi
 
-    # apply object selection for muons, electrons, jets
+    # apply object selection for muons, electrons
     good_muons, veto_muons = lepton_selection(muons, parameters["muons"], args.year)
     good_electrons, veto_electrons = lepton_selection(electrons, parameters["electrons"], args.year)
-    good_jets = jet_selection(jets, muons, (good_muons|veto_muons), parameters["jets"]) & jet_selection(jets, electrons, (good_electrons|veto_electrons), parameters["jets"])
-#    good_jets = jet_selection(jets, muons, (veto_muons | good_muons), parameters["jets"]) & jet_selection(jets, electrons, (veto_electrons | good_electrons) , parameters["jets"])
-    bjets_resolved = good_jets & (getattr(jets, parameters["btagging_algorithm"]) > parameters["btagging_WP"])
-    good_fatjets = jet_selection(fatjets, muons, good_muons, parameters["fatjets"]) & jet_selection(fatjets, electrons, good_electrons, parameters["fatjets"])
-#    good_fatjets = jet_selection(fatjets, muons, (veto_muons | good_muons), parameters["fatjets"]) & jet_selection(fatjets, electrons, (veto_electrons | good_electrons), parameters["fatjets"]) #FIXME remove vet_leptons
-
-#    higgs_candidates = good_fatjets & (fatjets.pt > 250)
-#    nhiggs = ha.sum_in_offsets(fatjets, higgs_candidates, mask_events, fatjets.masks["all"], NUMPY_LIB.int8)
-#    indices["best_higgs_candidate"] = ha.index_in_offsets(fatjets.pt, fatjets.offsets, 1, mask_events, higgs_candidates)
-#    best_higgs_candidate = NUMPY_LIB.zeros_like(higgs_candidates)
-#    best_higgs_candidate[ (fatjets.offsets[:-1] + indices["best_higgs_candidate"])[NUMPY_LIB.where( fatjets.offsets<len(best_higgs_candidate) )] ] = True
-#    best_higgs_candidate[ (fatjets.offsets[:-1] + indices["best_higgs_candidate"])[NUMPY_LIB.where( fatjets.offsets<len(best_higgs_candidate) )] ] &= nhiggs.astype(NUMPY_LIB.bool)[NUMPY_LIB.where( fatjets.offsets<len(best_higgs_candidate) )] # to avoid removing the leading fatjet in events with no higgs candidate
 
-    good_jets_nohiggs = good_jets & ha.mask_deltar_first(jets, good_jets, fatjets, good_fatjets, 1.2, indices['leading'])
-    bjets = good_jets_nohiggs & (getattr(jets, parameters["btagging_algorithm"]) > parameters["btagging_WP"])
-    nonbjets = good_jets_nohiggs & (getattr(jets, parameters["btagging_algorithm"]) < parameters["btagging_WP"])
+    # cleaning of jets from muons and electrons in one pass, only depends on the directions of the jets
+    jets_pass_dr = ha.mask_deltar_several(jets, jets.masks["all"], [
+        (muons, (good_muons|veto_muons), parameters["jets"]["dr"]),
+        (electrons, (good_electrons|veto_electrons), parameters["jets"]["dr"]),
+    ])
+    fatjets_pass_dr = ha.mask_deltar_several(fatjets, fatjets.masks["all"], [
+        (muons, good_muons, parameters["fatjets"]["dr"]),
+        (electrons, good_electrons, parameters["fatjets"]["dr"]),
+    ])
 
-    # apply basic event selection -> individual categories cut later
     nmuons         = ha.sum_in_offsets(muons, good_muons, mask_events, muons.masks["all"], NUMPY_LIB.int8) 
     nelectrons     = ha.sum_in_offsets(electrons, good_electrons, mask_events, electrons.masks["all"], NUMPY_LIB.int8)
     nleps          = NUMPY_LIB.add(nmuons, nelectrons)
     lepton_veto    = NUMPY_LIB.add(ha.sum_in_offsets(muons, veto_muons, mask_events, muons.masks["all"], NUMPY_LIB.int8), ha.sum_in_offsets(electrons, veto_electrons, mask_events, electrons.masks["all"], NUMPY_LIB.int8))
-    njets          = ha.sum_in_offsets(jets, nonbjets, mask_events, jets.masks["all"], NUMPY_LIB.int8)
-    ngoodjets      = ha.sum_in_offsets(jets, good_jets, mask_events, jets.masks["all"], NUMPY_LIB.int8)
-    btags          = ha.sum_in_offsets(jets, bjets, mask_events, jets.masks["all"], NUMPY_LIB.int8)
-    btags_resolved = ha.sum_in_offsets(jets, bjets_resolved, mask_events, jets.masks["all"], NUMPY_LIB.int8)
-    nfatjets       = ha.sum_in_offsets(fatjets, good_fatjets, mask_events, fatjets.masks['all'], NUMPY_LIB.int8)
-    #nhiggs = ha.sum_in_offsets(fatjets, higgs_candidates, mask_events, fatjets.masks['all'], NUMPY_LIB.int8)
 
     # trigger logic
     trigger_el = (nleps==1) & (nelectrons==1)
@@ -168,32 +82,32 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
         trigger_mu &= scalars["HLT_IsoMu24"]
     if "SingleMuon" in sample: trigger_el = NUMPY_LIB.zeros(nEvents, dtype=NUMPY_LIB.bool)
     if "SingleElectron" in sample: trigger_mu = NUMPY_LIB.zeros(nEvents, dtype=NUMPY_LIB.bool)
-    mask_events = mask_events & (trigger_el | trigger_mu)
 
-    # for reference, this is the selection for the resolved analysis
-    mask_events_res = mask_events & (nleps == 1) & (lepton_veto == 0) & (ngoodjets >= 4) & (btags_resolved > 2) & (scalars[metstruct+"_pt"] > 20)
-    # apply basic event selection
-    #mask_events_higgs = mask_events & (nleps == 1) & (scalars[metstruct+"_pt"] > 20) & (nhiggs > 0) & (njets > 1)  # & NUMPY_LIB.invert( (njets >= 4) & (btags >=2) ) & (lepton_veto == 0)
-    mask_events_boost = mask_events & (nleps == 1) & (lepton_veto == 0) & (scalars[metstruct+"_pt"] > parameters['met']) & (nfatjets > 0) & (btags >= parameters['btags']) # & (btags_resolved < 3)# & (njets > 1)  # & NUMPY_LIB.invert( (njets >= 4)  )
+    common = {
+        'mask_events'     : mask_events,
+        'mask_trigger'    : (trigger_el | trigger_mu),
+        'good_muons'      : good_muons,
+        'good_electrons'  : good_electrons,
+        'jets_pass_dr'    : jets_pass_dr,
+        'fatjets_pass_dr' : fatjets_pass_dr,
+        'nleps'           : nleps,
+        'lepton_veto'     : lepton_veto,
+    }
 
-############# calculate basic variables
-    mask_events = mask_events_res | mask_events_boost
-    leading_jet_pt        = ha.get_in_offsets(jets.pt, jets.offsets, indices['leading'], mask_events, nonbjets)
-    leading_jet_eta       = ha.get_in_offsets(jets.eta, jets.offsets, indices['leading'], mask_events, nonbjets)
-    leading_fatjet_SDmass = ha.get_in_offsets(fatjets.msoftdrop, fatjets.offsets, indices['leading'], mask_events, good_fatjets)
-    leading_fatjet_pt     = ha.get_in_offsets(fatjets.pt, fatjets.offsets, indices['leading'], mask_events, good_fatjets)
-    leading_fatjet_eta    = ha.get_in_offsets(fatjets.eta, fatjets.offsets, indices['leading'], mask_events, good_fatjets)
-    leading_lepton_pt     = NUMPY_LIB.maximum(ha.get_in_offsets(muons.pt, muons.offsets, indices["leading"], mask_events, good_muons), ha.get_in_offsets(electrons.pt, electrons.offsets, indices["leading"], mask_events, good_electrons))
-    leading_lepton_eta    = NUMPY_LIB.maximum(ha.get_in_offsets(muons.eta, muons.offsets, indices["leading"], mask_events, good_muons), ha.get_in_offsets(electrons.eta, electrons.offsets, indices["leading"], mask_events, good_electrons))
+    # lepton SF corrections, the events passing any selection of the variations get the same weights
+    if is_mc:
+        mask_lepton_weights = mask_events & common['mask_trigger']
+        electron_weights = compute_lepton_weights(electrons, electrons.pt, (electrons.deltaEtaSC + electrons.eta), mask_lepton_weights, good_electrons, evaluator, ["el_triggerSF", "el_recoSF", "el_idSF"])
+        muon_weights = compute_lepton_weights(muons, muons.pt, muons.eta, mask_lepton_weights, good_muons, evaluator, ["mu_triggerSF", "mu_isoSF", "mu_idSF"], args.year)
+        common['weights_lepton'] = muon_weights * electron_weights
 
-    leading_fatjet_rho    = NUMPY_LIB.zeros_like(leading_lepton_pt)
-    leading_fatjet_rho[mask_events] = NUMPY_LIB.log( leading_fatjet_SDmass[mask_events]**2 / leading_fatjet_pt[mask_events]**2 )
+    return common
 
-    lead_lep_p4        = select_lepton_p4(muons, good_muons, electrons, good_electrons, indices["leading"], mask_events)
-    leading_fatjet_phi = ha.get_in_offsets(fatjets.phi, fatjets.offsets, indices['leading'], mask_events, good_fatjets)
-    deltaRHiggsLepton  = ha.calc_dr(lead_lep_p4.phi, lead_lep_p4.eta, leading_fatjet_phi, leading_fatjet_eta, mask_events)
+#Event weights of a systematic variation, weight-only variations differ from each other only here
+def compute_weights(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, is_mc=True, uncertainty=None, uncertaintyName=None, common=None, leading_fatjet_pt=None):
+    scalars = data["eventvars"]
+    nEvents = data["Muon"].numevents()
 
-############# calculate weights for MC samples
     weights = {}
     weights['ones'] = NUMPY_LIB.ones(nEvents, dtype=NUMPY_LIB.float32)
     weights["nominal"] = NUMPY_LIB.ones(nEvents, dtype=NUMPY_LIB.float32)
@@ -231,16 +145,18 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
 
         # pu corrections
         if 'puWeight' in scalars:
-            weights['pu'] = scalars['puWeight']
+            #the branch of a weight-only variation is not swapped into the data, look it up
+            puBranch = 'puWeight'
+            if uncertainty is not None:
+                puBranch = dict(zip(uncertainty[0][::2], uncertainty[0][1::2])).get('puWeight', 'puWeight')
+            weights['pu'] = scalars[puBranch]
         else:
     #        weights['pu'] = compute_pu_weights(parameters["pu_corrections_target"], weights["nominal"], scalars["Pileup_nTrueInt"], scalars["PV_npvsGood"])
             weights['pu'] = compute_pu_weights(parameters["pu_corrections_target"], weights["nominal"], scalars["Pileup_nTrueInt"], scalars["Pileup_nTrueInt"])
         weights["nominal"] = weights["nominal"] * weights['pu']
 
         # lepton SF corrections
-        electron_weights = compute_lepton_weights(electrons, electrons.pt, (electrons.deltaEtaSC + electrons.eta), mask_events, good_electrons, evaluator, ["el_triggerSF", "el_recoSF", "el_idSF"])
-        muon_weights = compute_lepton_weights(muons, muons.pt, muons.eta, mask_events, good_muons, evaluator, ["mu_triggerSF", "mu_isoSF", "mu_idSF"], args.year)
-        weights['lepton']  = muon_weights * electron_weights
+        weights['lepton']  = common['weights_lepton']
         weights["nominal"] = weights["nominal"] * weights['lepton']
 
         # btag SF corrections
@@ -252,7 +168,7 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
 
         # bbtag SF corrections
         if parameters['bbtagging_algorithm']=='btagDDBvL':
-            weights['bbtag'] = NUMPY_LIB.ones_like(mask_events,dtype=NUMPY_LIB.float64) 
+            weights['bbtag'] = NUMPY_LIB.ones_like(leading_fatjet_pt,dtype=NUMPY_LIB.float64) 
             if 'bbtagSF_DDBvL_M1_up' in uncertainty[1]:
                 bbtagSF_loPt = parameters['bbtagSF_DDBvL_M1_loPt_up']
                 bbtagSF_hiPt = parameters['bbtagSF_DDBvL_M1_hiPt_up']
@@ -266,6 +182,166 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
             weights['bbtag'][leading_fatjet_pt>=350] = bbtagSF_hiPt
             weights['nominal'] *= weights['bbtag']
 
+
+    return weights
+
+#This function will be called for every file in the dataset and every systematic variation
+def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, is_mc=True, lumimask=None, cat=False, boosted=False, uncertainty=None, uncertaintyName=None, parametersName=None, extraCorrection=None, common=None, weight_variations=None, dnn_inference=None):
+    #Output structure that will be returned and added up among the files.
+    #Should be relatively small.
+    ret = Results()
+
+    muons     = data["Muon"]
+    electrons = data["Electron"]
+    scalars   = data["eventvars"]
+    jets      = data["Jet"]
+    fatjets   = data["FatJet"]
+    if is_mc:
+      genparts  = data['GenPart']
+
+    if args.year=='2017':
+      metstruct = 'METFixEE2017'
+    else:
+      metstruct = 'MET'
+
+    if is_mc and uncertaintyName.startswith('jes') and not sample.startswith('ttH'):
+        jesMerged = {
+                'Absolute'                    : ['AbsoluteMPFBias','AbsoluteScale','Fragmentation','PileUpDataMC','PileUpPtRef','RelativeFSR','SinglePionECAL','SinglePionHCAL'],
+                f'Absolute_{args.year}'       : ['AbsoluteStat','RelativeStatFSR','TimePtEta'],
+                'BBEC1'                       : ['PileUpPtBB','PileUpPtEC1','RelativePtBB'],
+                'EC2'                         : ['PileUpPtEC2'],
+                'HF'                          : ['PileUpPtHF','RelativeJERHF','RelativePtHF'],
+                f'BBEC1_{args.year}'          : ['RelativeJEREC1','RelativePtEC1','RelativeStatEC'],
+                f'EC2_{args.year}'            : ['RelativePtEC2'],
+                f'RelativeSample_{args.year}' : ['RelativeSample'],
+                f'HF_{args.year}'             : ['RelativeStatHF']
+                }
+        variation = 'Up' if uncertaintyName.endswith('Up') else 'Down'
+        jesName = uncertaintyName.split('jes')[-1].split(variation)[0]
+        if not hasattr(jets,f'pt_jes{jesName}{variation}'):
+            def sumInQuadrature(arr):
+                if len(arr)==1:
+                    return arr
+                else:
+                    return NUMPY_LIB.sqrt(NUMPY_LIB.sum(NUMPY_LIB.square(NUMPY_LIB.array(arr,dtype=NUMPY_LIB.float32)), axis=0))
+
+            for struct in [fatjets,jets]:
+                for var in ['pt','mass']:
+                    c = sumInQuadrature([getattr(struct,f'{var}_nom')-getattr(struct,f'{var}_jes{jesNameSplit}{variation}') for jesNameSplit in jesMerged[jesName]])
+                    setattr(struct, f'{var}_jes{jesName}{variation}', getattr(struct, f'{var}_nom')+(c if variation=='Up' else -c) )
+
+            c = sumInQuadrature([getattr(fatjets,'msoftdrop_nom')-getattr(fatjets,f'msoftdrop_jes{jesNameSplit}{variation}') for jesNameSplit in jesMerged[jesName]])
+            setattr(fatjets, f'msoftdrop_jes{jesName}{variation}', fatjets.msoftdrop_nom+(c if variation=='Up' else -c) )
+            for var in ['pt','phi']:
+                c = sumInQuadrature([scalars[f'{metstruct}_{var}_jer']-scalars[f'{metstruct}_{var}_jes{jesNameSplit}{variation}'] for jesNameSplit in jesMerged[jesName]])
+                scalars[f'{metstruct}_{var}_jes{jesName}{variation}'] = scalars[f'{metstruct}_{var}_nom']+(c if variation=='Up' else -c)
+            set_trace()
+    if uncertainty is not None:
+        if len(uncertainty)!=2: raise Exception(f'Invalid uncertainty {uncertainty}')
+        evUnc, objUnc = uncertainty
+        if len(evUnc)%2!=0: raise Exception(f'Invalid uncertainty for events {evUnc}')
+        for oldVar,newVar in zip(evUnc[::2],evUnc[1::2]):
+            scalars[oldVar] = scalars[newVar].copy()
+
+        if len(objUnc)%3!=0: raise Exception(f'Invalid uncertainty for objects {objUnc}')
+        for struct,oldBranch,newBranch in zip(objUnc[::3],objUnc[1::3],objUnc[2::3]):
+            if struct=='FatJet':
+              if not oldBranch=='bbtagSF_DDBvL_M1':
+                setattr(fatjets, oldBranch, getattr(fatjets,newBranch).copy())
+            elif struct=='Jet':
+                setattr(jets, oldBranch, getattr(jets,newBranch).copy())
+            else:
+                raise Exception(f'Problem with uncertainty on {struct}, {oldBranch}, {newBranch}')
+    
+    if extraCorrection is not None:
+      for e in extraCorrection:
+          fatjets.msoftdrop /= getattr(fatjets, f'msoftdrop_corr_{e}')
+
+    nEvents = muons.numevents()
+
+    indices = {
+        "leading"    : NUMPY_LIB.zeros(nEvents, dtype=NUMPY_LIB.int32),
+        "subleading" : NUMPY_LIB.ones(nEvents, dtype=NUMPY_LIB.int32)
+        }
+
+    #selections and weights which do not depend on the systematic variation
+    if common is None:
+        common = analyze_data_common(data, sample, NUMPY_LIB=NUMPY_LIB, parameters=parameters, is_mc=is_mc, lumimask=lumimask)
+    mask_events = common['mask_events']
+
+    # apply object selection for muons, electrons, jets
+    good_muons = common['good_muons']
+    good_electrons = common['good_electrons']
+    good_jets = jet_selection(jets, None, None, parameters["jets"], common['jets_pass_dr'])
+#    good_jets = jet_selection(jets, muons, (veto_muons | good_muons), parameters["jets"]) & jet_selection(jets, electrons, (veto_electrons | good_electrons) , parameters["jets"])
+    bjets_resolved = good_jets & (getattr(jets, parameters["btagging_algorithm"]) > parameters["btagging_WP"])
+    good_fatjets = jet_selection(fatjets, None, None, parameters["fatjets"], common['fatjets_pass_dr'])
+#    good_fatjets = jet_selection(fatjets, muons, (veto_muons | good_muons), parameters["fatjets"]) & jet_selection(fatjets, electrons, (veto_electrons | good_electrons), parameters["fatjets"]) #FIXME remove vet_leptons
+
+#    higgs_candidates = good_fatjets & (fatjets.pt > 250)
+#    nhiggs = ha.sum_in_offsets(fatjets, higgs_candidates, mask_events, fatjets.masks["all"], NUMPY_LIB.int8)
+#    indices["best_higgs_candidate"] = ha.index_in_offsets(fatjets.pt, fatjets.offsets, 1, mask_events, higgs_candidates)
+#    best_higgs_candidate = NUMPY_LIB.zeros_like(higgs_candidates)
+#    best_higgs_candidate[ (fatjets.offsets[:-1] + indices["best_higgs_candidate"])[NUMPY_LIB.where( fatjets.offsets<len(best_higgs_candidate) )] ] = True
+#    best_higgs_candidate[ (fatjets.offsets[:-1] + indices["best_higgs_candidate"])[NUMPY_LIB.where( fatjets.offsets<len(best_higgs_candidate) )] ] &= nhiggs.astype(NUMPY_LIB.bool)[NUMPY_LIB.where( fatjets.offsets<len(best_higgs_candidate) )] # to avoid removing the leading fatjet in events with no higgs candidate
+
+    good_jets_nohiggs = good_jets & ha.mask_deltar_first(jets, good_jets, fatjets, good_fatjets, 1.2, indices['leading'])
+    bjets = good_jets_nohiggs & (getattr(jets, parameters["btagging_algorithm"]) > parameters["btagging_WP"])
+    nonbjets = good_jets_nohiggs & (getattr(jets, parameters["btagging_algorithm"]) < parameters["btagging_WP"])
+
+    # apply basic event selection -> individual categories cut later
+    nleps          = common['nleps']
+    lepton_veto    = common['lepton_veto']
+    njets          = ha.sum_in_offsets(jets, nonbjets, mask_events, jets.masks["all"], NUMPY_LIB.int8)
+    ngoodjets      = ha.sum_in_offsets(jets, good_jets, mask_events, jets.masks["all"], NUMPY_LIB.int8)
+    btags          = ha.sum_in_offsets(jets, bjets, mask_events, jets.masks["all"], NUMPY_LIB.int8)
+    btags_resolved = ha.sum_in_offsets(jets, bjets_resolved, mask_events, jets.masks["all"], NUMPY_LIB.int8)
+    nfatjets       = ha.sum_in_offsets(fatjets, good_fatjets, mask_events, fatjets.masks['all'], NUMPY_LIB.int8)
+    #nhiggs = ha.sum_in_offsets(fatjets, higgs_candidates, mask_events, fatjets.masks['all'], NUMPY_LIB.int8)
+
+    # trigger logic
+    mask_events = mask_events & common['mask_trigger']
+
+    # for reference, this is the selection for the resolved analysis
+    mask_events_res = mask_events & (nleps == 1) & (lepton_veto == 0) & (ngoodjets >= 4) & (btags_resolved > 2) & (scalars[metstruct+"_pt"] > 20)
+    # apply basic event selection
+    #mask_events_higgs = mask_events & (nleps == 1) & (scalars[metstruct+"_pt"] > 20) & (nhiggs > 0) & (njets > 1)  # & NUMPY_LIB.invert( (njets >= 4) & (btags >=2) ) & (lepton_veto == 0)
+    mask_events_boost = mask_events & (nleps == 1) & (lepton_veto == 0) & (scalars[metstruct+"_pt"] > parameters['met']) & (nfatjets > 0) & (btags >= parameters['btags']) # & (btags_resolved < 3)# & (njets > 1)  # & NUMPY_LIB.invert( (njets >= 4)  )
+
+############# calculate basic variables
+    mask_events = mask_events_res | mask_events_boost
+    leading_jet           = ha.get_in_offsets_columns({'pt': jets.pt, 'eta': jets.eta}, jets.offsets, indices['leading'], mask_events, nonbjets)
+    leading_jet_pt        = leading_jet['pt']
+    leading_jet_eta       = leading_jet['eta']
+    #the leading fat jet is resolved once, its columns are gathered as they are needed
+    leading_fatjet_idx    = ha.resolve_in_offsets(fatjets.offsets, indices['leading'], mask_events, good_fatjets)
+    leading_fatjet        = ha.get_at_indices({'msoftdrop': fatjets.msoftdrop, 'pt': fatjets.pt, 'eta': fatjets.eta, 'phi': fatjets.phi}, leading_fatjet_idx)
+    leading_fatjet_SDmass = leading_fatjet['msoftdrop']
+    leading_fatjet_pt     = leading_fatjet['pt']
+    leading_fatjet_eta    = leading_fatjet['eta']
+    leading_muon          = ha.get_in_offsets_columns({'pt': muons.pt, 'eta': muons.eta}, muons.offsets, indices['leading'], mask_events, good_muons)
+    leading_electron      = ha.get_in_offsets_columns({'pt': electrons.pt, 'eta': electrons.eta}, electrons.offsets, indices['leading'], mask_events, good_electrons)
+    leading_lepton_pt     = NUMPY_LIB.maximum(leading_muon['pt'], leading_electron['pt'])
+    leading_lepton_eta    = NUMPY_LIB.maximum(leading_muon['eta'], leading_electron['eta'])
+
+    leading_fatjet_rho    = NUMPY_LIB.zeros_like(leading_lepton_pt)
+    leading_fatjet_rho[mask_events] = NUMPY_LIB.log( leading_fatjet_SDmass[mask_events]**2 / leading_fatjet_pt[mask_events]**2 )
+
+    lead_lep_p4        = select_lepton_p4(muons, good_muons, electrons, good_electrons, indices["leading"], mask_events)
+    leading_fatjet_phi = leading_fatjet['phi']
+    deltaRHiggsLepton  = ha.calc_dr(lead_lep_p4.phi, lead_lep_p4.eta, leading_fatjet_phi, leading_fatjet_eta, mask_events)
+
+############# calculate weights for MC samples
+    weights = compute_weights(data, sample, NUMPY_LIB=NUMPY_LIB, parameters=parameters, samples_info=samples_info, is_mc=is_mc, uncertainty=uncertainty, uncertaintyName=uncertaintyName, common=common, leading_fatjet_pt=leading_fatjet_pt)
+
+    #the weight-only variations share everything but the weights with this one, their histograms are filled together
+    weights_all = {uncertaintyName: weights}
+    rets = {uncertaintyName: ret}
+    if weight_variations is not None:
+      for vn,v in weight_variations.items():
+        weights_all[vn] = compute_weights(data, sample, NUMPY_LIB=NUMPY_LIB, parameters=parameters, samples_info=samples_info, is_mc=is_mc, uncertainty=v, uncertaintyName=vn, common=common, leading_fatjet_pt=leading_fatjet_pt)
+        rets[vn] = Results()
+
 ############# masks for different selections
     mask_events = {
       'resolved' : mask_events_res,
@@ -274,8 +350,9 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
     mask_events['2J']   = mask_events['basic'] & (njets>1)
 
     #Ws reconstruction
-    pznu = ha.METzCalculator(lead_lep_p4, METp4, mask_events['2J'])
-    neutrinop4 = TLorentzVectorArray.from_cartesian(METp4.x, METp4.y, pznu, NUMPY_LIB.sqrt( METp4.x**2 + METp4.y**2 + pznu**2 ))
+    neutrinop4 = [NUMPY_LIB.zeros(nEvents, dtype=NUMPY_LIB.float32) for i in range(4)]
+    ha.neutrino_pz(lead_lep_p4.pt, lead_lep_p4.eta, lead_lep_p4.phi, lead_lep_p4.mass, scalars[metstruct+"_pt"], scalars[metstruct+"_phi"], mask_events['2J'], out_p4=neutrinop4)
+    neutrinop4 = LorentzVectorArray.from_cartesian(*neutrinop4, NUMPY_LIB)
     lepW = lead_lep_p4 + neutrinop4
 
     hadW = hadronic_W(jets, nonbjets, lepW, mask_events['2J'])
@@ -290,8 +367,9 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
     mask_events['2J2WdeltaR'] = mask_events['2J2W'] & (deltaRlepWHiggs>1) & (deltaRhadWHiggs>1)# & (deltaRlepWHiggs<4) & (deltaRhadWHiggs<4)
 
     #boosted Higgs
-    leading_fatjet_tau1     = ha.get_in_offsets(fatjets.tau1, fatjets.offsets, indices['leading'], mask_events['2J2WdeltaR'], good_fatjets)
-    leading_fatjet_tau2     = ha.get_in_offsets(fatjets.tau2, fatjets.offsets, indices['leading'], mask_events['2J2WdeltaR'], good_fatjets)
+    leading_fatjet_dR       = ha.get_at_indices({'tau1': fatjets.tau1, 'tau2': fatjets.tau2, 'Hbb': getattr(fatjets, parameters["bbtagging_algorithm"])}, NUMPY_LIB.where(mask_events['2J2WdeltaR'], leading_fatjet_idx, -1))
+    leading_fatjet_tau1     = leading_fatjet_dR['tau1']
+    leading_fatjet_tau2     = leading_fatjet_dR['tau2']
     leading_fatjet_tau21    = NUMPY_LIB.divide(leading_fatjet_tau2, leading_fatjet_tau1)
     ### tau21DDT defined as in https://twiki.cern.ch/twiki/bin/viewauth/CMS/JetWtagging#tau21DDT_0_43_HP_0_43_tau21DDT_0
 #    leading_fatjet_tau21DDT = NUMPY_LIB.zeros_like(leading_fatjet_tau21)
@@ -305,7 +383,7 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
 #    mask_events['2J2WdeltaRTau21']    = mask_events['2J2WdeltaR'] & (leading_fatjet_tau21<parameters["fatjets"]["tau21cut"][args.year])
 #    mask_events['2J2WdeltaRTau21DDT'] = mask_events['2J2WdeltaR'] & (leading_fatjet_tau21<parameters["fatjets"]["tau21DDTcut"][args.year])
 
-    leading_fatjet_Hbb = ha.get_in_offsets(getattr(fatjets, parameters["bbtagging_algorithm"]), fatjets.offsets, indices['leading'], mask_events['2J2WdeltaR'], good_fatjets)
+    leading_fatjet_Hbb = leading_fatjet_dR['Hbb']
     for m in ['2J2WdeltaR']:#, '2J2WdeltaRTau21']:#, '2J2WdeltaRTau21DDT']:
         mask_events[f'{m}_Pass'] = mask_events[m] & (leading_fatjet_Hbb>parameters['bbtagging_WP'])
         mask_events[f'{m}_Fail'] = mask_events[m] & (leading_fatjet_Hbb<=parameters['bbtagging_WP'])
@@ -319,7 +397,8 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
         mask_events[m+'_orthogonal'] = mask_events[m] & (btags_resolved < 3)
         mask_events[m+'_overlap']    = mask_events[m] & mask_events['resolved']
     for mn,m in mask_events.items():
-        ret['nevts_'+mn] = Histogram([sum(weights['nominal'][m])], 0,0)
+      for n,w in weights_all.items():
+        rets[n]['nevts_'+mn] = Histogram([sum(w['nominal'][m])], 0,0)
 
     vars2d = {
             'ngoodjets' : ngoodjets,
@@ -336,14 +415,12 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
             #        )
             #ret[f'hist2d_njetsVSbtags_{mn}'] = Histogram( hist, hist, (binsx[0],binsx[-1], binsy[0],binsy[-1]) )
             for vn,v in vars2d.items():
-                hist, binsx, binsy = NUMPY_LIB.histogram2d(v[m], btags_resolved[m],\
-                        bins=(\
+              for n,w in weights_all.items():
+                rets[n][f'hist2d_{vn}VSbtags_{mn}'] = get_histogram_nd( (v[m], btags_resolved[m]), w["nominal"][m],\
+                        (\
                         NUMPY_LIB.linspace(*histogram_settings[vn]),\
                         NUMPY_LIB.linspace(*histogram_settings['btags_resolved']),\
-                        ),\
-                        weights=weights["nominal"][m]\
-                        )
-                ret[f'hist2d_{vn}VSbtags_{mn}'] = Histogram( hist, hist, (*histogram_settings[vn],*histogram_settings['btags_resolved']) )
+                        ) )
 
 ############# histograms
     vars_to_plot = {
@@ -375,41 +452,57 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
       'deltaRHiggsLepton' : deltaRHiggsLepton,
       'PV_npvsGood'       : scalars['PV_npvsGood'],
     }
+    #the predictions are cached per chunk by dnn_inference, the variations which do not change the inputs reuse them
+    if dnn_inference is not None:
+      DNN_pred = evaluate_DNN(jets, good_jets, electrons, good_electrons, muons, good_muons, scalars, mask_events['2J2WdeltaR'], dnn_inference.DNN, dnn_inference.DNN_model, inference=dnn_inference, chunk=data['chunk'])
+      if DNN_pred.ndim == 1:
+        vars_to_plot['DNN_pred'] = DNN_pred
+    weight_names = list(dict.fromkeys(wn for w in weights_all.values() for wn in w))
     if is_mc:
-      for wn,w in weights.items():
-          vars_to_plot[f'weights_{wn}'] = w
+      for wn in weight_names:
+          vars_to_plot[f'weights_{wn}'] = weights[wn] if wn in weights else None #filled from the weights of each variation
       #vars_to_plot['pu_weights'] = pu_weights
 
     #var_name, var = 'leadAK8JetMass', leading_fatjet_SDmass
     vars_split = ['leadAK8JetMass', 'leadAK8JetRho']
     ptbins = NUMPY_LIB.append( NUMPY_LIB.arange(250,600,50), [600, 1000, 5000] )
-    for var_name in vars_split:
-      var = vars_to_plot[var_name]
-      for ipt in range( len(ptbins)-1 ):
-        for m in ['2J2WdeltaR']:#, '2J2WdeltaRTau21']:#, '2J2WdeltaRTau21DDT']:
-          for r in ['Pass','Fail']:
-            for o in ['','_orthogonal']:
-              mask_name = f'{m}_{r}{o}'
-              if not mask_name in mask_events: continue
-              mask = mask_events[mask_name] & (leading_fatjet_pt>ptbins[ipt]) & (leading_fatjet_pt<ptbins[ipt+1])
-              ret[f'hist_{var_name}_{mask_name}_pt{ptbins[ipt]}to{ptbins[ipt+1]}'] = get_histogram( var[mask], weights['nominal'][mask], NUMPY_LIB.linspace( *histogram_settings[var_name] ) )
+    masks_split = {}
+    for ipt in range( len(ptbins)-1 ):
+      for m in ['2J2WdeltaR']:#, '2J2WdeltaRTau21']:#, '2J2WdeltaRTau21DDT']:
+        for r in ['Pass','Fail']:
+          for o in ['','_orthogonal']:
+            mask_name = f'{m}_{r}{o}'
+            if not mask_name in mask_events: continue
+            masks_split[f'{mask_name}_pt{ptbins[ipt]}to{ptbins[ipt+1]}'] = mask_events[mask_name] & (leading_fatjet_pt>ptbins[ipt]) & (leading_fatjet_pt<ptbins[ipt+1])
+    #all the histograms are filled in one pass over the events, the same weight of different variations is a separate weight
+    hists = get_histograms( {var_name : vars_to_plot[var_name] for var_name in vars_split}, masks_split, {n : w['nominal'] for n,w in weights_all.items() if 'nominal' in w}, {var_name : NUMPY_LIB.linspace( *histogram_settings[var_name] ) for var_name in vars_split} )
+    for (var_name, mask_name, n), h in hists.items():
+      rets[n][f'hist_{var_name}_{mask_name}'] = h
 
     #weight_names = {'' : 'nominal', '_NoWeights' : 'ones'}
     #for weight_name, w in weight_names.items():
     #  if w=='ones': continue
-    for wn,w in weights.items():
-      #ret[f'nevts_overlap{weight_name}'] = Histogram( [sum(weights[w]), sum(weights[w][mask_events['2J2WdeltaR']]), sum(weights[w][mask_events['resolved']]), sum(weights[w][mask_events['overlap']])], 0,0 )
-      for mask_name, mask in mask_events.items():
-        if not 'deltaR' in mask_name: continue
+    #ret[f'nevts_overlap{weight_name}'] = Histogram( [sum(weights[w]), sum(weights[w][mask_events['2J2WdeltaR']]), sum(weights[w][mask_events['resolved']]), sum(weights[w][mask_events['overlap']])], 0,0 )
+    masks_fill = {mask_name : mask for mask_name, mask in mask_events.items() if 'deltaR' in mask_name}
+#    for mask_name, mask in masks_fill.items():
 #        with open(f'/afs/cern.ch/work/d/druini/public/hepaccelerate/tests/events_pass_selection_{sample}_{mask_name}.txt','a+') as f:
 #          for nevt, run, lumiBlock in zip(scalars['event'][mask], scalars['run'][mask], scalars['luminosityBlock']):
 #            f.write(f'{nevt}, {run}, {lumiBlock}\n')
-        for var_name, var in vars_to_plot.items():
-          #if (not is_mc) and ('Pass' in mask_name) and (var_name=='leadAK8JetMass') : continue
-          try:
-            ret[f'hist_{var_name}_{mask_name}_weights_{wn}'] = get_histogram( var[mask], w[mask], NUMPY_LIB.linspace( *histogram_settings[var_name if not var_name.startswith('weights') else 'weights'] ) )
-          except KeyError:
-            print(f'!!!!!!!!!!!!!!!!!!!!!!!! Please add variable {var_name} to the histogram settings')
+    bins_fill = {}
+    for var_name in vars_to_plot:
+      #if (not is_mc) and ('Pass' in mask_name) and (var_name=='leadAK8JetMass') : continue
+      try:
+        bins_fill[var_name] = NUMPY_LIB.linspace( *histogram_settings[var_name if not var_name.startswith('weights') else 'weights'] )
+      except KeyError:
+        print(f'!!!!!!!!!!!!!!!!!!!!!!!! Please add variable {var_name} to the histogram settings')
+    hists = get_histograms( {var_name : var for var_name, var in vars_to_plot.items() if var_name in bins_fill and not var_name.startswith('weights_')}, masks_fill, {(n, wn) : w for n,weights_n in weights_all.items() for wn,w in weights_n.items()}, bins_fill )
+    for (var_name, mask_name, (n, wn)), h in hists.items():
+      rets[n][f'hist_{var_name}_{mask_name}_weights_{wn}'] = h
+    #the weights themselves are different in every variation
+    for n,weights_n in weights_all.items():
+      hists = get_histograms( {f'weights_{wn}' : w for wn,w in weights_n.items() if f'weights_{wn}' in bins_fill}, masks_fill, weights_n, bins_fill )
+      for (var_name, mask_name, wn), h in hists.items():
+        rets[n][f'hist_{var_name}_{mask_name}_weights_{wn}'] = h
 
 ############# genPart study: where are the b quarks?
     if sample=='ttHTobb':
@@ -419,7 +512,8 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
           pdb.set_trace()
         for mn,m in mask_events.items():
             genH_pt = ha.get_in_offsets(genparts.pt, genparts.offsets, indices['leading'], m, genH)
-            ret[f'hist_genH_pt_{mn}'] = get_histogram(genH_pt[m], weights['nominal'][m], NUMPY_LIB.linspace(*histogram_settings['leading_jet_pt']))
+            for n,w in weights_all.items():
+              rets[n][f'hist_genH_pt_{mn}'] = get_histogram(genH_pt[m], w['nominal'][m], NUMPY_LIB.linspace(*histogram_settings['leading_jet_pt']))
             genb = {}
             genb['top'] = ha.genPart_from_mother(genparts, 5, 6, m)
             genb['H']   = ha.genPart_from_mother(genparts, 5, 25, m)
@@ -432,25 +526,27 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
                 dr_b1fatjet = ha.calc_dr(genb_vars['phi'][::2], genb_vars['eta'][::2],leading_fatjet_phi[m],leading_fatjet_eta[m],NUMPY_LIB.ones(nevs))
                 dr_b2fatjet = ha.calc_dr(genb_vars['phi'][1::2], genb_vars['eta'][1::2],leading_fatjet_phi[m],leading_fatjet_eta[m],NUMPY_LIB.ones(nevs))
                 #for weight_name, w in weight_names.items():
-                for wn,w in weights.items():
+                for n,weights_n in weights_all.items():
+                  for wn,w in weights_n.items():
                     if wn=='ones': continue
                     #ret[f'hist_dr_b1fatjet_{mn+weight_name}'] = get_histogram( dr_b1fatjet, weights[w][m], NUMPY_LIB.linspace(0,10,101) )
                     #ret[f'hist_dr_b2fatjet_{mn+weight_name}'] = get_histogram( dr_b2fatjet, weights[w][m], NUMPY_LIB.linspace(0,10,101) )
-                    ret[f'hist_dr_genbfrom{mom}_fatjet_{mn}_weights_{wn}'] = get_histogram( dr_b1fatjet, w[m], NUMPY_LIB.linspace(0,10,101) ) + get_histogram( dr_b2fatjet, w[m], NUMPY_LIB.linspace(0,10,101) )
+                    rets[n][f'hist_dr_genbfrom{mom}_fatjet_{mn}_weights_{wn}'] = get_histogram( dr_b1fatjet, w[m], NUMPY_LIB.linspace(0,10,101) ) + get_histogram( dr_b2fatjet, w[m], NUMPY_LIB.linspace(0,10,101) )
                     for var in ['pt','eta']:
-                        ret[f'hist_genbfrom{mom}_{var}_{mn}_weights_{wn}'] = get_histogram( genb_vars[var][::2], w[m], NUMPY_LIB.linspace(*histogram_settings[f'leading_jet_{var}']) ) + get_histogram( genb_vars[var][1::2], w[m], NUMPY_LIB.linspace(*histogram_settings[f'leading_jet_{var}']) )
+                        rets[n][f'hist_genbfrom{mom}_{var}_{mn}_weights_{wn}'] = get_histogram( genb_vars[var][::2], w[m], NUMPY_LIB.linspace(*histogram_settings[f'leading_jet_{var}']) ) + get_histogram( genb_vars[var][1::2], w[m], NUMPY_LIB.linspace(*histogram_settings[f'leading_jet_{var}']) )
 
     ####### printout event numbers 
-    outdir = os.path.join(args.outdir,args.version,parametersName,uncertaintyName)
-    if not os.path.exists(outdir):
-      os.makedirs(outdir)
-
-    outf = os.path.join(outdir, f'{sample}_{uncertaintyName}.txt')
-    exists = os.path.isfile(outf)
-    with open(outf,'a+') as f:
-      if not exists: f.write('run, lumi, event\n')
-      for run,lumi,nevt in zip(scalars['run'][mask_events['2J2WdeltaR_Pass']],scalars['luminosityBlock'][mask_events['2J2WdeltaR_Pass']],scalars['event'][mask_events['2J2WdeltaR_Pass']]):
-        f.write(f'{run}, {lumi}, {nevt}\n')
+    for n in weights_all:
+      outdir = os.path.join(args.outdir,args.version,parametersName,n)
+      if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+      outf = os.path.join(outdir, f'{sample}_{n}.txt')
+      exists = os.path.isfile(outf)
+      with open(outf,'a+') as f:
+        if not exists: f.write('run, lumi, event\n')
+        for run,lumi,nevt in zip(scalars['run'][mask_events['2J2WdeltaR_Pass']],scalars['luminosityBlock'][mask_events['2J2WdeltaR_Pass']],scalars['event'][mask_events['2J2WdeltaR_Pass']]):
+          f.write(f'{run}, {lumi}, {nevt}\n')
 
     ### next lines are to write event numbers of very high pt events
     #mask = mask_events['2J2WdeltaR'] & (leading_fatjet_pt>1500)
@@ -661,17 +757,60 @@ def analyze_data(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, i
 #
 #
 #
+    if weight_variations is not None:
+      return Results(rets)
+    return ret
+
+#branches which only enter the event weights
+weight_branches = ['puWeight', 'btagSF_deepjet_M', 'bbtagSF_DDBvL_M1']
+
+def kinematic_swaps(uncertainty):
+    """The branch swaps of an uncertainty which change objects or event variables, i.e. not only the weights"""
+    if uncertainty is None:
+        return ((), ())
+    evUnc, objUnc = uncertainty
+    ev  = sorted((old,new) for old,new in zip(evUnc[::2],evUnc[1::2]) if not old in weight_branches)
+    obj = sorted((struct,old,new) for struct,old,new in zip(objUnc[::3],objUnc[1::3],objUnc[2::3]) if not old in weight_branches)
+    return (tuple(ev), tuple(obj))
+
+#Runs all the systematic variations on a file in one pass: the selections and weights they do not change are computed once
+def analyze_data_variations(data, sample, NUMPY_LIB=None, parameters={}, samples_info={}, is_mc=True, lumimask=None, cat=False, boosted=False, uncertainties={}, parametersName=None, extraCorrection=None, weights_fast_path=False, dnn_inference=None):
+    common = analyze_data_common(data, sample, NUMPY_LIB=NUMPY_LIB, parameters=parameters, is_mc=is_mc, lumimask=lumimask)
+
+    #variations with the same kinematic swaps only differ in the weights, analyse them together
+    groups = {}
+    for un,u in uncertainties.items():
+        key = kinematic_swaps(u) if weights_fast_path else un
+        groups.setdefault(key, []).append(un)
+
+    #one set of histograms per variation
+    ret = Results()
+    for names in groups.values():
+        un = names[0]
+        weight_variations = {vn : uncertainties[vn] for vn in names[1:]}
+        ret_group = analyze_data(data, sample, NUMPY_LIB=NUMPY_LIB, parameters=parameters, samples_info=samples_info, is_mc=is_mc, lumimask=lumimask, cat=cat, boosted=boosted, uncertainty=uncertainties[un], uncertaintyName=un, parametersName=parametersName, extraCorrection=extraCorrection, common=common, weight_variations=weight_variations, dnn_inference=dnn_inference)
+        for vn in names:
+            ret[vn] = ret_group[vn]
     return ret
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Runs a simple array-based analysis')
     parser.add_argument('--use-cuda', action='store_true', help='Use the CUDA backend')
-    parser.add_argument('--from-cache', action='store_true', help='Load from cache (otherwise create it)')
+    parser.add_argument('--from-cache', action='store_true', help='Load from cache (files and branches missing in the cache are read from ROOT and added to it)')
     parser.add_argument('--nthreads', action='store', help='Number of CPU threads to use', type=int, default=4, required=False)
     parser.add_argument('--files-per-batch', action='store', help='Number of files to process per batch', type=int, default=1, required=False)
+    parser.add_argument('--workers', action='store', help='Number of processes analysing the files (or chunks of --chunksize events) of a batch in parallel, CPU only', type=int, default=1, required=False)
+    parser.add_argument('--workqueue', action='store', help='Number of local worker processes pulling files (or chunks of --chunksize events) from a work queue', type=int, default=0, required=False)
+    parser.add_argument('--max-retries', action='store', help='Number of times a failed work queue task is retried', type=int, default=2, required=False)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--prefetch', action='store', help='Number of batches (or chunks) to load in the background while analysing the current one, 0 to disable', type=int, default=0, required=False)
+    parser.add_argument('--prefetch-memory', action='store', help='Maximum memory in GB held by the loaded batches when prefetching', type=float, default=None, required=False)
+    parser.add_argument('--chunksize', action='store', help='Number of events to process at a time, bounds the memory usage (default: whole files)', type=int, default=None, required=False)
     parser.add_argument('--cache-location', action='store', help='Path prefix for the cache, must be writable', type=str, default=os.path.join(os.getcwd(), 'cache'))
+    parser.add_argument('--cache-quota', action='store', help='Maximum size of the cache in GB, least recently used entries are evicted beyond it', type=float, default=None, required=False)
     parser.add_argument('--outdir', action='store', help='directory to store outputs', type=str, default=os.getcwd())
     parser.add_argument('--outtag', action='store', help='outtag added to output file', type=str, default="")
+    parser.add_argument('--output-format', action='store', choices=['json', 'hbin'], help='format of the output files, hbin is a binary file with an index to load single histograms', type=str, default='json')
     parser.add_argument('--version', action='store', help='tag added to the output directory', type=str, default='')
     parser.add_argument('--filelist', action='store', help='List of files to load', type=str, default=None, required=False)
     parser.add_argument('--sample', action='store', help='sample name', type=str, default=None, required=True)
@@ -680,9 +819,25 @@ if __name__ == "__main__":
     parser.add_argument('--year', action='store', choices=['2016', '2017', '2018'], help='Year of data/MC samples', default='2017')
     parser.add_argument('--parameters', nargs='+', help='change default parameters, syntax: name value, eg --parameters met 40 bbtagging_algorithm btagDDBvL', default=None)
     parser.add_argument('--corrections', action='store_true', help='Flag to include corrections')
+    parser.add_argument('--single-pass', action='store_true', help='Analyse all the systematic variations of a file in one pass, computing the parts they do not change only once')
+    parser.add_argument('--DNN', action='store', help='Type of the DNN to evaluate on the selected events (e.g. ffwd_binary), needs --DNN-model', type=str, default=None, required=False)
+    parser.add_argument('--DNN-model', action='store', help='Keras model file of the DNN', type=str, default=None, required=False)
+    parser.add_argument('--weights-fast-path', action='store_true', help='Fill the histograms of the variations which only change the event weights together with the nominal ones, implies --single-pass')
     parser.add_argument('filenames', nargs=argparse.REMAINDER)
     args = parser.parse_args()
 
+    args.single_pass = args.single_pass or args.weights_fast_path
+
+    if args.workers > 1 and args.use_cuda:
+        parser.error("--workers is only supported with the CPU backend")
+    if args.workers > 1 and args.prefetch > 0:
+        #the workers are forked while the prefetching thread and its readers may hold locks
+        parser.error("--workers can not be combined with --prefetch")
+    if args.workers > 1:
+        #the workers are forked after the kernels ran in this process, the TBB threading layer can hang at exit then
+        import numba
+        numba.config.THREADING_LAYER = "workqueue"
+
     # set CPU or GPU backend
     NUMPY_LIB, ha = choose_backend(args.use_cuda)
     lib_analysis.NUMPY_LIB, lib_analysis.ha = NUMPY_LIB, ha
@@ -715,6 +870,15 @@ if __name__ == "__main__":
         is_mc = True
         lumimask = None
 
+    #one inference for the whole run, its predictions are reused among the variations of a chunk
+    dnn_inference = None
+    if args.DNN is not None:
+        if args.DNN_model is None:
+            raise Exception('--DNN needs --DNN-model')
+        import keras.models
+        DNN_model = keras.models.load_model(args.DNN_model, custom_objects={'mse0': lib_analysis.mse0, 'mae0': lib_analysis.mae0, 'r2_score0': lib_analysis.r2_score0})
+        dnn_inference = DNNInference(args.DNN, DNN_model)
+
 
     #define arrays to load: these are objects that will be kept together
     arrays_objects = [
@@ -882,8 +1046,21 @@ if __name__ == "__main__":
       uncertainties = {'' : None}
       results       = {'' : Results()}
 
-    for ibatch, files_in_batch in enumerate(chunks(filenames, args.files_per_batch)):
-        print(f'!!!!!!!!!!!!! loading {ibatch}: {files_in_batch}')
+    if is_mc:
+
+        # add information needed for MC corrections
+        parameters["pu_corrections_target"] = load_puhist_target(parameters["pu_corrections_file"])
+        #parameters["btag_SF_target"] = BTagScaleFactor(parameters["btag_SF_{}".format(parameters["btagging_algorithm"])], BTagScaleFactor.RESHAPE, 'iterativefit,iterativefit,iterativefit', keep_df=True)
+
+        ### this computes the lepton weights
+        ext = extractor()
+        print(parameters["corrections"])
+        for corr in parameters["corrections"]:
+            ext.add_weight_sets([corr])
+        ext.finalize()
+        evaluator = ext.make_evaluator()
+
+    def make_dataset(files_in_batch):
         #define our dataset
         structs = ["Jet", "Muon", "Electron"]#, "selectedPatJetsAK4PFPuppi"]
         if is_mc:
@@ -893,9 +1070,26 @@ if __name__ == "__main__":
 #          if is_mc:
 #            structs += ['GenPart']
         dataset = NanoAODDataset(files_in_batch, arrays_objects + arrays_event, "Events", structs, arrays_event)
-        dataset.get_cache_dir = lambda fn,loc=args.cache_location: os.path.join(loc, fn)
+        dataset.get_cache_dir = lambda fn,loc=args.cache_location: os.path.join(loc, fn.lstrip(os.sep))
+        dataset.cache_manager = CacheManager(args.cache_location, quota=None if args.cache_quota is None else args.cache_quota*1e9)
+        return dataset
+
+    def load_batches():
+      """Yield (ibatch, ichunk, dataset) with the data loaded and the objects made, ready to be analysed"""
+      for ibatch, files_in_batch in enumerate(chunks(filenames, args.files_per_batch)):
+        print(f'!!!!!!!!!!!!! loading {ibatch}: {files_in_batch}')
+        dataset = make_dataset(files_in_batch)
+
+        if args.from_cache:
+          print("loading dataset from cache")
+          dataset.from_cache(verbose=True, nthreads=args.nthreads)
 
-        if not args.from_cache:
+        if args.chunksize is not None and args.workers <= 1:
+            #stream the batch in chunks of events, either read from ROOT one at a time or as views of the cache
+            for ichunk, chunk in enumerate(dataset.iterate_chunks(args.chunksize, nthreads=args.nthreads, verbose=True)):
+                yield ibatch, ichunk, chunk
+
+        elif not args.from_cache:
             #Load data from ROOT files
             dataset.preload(nthreads=args.nthreads, verbose=True)
 
@@ -906,35 +1100,99 @@ if __name__ == "__main__":
 #            print("preparing dataset cache")
 #            dataset.to_cache(verbose=True, nthreads=args.nthreads)  ###ALE: comment to run without cache
 
+            #the structs hold a copy of the data, release the raw arrays
+            dataset.data_host = []
+            yield ibatch, 0, dataset
 
-        #Optionally, load the dataset from an uncompressed format
         else:
-          print("loading dataset from cache")
-          dataset.from_cache(verbose=True, nthreads=args.nthreads)
-
-        if is_mc:
-
-            # add information needed for MC corrections
-            parameters["pu_corrections_target"] = load_puhist_target(parameters["pu_corrections_file"])
-            #parameters["btag_SF_target"] = BTagScaleFactor(parameters["btag_SF_{}".format(parameters["btagging_algorithm"])], BTagScaleFactor.RESHAPE, 'iterativefit,iterativefit,iterativefit', keep_df=True)
+            yield ibatch, 0, dataset
+
+    def analyze_chunk(chunk):
+      """Run the analysis for all parameter sets and uncertainties on a dataset, returns Results({parametersName: Results({uncertaintyName: Results})})"""
+      ret = Results({})
+      for p in pars:
+        parameters['met'], parameters['bbtagging_algorithm'], parameters['bbtagging_WP'], parameters['btags'] = pars[p] #
+        if args.single_pass:
+          #all the variations of a file are analysed together, sharing the parts they do not change
+          ret[p] = chunk.analyze(analyze_data_variations, NUMPY_LIB=NUMPY_LIB, parameters=parameters, is_mc = is_mc, lumimask=lumimask, cat=args.categories, sample=args.sample, samples_info=samples_info, boosted=args.boosted, uncertainties=uncertainties, parametersName=p, extraCorrection=extraCorrections['no_PUPPI'], weights_fast_path=args.weights_fast_path, dnn_inference=dnn_inference)
+          continue
+        ret[p] = Results({})
+        for un,u in uncertainties.items():
+        #### this is where the magic happens: run the main analysis
+          #if not 'BBEC1' in un: continue
+          ret[p][un] = chunk.analyze(analyze_data, NUMPY_LIB=NUMPY_LIB, parameters=parameters, is_mc = is_mc, lumimask=lumimask, cat=args.categories, sample=args.sample, samples_info=samples_info, boosted=args.boosted, uncertainty=u, uncertaintyName=un, parametersName=p, extraCorrection=extraCorrections['no_PUPPI'], dnn_inference=dnn_inference)
+      return ret
+
+    def analyze_task(task):
+      """Load and analyse the events [entrystart, entrystop) of one file, a task of the work queue"""
+      sample, fn, entrystart, entrystop = task
+      assert(sample == args.sample)
+      dataset = make_dataset([fn])
+      if args.from_cache:
+        dataset.from_cache(nthreads=args.nthreads)
+        chunk = dataset.select_chunk(0, entrystart, entrystop)
+      else:
+        tt = uproot.open(fn).get("Events")
+        chunk = dataset.make_chunk(0, entrystart, entrystop)
+        chunk.data_host = [chunk.read_arrays(tt, args.nthreads, entrystart, entrystop)]
+        chunk.make_objects()
+        chunk.data_host = []
+      return analyze_chunk(chunk)
+
+    if args.worker:
+      #pull tasks from the coordinator until there are none left
+      run_worker(analyze_task)
+      sys.exit(0)
+
+    failed = []
+    if args.workqueue > 0:
+      #one task per file, or per --chunksize events
+      tasks = []
+      for fn in filenames:
+        nev = uproot.open(fn).get("Events").numentries
+        steps = nev if args.chunksize is None else args.chunksize
+        tasks += [(args.sample, fn, entrystart, min(entrystart + steps, nev)) for entrystart in range(0, nev, max(steps, 1))]
+
+      #the workers run this script with the same arguments
+      worker_argv = []
+      for arg in sys.argv[1:]:
+        if arg.startswith('--workqueue='):
+          continue
+        if len(worker_argv) > 0 and worker_argv[-1] == '--workqueue':
+          worker_argv.pop()
+          continue
+        worker_argv += [arg]
+      #options go before the positional filenames
+      command = [sys.executable, os.path.abspath(__file__), '--worker'] + worker_argv
+
+      ret, failed = WorkQueue(tasks, max_retries=args.max_retries, verbose=True).run(command, args.workqueue)
+      for task in failed:
+        print(f'task failed: {task}')
+      #only the histograms filled by some task are returned
+      for p in pars:
+        for un in uncertainties:
+          if p in ret and un in ret[p]:
+            results[p][un] += ret[p][un]
+      batches = []
+    else:
+      #the next batches are loaded in the background while the current one is analysed
+      max_bytes = None if args.prefetch_memory is None else args.prefetch_memory*1e9
+      batches = prefetch(load_batches(), depth=args.prefetch, max_bytes=max_bytes, sizeof=lambda x: x[2].nbytes())
 
-            ### this computes the lepton weights
-            ext = extractor()
-            print(parameters["corrections"])
-            for corr in parameters["corrections"]:
-                ext.add_weight_sets([corr])
-            ext.finalize()
-            evaluator = ext.make_evaluator()
+    for ibatch, ichunk, chunk in batches:
+          if ibatch == 0 and ichunk == 0:
+              print(chunk.printout())
 
-        if ibatch == 0:
-            print(dataset.printout())
+          if args.workers > 1:
+            #the events of the batch are split in ranges of --chunksize events, analysed in forked processes
+            ret = chunk.analyze_parallel(analyze_chunk, args.workers, entrysteps=args.chunksize, verbose=True)
+          else:
+            ret = analyze_chunk(chunk)
 
-        for p in pars:
-          parameters['met'], parameters['bbtagging_algorithm'], parameters['bbtagging_WP'], parameters['btags'] = pars[p] #
-          for un,u in uncertainties.items():
-          #### this is where the magic happens: run the main analysis
-            #if not 'BBEC1' in un: continue
-            results[p][un] += dataset.analyze(analyze_data, NUMPY_LIB=NUMPY_LIB, parameters=parameters, is_mc = is_mc, lumimask=lumimask, cat=args.categories, sample=args.sample, samples_info=samples_info, boosted=args.boosted, uncertainty=u, uncertaintyName=un, parametersName=p, extraCorrection=extraCorrections['no_PUPPI'])
+          for p in pars:
+            for un in uncertainties:
+              if p in ret and un in ret[p]:
+                results[p][un] += ret[p][un]
 
     #print(results)
 
@@ -958,4 +1216,12 @@ if __name__ == "__main__":
         if not os.path.exists(outdir):
           os.makedirs(outdir)
 
-        r.save_json(os.path.join(outdir,f"out_{args.sample}_{rn}{args.outtag}.json"))
+        if args.output_format == 'hbin':
+          r.save_hbin(os.path.join(outdir,f"out_{args.sample}_{rn}{args.outtag}.hbin"))
+        else:
+          r.save_json(os.path.join(outdir,f"out_{args.sample}_{rn}{args.outtag}.json"))
+
+    #the partial results are written, the batch system has to see the failed tasks
+    if len(failed) > 0:
+      print(f'{len(failed)} tasks failed')
+      sys.exit(1)
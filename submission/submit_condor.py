@@ -18,6 +18,7 @@ parser.add_argument('--condor-job-flavour', choices=['espresso','microcentury','
 parser.add_argument('--parameters', nargs='+', help='change default parameters, syntax: name value, eg --parameters met 40 bbtagging_algorithm btagDDBvL', default=None)
 parser.add_argument('--from-cache', action='store_true', help='Load from cache (otherwise create it)')
 parser.add_argument('--files-per-batch', action='store', help='Number of files to process per batch', type=int, default=1, required=False)
+parser.add_argument('--chunksize', action='store', help='Number of events to process at a time, bounds the memory usage of the jobs', type=int, default=None, required=False)
 parser.add_argument('--nthreads', action='store', help='Number of CPU threads to use', type=int, default=4, required=False)
 parser.add_argument('--cache-location', action='store', help='Path prefix for the cache, must be writable', type=str, default=os.path.join(os.getcwd(), 'cache'))
 parser.add_argument('--outdir', action='store', help='directory to store outputs', type=str, default=os.path.join(os.getcwd(),'results'))
@@ -118,6 +119,8 @@ for s in samples:
           fh.write(f' --version {args.version} ')
       if args.from_cache:
           fh.write(" --from-cache ")
+      if args.chunksize is not None:
+          fh.write(f" --chunksize {args.chunksize} ")
       fh.write(f" --boosted --sample {s} --files-per-batch {args.files_per_batch} --nthread {args.nthreads}  --year {args.year} --outtag _{njob} --outdir {os.path.join(args.outdir,args.year)} ")
       for fi in f:
           fh.write(f'{fi} ')
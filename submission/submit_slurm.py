@@ -11,10 +11,12 @@ parser.add_argument('--samples', nargs='+', help='List of samples to process', t
 parser.add_argument('--files-per-job', action='store', help='Number of files to process per job', type=int, default=5)
 parser.add_argument('--postproc', action='store_true', help='Flag for running on postprocessed datasets and include corrections')
 parser.add_argument('-q','--quick', action='store_true', help='submit jobs to the quick queue')
+parser.add_argument('--mem', action='store', help='Memory per job in MB', type=int, default=4000)
 
 parser.add_argument('--parameters', nargs='+', help='change default parameters, syntax: name value, eg --parameters met 40 bbtagging_algorithm btagDDBvL', default=None)
 parser.add_argument('--from-cache', action='store_true', help='Load from cache (otherwise create it)')
 parser.add_argument('--files-per-batch', action='store', help='Number of files to process per batch', type=int, default=1, required=False)
+parser.add_argument('--chunksize', action='store', help='Number of events to process at a time, bounds the memory usage of the jobs', type=int, default=None, required=False)
 parser.add_argument('--nthreads', action='store', help='Number of CPU threads to use', type=int, default=4, required=False)
 parser.add_argument('--cache-location', action='store', help='Path prefix for the cache, must be writable', type=str, default=os.path.join(os.getcwd(), 'cache'))
 parser.add_argument('--outdir', action='store', help='directory to store outputs', type=str, default=os.path.join(os.getcwd(),'results'))
@@ -96,6 +98,8 @@ for s in samples:
                 fh.write(f' --version {args.version} ')
             if args.from_cache:
                 fh.write(" --from-cache ")
+            if args.chunksize is not None:
+                fh.write(f" --chunksize {args.chunksize} ")
             if args.postproc:
               fh.write(' --corrections ')
             fh.write(f" --boosted --sample {s} --files-per-batch {args.files_per_batch} --nthread {args.nthreads}  --year {args.year} --outtag _{njob} --outdir {os.path.join(args.outdir,args.year)} ")
@@ -106,4 +110,4 @@ for s in samples:
               else:
                 fh.write(f'{fi.replace("xrootd-cms.infn.it","cms-xrd-global.cern.ch")} ')
 
-        os.system(f"sbatch {'-p quick --time 01:00:00' if args.quick else ''} --mem=4000 {job_file}")
+        os.system(f"sbatch {'-p quick --time 01:00:00' if args.quick else ''} --mem={args.mem} {job_file}")